@@ -1,10 +1,18 @@
 import abc
+import argparse
+import array
+import bisect
+import copy
 import os
 import re
 import sys
+import time
 import typing as typ
 
-from . import compiled
+from . import compiled, object_file
+
+if typ.TYPE_CHECKING:
+    from . import linker
 
 
 class AssemblyError(abc.ABC, Exception):
@@ -26,12 +34,14 @@ class LinkTimeError(AssemblyError):
 class ParseError(AssemblyError):
     def __init__(self, msg: str) -> None:
         self.asm_traceback: typ.List[typ.List[str]] = []
-        self.registered_parsers: typ.Set['Parser'] = set()
+        self.registered_interpreters: typ.Set['Interpreter'] = set()
         self.msg = msg
 
-    def add_traceback(self, lines: typ.List[str], parser: 'Parser') -> None:
+    def add_traceback(
+        self, lines: typ.List[str], interpreter: 'Interpreter'
+    ) -> None:
         self.asm_traceback.append(lines)
-        self.registered_parsers.add(parser)
+        self.registered_interpreters.add(interpreter)
 
     def print_info(self) -> None:
         print("\n !!! Parsing Error !!!")
@@ -43,13 +53,14 @@ class ParseError(AssemblyError):
 
 
 class ValueNotReadyException(Exception):
-    def __init__(self, msg: str, traceback: typ.Optional['ProgramTraceback']):
+    def __init__(self, msg: str, traceback: typ.Optional[int]):
         self.msg = msg
         self.traceback = traceback
 
 
 class Value(abc.ABC):
-    backtrace: typ.Optional['ProgramTraceback'] = None
+    # the number of the traceback in the assembler's traceback_table
+    backtrace: typ.Optional[int] = None
 
 
 class IdentifierValue(Value):
@@ -68,16 +79,18 @@ class NumericValue(Value):
         pass
 
     def as_integer(self, asm: 'Assembler') -> int:
-        word_array = self.as_word_array(asm)
-
-        return sum(
-            word * 2 ** (6 * (self.num_words - i - 1))
-            for i, word in enumerate(word_array)
-        )
+        value = 0
+        for word in self.as_word_array(asm):
+            value = value * 64 + word
+        return value
 
     def place_value(self, location: int, assembler: 'Assembler') -> None:
         pass
 
+    def referenced_labels(self) -> typ.Optional[typ.List[str]]:
+        # the labels the value depends on, or None if it can't tell
+        return None
+
 
 class ConstantNumericValue(NumericValue):
     def __init__(self, value: int, num_words: int):
@@ -101,24 +114,65 @@ class ConstantNumericValue(NumericValue):
     def __repr__(self) -> str:
         return f'ConstantNumericValue({self.value}_{self.num_words})'
 
+    def fits(self) -> bool:
+        return (
+            0 <= self.value and
+            self.value.bit_length() <= 6 * self.num_words
+        )
+
     def as_word_array(self, asm: 'Assembler') -> typ.List[int]:
         return self.int_to_words(self.value, self.num_words)
 
+    def as_integer(self, asm: 'Assembler') -> int:
+        if not self.fits():
+            # for the same error as as_word_array
+            self.int_to_words(self.value, self.num_words)
+        return self.value
+
+    def referenced_labels(self) -> typ.Optional[typ.List[str]]:
+        return []
+
+
+class DerivedValue(ConstantNumericValue):
+    # a number a function worked out from values that depend on labels
+    def __init__(
+        self, value: int, num_words: int,
+        labels: typ.Optional[typ.List[str]]
+    ):
+        super().__init__(value, num_words)
+        self.labels = labels
+
+    def __repr__(self) -> str:
+        return f'DerivedValue({self.value}_{self.num_words}, {self.labels})'
+
+    def referenced_labels(self) -> typ.Optional[typ.List[str]]:
+        return self.labels
+
 
 class LabelValue(NumericValue):
     def __init__(self, name: str):
         self.name = name
         self.num_words = 3
+        # the address it was last found at, and its words
+        self.resolved: typ.Optional[typ.Tuple[int, typ.List[int]]] = None
 
     def as_word_array(self, asm: 'Assembler') -> typ.List[int]:
-        if self.name not in asm.label_values:
+        address = asm.label_values.get(self.name)
+        if address is None:
             raise ValueNotReadyException(
                 f"Can't find label {self.name}", self.backtrace
             )
 
-        return ConstantNumericValue.int_to_words(
-            asm.label_values[self.name], 3
-        )
+        # labels can't be redeclared, so this only changes if the value is
+        # used by another Assembler
+        if self.resolved is None or self.resolved[0] != address:
+            self.resolved = (
+                address, ConstantNumericValue.int_to_words(address, 3)
+            )
+        return self.resolved[1]
+
+    def referenced_labels(self) -> typ.Optional[typ.List[str]]:
+        return [self.name]
 
 
 class InlineLabelDeclarationValue(NumericValue):
@@ -137,6 +191,9 @@ class InlineLabelDeclarationValue(NumericValue):
         #       slightly vague error, but there should be a better message
         assembler.declare_label(self.name, location)
 
+    def referenced_labels(self) -> typ.Optional[typ.List[str]]:
+        return self.initial_value.referenced_labels()
+
 
 class MakeResultValue(NumericValue):
     def __init__(self, constituents: typ.List[NumericValue]):
@@ -158,6 +215,15 @@ class MakeResultValue(NumericValue):
             consitituent.place_value(location + offset, assembler)
             offset += consitituent.num_words
 
+    def referenced_labels(self) -> typ.Optional[typ.List[str]]:
+        labels = []
+        for constituent in self.constituents:
+            constituent_labels = constituent.referenced_labels()
+            if constituent_labels is None:
+                return None
+            labels.extend(constituent_labels)
+        return labels
+
 
 class ExtractedValue(NumericValue):
     num_words = 1
@@ -170,19 +236,203 @@ class ExtractedValue(NumericValue):
     def as_word_array(self, asm: 'Assembler') -> typ.List[int]:
         return [self.value.as_word_array(asm)[self.word_num]]
 
+    def referenced_labels(self) -> typ.Optional[typ.List[str]]:
+        return self.value.referenced_labels()
 
-class CodeValue(Value):
+
+def fold_constant(
+    value: NumericValue, operands: typ.Sequence[Value], asm: 'Assembler'
+) -> NumericValue:
+    # value, worked out now if it only depends on plain constants. Not
+    # subclasses of them, which (like $$ while building a library module)
+    # are more than their value, and not ones that don't fit, whose error
+    # should only come if they're used.
+    for operand in operands:
+        if type(operand) is not ConstantNumericValue or not operand.fits():
+            return value
+    return ConstantNumericValue(value.as_integer(asm), value.num_words)
+
+
+class SourceBlock:
+    # Lines of source, either a whole file or the inside of a code block,
+    # which are parsed the first time they're run and then reused
     def __init__(
-        self, lines: typ.List[str], line_mapping: typ.List[int], origin: str,
-        context: 'Context'
+        self, lines: typ.List[str], line_mapping: typ.List[int], origin: str
     ):
         self.lines = lines
         self.line_mapping = line_mapping
         self.origin = origin
-        self.context = context
+        self.statements: typ.Optional[typ.List['Statement']] = None
 
         assert len(self.lines) == len(self.line_mapping)
 
+    @staticmethod
+    def from_source(source: str, origin: str) -> 'SourceBlock':
+        sanitised = source.replace('\r', '')
+        lines = sanitised.split('\n')
+
+        line_mapping = [
+            line_index + 1 for line_index in range(len(lines))
+        ]
+        return SourceBlock(lines, line_mapping, origin)
+
+    def parse(self) -> typ.List['Statement']:
+        if self.statements is None:
+            self.statements = Parser(self).parse_program()
+        return self.statements
+
+    def __deepcopy__(self, memo: typ.Dict[int, typ.Any]) -> 'SourceBlock':
+        # never changes once parsed, so copies can share it
+        return self
+
+
+class IncludeCache:
+    # Included files, shared between every Assembler in the process. Parsed
+    # statements don't depend on the Assembler or Context they're run in,
+    # so a file only needs reading and parsing again if it's changed.
+    def __init__(self) -> None:
+        self.entries: typ.Dict[
+            str, typ.Tuple[typ.Tuple[int, int], SourceBlock]
+        ] = {}
+
+    def load(self, file_path: str) -> SourceBlock:
+        file_path = os.path.realpath(file_path)
+        version = self.version(file_path)
+        if version is None:
+            raise ParseError(f"Can't read include {file_path}")
+
+        entry = self.entries.get(file_path)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+
+        with open(file_path) as file:
+            source = file.read()
+
+        block = SourceBlock.from_source(source, file_path)
+        self.entries[file_path] = (version, block)
+        return block
+
+    def version(self, file_path: str) -> typ.Optional[typ.Tuple[int, int]]:
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+
+include_cache = IncludeCache()
+
+
+class PreludeSnapshot:
+    # The Context and Assembler state after running a prelude
+    def __init__(self, assembler: 'Assembler', context: 'Context') -> None:
+        # sections hold code values, which share contexts with context
+        self.context, self.data_values, self.sections = copy.deepcopy(
+            (context, assembler.data_values, assembler.sections)
+        )
+        self.label_values = assembler.label_values.copy()
+        self.ip = assembler.ip
+        self.current_uid = assembler.current_uid
+        self.collected_ranges = assembler.collected_ranges.copy()
+        # what the traceback numbers in all of the above refer to
+        self.traceback_table = assembler.traceback_table.copy()
+
+        self.included_files = assembler.included_files.copy()
+        self.file_versions = [
+            include_cache.version(file_path)
+            for file_path in self.included_files
+        ]
+
+    def is_current(self) -> bool:
+        return all(
+            include_cache.version(file_path) == version
+            for file_path, version in zip(
+                self.included_files, self.file_versions
+            )
+        )
+
+    def restore(self, assembler: 'Assembler') -> 'Context':
+        context, assembler.data_values, assembler.sections = copy.deepcopy(
+            (self.context, self.data_values, self.sections)
+        )
+        # DATA is the only thing that sets written flags
+        for start_ip, value, traceback in self.data_values:
+            assembler.write_words(start_ip, value.num_words)
+        assembler.label_values = self.label_values.copy()
+        assembler.ip = self.ip
+        assembler.current_uid = self.current_uid
+        assembler.collected_ranges = self.collected_ranges.copy()
+        assembler.traceback_table = self.traceback_table.copy()
+        assembler.included_files = self.included_files.copy()
+        return context
+
+
+PreludeKey = typ.Tuple[
+    typ.Tuple[str, ...], typ.Tuple[str, ...], typ.Tuple[str, ...]
+]
+
+
+class PreludeCache:
+    # Nearly every program starts by including common_pre, saying what it
+    # NEEDs and including common. The state after those lines is kept, and
+    # later programs with the same prelude start from a copy of it instead
+    # of running it again. Shared between every Assembler in the process.
+    PRELUDE_COMMANDS = ('INCLUDE', 'NEED')
+
+    def __init__(self) -> None:
+        self.snapshots: typ.Dict[PreludeKey, PreludeSnapshot] = {}
+
+    def prelude_length(self, block: SourceBlock) -> int:
+        # the number of INCLUDE and NEED commands the block starts with
+        length = 0
+        for statement in block.parse():
+            if not isinstance(statement, CommandStatement):
+                break
+            if statement.name.upper() not in self.PRELUDE_COMMANDS:
+                break
+            length += 1
+        return length
+
+    def key(
+        self, block: SourceBlock, prelude_length: int, assembler: 'Assembler'
+    ) -> PreludeKey:
+        # includes are looked up relative to the primary file, so the same
+        # lines can mean different files in different directories, and what
+        # SECTION keeps depends on the kind of assembler
+        statements = block.parse()[:prelude_length]
+        lines = tuple(
+            block.lines[statement.line_num].strip()
+            for statement in statements
+            if isinstance(statement, CommandStatement)
+        )
+        return (
+            lines, tuple(assembler.include_lookup_dirs()),
+            assembler.prelude_variant()
+        )
+
+    def find(self, key: PreludeKey) -> typ.Optional[PreludeSnapshot]:
+        snapshot = self.snapshots.get(key)
+        if snapshot is not None and snapshot.is_current():
+            return snapshot
+        return None
+
+    def store(self, key: PreludeKey, snapshot: PreludeSnapshot) -> None:
+        self.snapshots[key] = snapshot
+
+
+prelude_cache = PreludeCache()
+
+
+class CodeValue(Value):
+    def __init__(self, block: SourceBlock, context: 'Context'):
+        self.block = block
+        self.context = context
+
+    def __deepcopy__(self, memo: typ.Dict[int, typ.Any]) -> 'CodeValue':
+        new_value = CodeValue(self.block, copy.deepcopy(self.context, memo))
+        memo[id(self)] = new_value
+        return new_value
+
 
 class InstructionMacro:
     def __init__(
@@ -195,10 +445,20 @@ class InstructionMacro:
         self.context = code_block.context
         self.is_internal = is_internal
 
+    def __deepcopy__(
+        self, memo: typ.Dict[int, typ.Any]
+    ) -> 'InstructionMacro':
+        macro = InstructionMacro(
+            self.name, copy.deepcopy(self.code_block, memo), self.arg_names,
+            self.is_internal
+        )
+        memo[id(self)] = macro
+        return macro
+
     def execute(
         self, args: typ.List['Value'],
         assembler: 'Assembler', executing_context: 'Context',
-        traceback: 'ProgramTraceback'
+        traceback: int
     ) -> None:
         if len(self.arg_names) != len(args):
             raise ParseError(
@@ -211,45 +471,115 @@ class InstructionMacro:
 
         new_context.last_global_label = executing_context.last_global_label
 
-        parser = Parser(
-            assembler, self.code_block.lines, self.code_block.line_mapping,
-            self.code_block.origin, traceback, self.is_internal
+        interpreter = Interpreter(
+            assembler, self.code_block.block, traceback, self.is_internal
         )
-        parser.parse_program(new_context)
+        interpreter.run(new_context)
+
+
+# where a context last found a name, and how many times the name had been
+# defined then
+FoundOwners = typ.Dict[str, typ.Tuple[int, typ.Optional['Context']]]
 
 
 class Context:
+    # Names are found by walking up the parents. Where that's a long way
+    # the context remembers which one had the name, until the name is next
+    # defined anywhere (which only happens often for macro arguments, which
+    # are found close by).
+    REMEMBER_DEPTH = 2
+
     def __init__(self, parent: typ.Optional['Context']):
         self.parent = parent
         self.instruction_macros: typ.Dict[str, InstructionMacro] = {}
         self.variables: typ.Dict[str, Value] = {}
+        self.macro_owners: typ.Optional[FoundOwners] = None
+        self.variable_owners: typ.Optional[FoundOwners] = None
 
+        # how many times each name has been defined, shared by every context
+        # under the same root
+        self.definitions: typ.Dict[str, int]
         if self.parent is not None:
             self.last_global_label: str = self.parent.last_global_label
+            self.definitions = self.parent.definitions
         else:
             self.last_global_label = '_global_start'
+            self.definitions = {}
+
+    def __deepcopy__(self, memo: typ.Dict[int, typ.Any]) -> 'Context':
+        # written out rather than left to copy.deepcopy, which is several
+        # times slower for the number of contexts and macros in a prelude
+        context = Context.__new__(Context)
+        memo[id(self)] = context
+
+        context.parent = copy.deepcopy(self.parent, memo)
+        context.instruction_macros = {
+            name: copy.deepcopy(macro, memo)
+            for name, macro in self.instruction_macros.items()
+        }
+        context.variables = {
+            name: copy.deepcopy(value, memo)
+            for name, value in self.variables.items()
+        }
+        context.last_global_label = self.last_global_label
+        # the same dict for every copied context
+        context.definitions = copy.deepcopy(self.definitions, memo)
+        context.macro_owners = None
+        context.variable_owners = None
+        return context
+
+    def find_owner(
+        self, name: str, is_macro: bool
+    ) -> typ.Optional['Context']:
+        # the nearest context, this one or a parent, defining name
+        owners = self.macro_owners if is_macro else self.variable_owners
+        definitions = self.definitions.get(name, 0)
+        if owners is not None and name in owners:
+            owner_definitions, owner = owners[name]
+            if owner_definitions == definitions:
+                return owner
+
+        context: typ.Optional[Context] = self
+        depth = 0
+        while context is not None and name not in (
+            context.instruction_macros if is_macro else context.variables
+        ):
+            context = context.parent
+            depth += 1
+
+        if depth >= Context.REMEMBER_DEPTH:
+            if owners is None:
+                owners = {}
+                if is_macro:
+                    self.macro_owners = owners
+                else:
+                    self.variable_owners = owners
+            owners[name] = (definitions, context)
+        return context
 
     def find_instruction_macro(
         self, name: str
     ) -> typ.Optional[InstructionMacro]:
-        if name in self.instruction_macros:
-            return self.instruction_macros[name]
-        if self.parent is not None:
-            return self.parent.find_instruction_macro(name)
-        return None
+        owner = self.find_owner(name, True)
+        if owner is None:
+            return None
+        return owner.instruction_macros[name]
 
     def find_variable_value(self, name: str) -> typ.Optional[Value]:
-        if name in self.variables:
-            return self.variables[name]
-        if self.parent is not None:
-            return self.parent.find_variable_value(name)
-        return None
+        owner = self.find_owner(name, False)
+        if owner is None:
+            return None
+        return owner.variables[name]
+
+    def count_definition(self, name: str) -> None:
+        self.definitions[name] = self.definitions.get(name, 0) + 1
 
     def define_variable(self, var_name: str, var_value: Value) -> None:
         if var_name in self.variables:
             raise ParseError(f"Redefinition of variable `{var_name}`")
 
         self.variables[var_name] = var_value
+        self.count_definition(var_name)
 
     def define_instruction(self, macro: InstructionMacro) -> None:
         name = macro.name
@@ -257,28 +587,31 @@ class Context:
             raise ParseError(f"Redefinition of command `{name}`")
 
         self.instruction_macros[name] = macro
+        self.count_definition(name)
 
     def set_variable(self, var_name: str, var_value: Value) -> None:
-        if var_name in self.variables:
-            self.variables[var_name] = var_value
-        else:
-            if self.parent is not None:
-                self.parent.set_variable(var_name, var_value)
-            else:
-                raise ParseError(f"Can't set {var_name} variable")
+        owner = self.find_owner(var_name, False)
+        if owner is None:
+            raise ParseError(f"Can't set {var_name} variable")
+        owner.variables[var_name] = var_value
 
 
 class ProgramTraceback:
     def __init__(
-        self, previous: typ.Optional['ProgramTraceback'], lines: typ.List[str],
-        program_line: str, line_origin: str, is_internal: bool,
+        self, previous: typ.Optional['ProgramTraceback'], origin: str,
+        line_number: int, line: str, is_internal: bool,
         last_global_label: str
     ) -> None:
         self.previous = previous
-        self.lines = lines
+        self.origin = origin
+        self.line_number = line_number
+        self.line = line
 
-        self.program_line = program_line
-        self.line_origin = line_origin
+        self.program_line = f"    {line}"
+        self.line_origin = f'{os.path.basename(origin)}:{line_number}'
+        self.lines = [
+            f'At "{origin}" on line {line_number}:', self.program_line
+        ]
         self.is_internal = is_internal
         self.last_global_label = last_global_label
 
@@ -307,16 +640,238 @@ class ProgramTraceback:
             return self
 
 
-class Assembler:
+class TracebackSite:
+    # Where a command is. Made once when its line is parsed, and compared by
+    # identity, so that parsed statements can be shared between assemblies
+    # without refering to any one table.
+    __slots__ = ('origin', 'line_number', 'line')
+
+    def __init__(self, origin: str, line_number: int, line: str) -> None:
+        self.origin = origin
+        self.line_number = line_number
+        self.line = line
+
+
+# site, previous entry, whether it's internal and the last global label
+TracebackEntry = typ.Tuple[
+    TracebackSite, typ.Optional[int], bool, str
+]
+
+
+class TracebackTable:
+    # Every traceback made while assembling, interned and referred to by
+    # number. Their text is only put together, as a ProgramTraceback, for
+    # the ones that are asked for (by an error, a listing or the debugger).
+    # Each assembly has its own.
+    def __init__(self) -> None:
+        self.entries: typ.List[TracebackEntry] = []
+        self.entry_numbers: typ.Dict[TracebackEntry, int] = {}
+        self.tracebacks: typ.Dict[int, ProgramTraceback] = {}
+        # for tracebacks from elsewhere (library modules), see intern
+        self.sites: typ.Dict[typ.Tuple[str, int, str], TracebackSite] = {}
+        self.interned: typ.Dict[ProgramTraceback, int] = {}
+
+    def copy(self) -> 'TracebackTable':
+        # numbers stay the same, so the copy can carry on from here
+        table = TracebackTable()
+        table.entries = self.entries.copy()
+        table.entry_numbers = self.entry_numbers.copy()
+        table.tracebacks = self.tracebacks.copy()
+        table.sites = self.sites.copy()
+        table.interned = self.interned.copy()
+        return table
+
+    def entry(
+        self, site: TracebackSite, previous: typ.Optional[int],
+        is_internal: bool, last_global_label: str
+    ) -> int:
+        entry = (site, previous, is_internal, last_global_label)
+        number = self.entry_numbers.get(entry)
+        if number is None:
+            number = self.add_entry(entry)
+        return number
+
+    def add_entry(self, entry: TracebackEntry) -> int:
+        number = len(self.entries)
+        self.entry_numbers[entry] = number
+        self.entries.append(entry)
+        return number
+
+    def intern(self, traceback: ProgramTraceback) -> int:
+        # the number of a traceback made by another table
+        number = self.interned.get(traceback)
+        if number is None:
+            key = (traceback.origin, traceback.line_number, traceback.line)
+            site = self.sites.get(key)
+            if site is None:
+                site = self.sites[key] = TracebackSite(*key)
+
+            number = self.entry(
+                site,
+                self.intern(traceback.previous)
+                if traceback.previous is not None else None,
+                traceback.is_internal, traceback.last_global_label
+            )
+            self.interned[traceback] = number
+        return number
+
+    def is_internal(self, number: int) -> bool:
+        return self.entries[number][2]
+
+    def traceback(self, number: int) -> ProgramTraceback:
+        traceback = self.tracebacks.get(number)
+        if traceback is None:
+            site, previous, is_internal, last_global_label = (
+                self.entries[number]
+            )
+            traceback = ProgramTraceback(
+                self.traceback(previous) if previous is not None else None,
+                site.origin, site.line_number, site.line, is_internal,
+                last_global_label
+            )
+            self.tracebacks[number] = traceback
+        return traceback
+
+    def trigger_error(self, number: int, msg: str) -> typ.NoReturn:
+        self.traceback(number).trigger_error(msg)
+
+
+class ProfileStats:
+    def __init__(self) -> None:
+        self.count = 0
+        self.inclusive_time = 0.0
+        self.exclusive_time = 0.0
+        self.words = 0
+
+
+# kind (macro, include, loop, times or section) and name
+ProfileKey = typ.Tuple[str, str]
+
+
+class Profiler:
+    # How often each macro, include, LOOP, TIMES and emitted section ran,
+    # the time spent in it (all of it, and just what wasn't in anything
+    # else measured inside it) and the words it wrote. Something that runs
+    # inside itself, like a recursive macro, only has its outermost run
+    # counted in its total time and words.
     def __init__(self) -> None:
-        self.written_flags: typ.List[typ.Optional[bool]] = [None] * (2 ** 18)
+        self.stats: typ.Dict[ProfileKey, ProfileStats] = {}
+        # key, start time, time spent in what it ran, words written before
+        self.running: typ.List[typ.Tuple[ProfileKey, float, float, int]] = []
+        self.depths: typ.Dict[ProfileKey, int] = {}
+
+    @staticmethod
+    def command_key(
+        command_name: str, arguments: typ.List[Value], traceback: int,
+        is_native: bool, asm: 'Assembler'
+    ) -> typ.Optional[ProfileKey]:
+        if not is_native:
+            return 'macro', command_name
+        if command_name == 'INCLUDE' or command_name == 'EMIT_SECTION':
+            if arguments and isinstance(arguments[0], IdentifierValue):
+                kind = 'include' if command_name == 'INCLUDE' else 'section'
+                return kind, arguments[0].contents
+        elif command_name == 'LOOP' or command_name == 'TIMES':
+            # told apart by where they are
+            site, _, _, _ = asm.traceback_table.entries[traceback]
+            file_name = os.path.basename(site.origin)
+            return command_name.lower(), f'{file_name}:{site.line_number}'
+        return None
+
+    def start(self, key: ProfileKey, asm: 'Assembler') -> None:
+        self.depths[key] = self.depths.get(key, 0) + 1
+        self.running.append((key, time.perf_counter(), 0.0, asm.words_written))
+
+    def stop(self, asm: 'Assembler') -> None:
+        key, start_time, inner_time, start_words = self.running.pop()
+        elapsed = time.perf_counter() - start_time
+        self.depths[key] -= 1
+
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = self.stats[key] = ProfileStats()
+        stats.count += 1
+        stats.exclusive_time += elapsed - inner_time
+        if self.depths[key] == 0:
+            stats.inclusive_time += elapsed
+            stats.words += asm.words_written - start_words
+
+        if self.running:
+            outer_key, outer_start, outer_inner, outer_words = (
+                self.running[-1]
+            )
+            self.running[-1] = (
+                outer_key, outer_start, outer_inner + elapsed, outer_words
+            )
+
+    def sorted_stats(self) -> typ.List[typ.Tuple[ProfileKey, ProfileStats]]:
+        # what most needs looking at first
+        return sorted(
+            self.stats.items(),
+            key=lambda item: (-item[1].exclusive_time, item[0])
+        )
+
+    def print_table(self) -> None:
+        print(
+            f"{'kind':8} | {'name':30} | {'count':>7} | {'total s':>8} | "
+            f"{'self s':>8} | {'words':>6}"
+        )
+        for (kind, name), stats in self.sorted_stats():
+            print(
+                f'{kind:8} | {name:30} | {stats.count:7} | '
+                f'{stats.inclusive_time:8.4f} | {stats.exclusive_time:8.4f} | '
+                f'{stats.words:6}'
+            )
+
+
+class Assembler:
+    # Sections of functions, which are only kept if something uses them.
+    # A function starts at a label that isn't local or made up, and goes up
+    # to the next one.
+    COLLECTED_SECTIONS = ('functions',)
+    # the first word of an unconditional JUMP (see lib/instructions.xasm),
+    # which a function has to end with for what follows to be unused
+    JUMP_OPCODE = 0b001100
+
+    def __init__(
+        self, libraries: typ.Optional['linker.LibraryStore'] = None
+    ) -> None:
+        # one byte per address, set once it's been written
+        self.written_flags = bytearray(2 ** 18)
         self.data_values: typ.List[
-            typ.Tuple[int, NumericValue, ProgramTraceback]
+            typ.Tuple[int, NumericValue, int]
         ] = []
         self.label_values: typ.Dict[str, int] = {}
         self.ip = 0
         self.primary_filename: typ.Optional[str] = None
         self.current_uid = 0
+        # resolved paths of every file included so far
+        self.included_files: typ.List[str] = []
+        # and of those being included right now, innermost last
+        self.include_stack: typ.List[str] = []
+
+        # what each SECTION has been given, in order: code to run, or the
+        # prebuilt part of a library module when linking against libraries
+        self.sections: typ.Dict[
+            str, typ.List[typ.Union[CodeValue, 'linker.SectionChunk']]
+        ] = {}
+        self.libraries = libraries
+        # where each collected section was emitted, and whether to drop the
+        # functions in them that nothing uses
+        self.collected_ranges: typ.List[typ.Tuple[int, int]] = []
+        self.collect_functions = True
+
+        self.words_written = 0
+        self.profiler: typ.Optional[Profiler] = None
+        self.traceback_table = TracebackTable()
+
+    def enable_profiling(self) -> Profiler:
+        # must be before assembling; the profiler's stats fill in as it goes
+        self.profiler = Profiler()
+        return self.profiler
+
+    def prelude_variant(self) -> typ.Tuple[str, ...]:
+        return ('linked',) if self.libraries is not None else ('source',)
 
     def assemble_file(self, file_name: str) -> None:
         assert self.primary_filename is None
@@ -327,15 +882,25 @@ class Assembler:
         self.assemble_source(source, os.path.abspath(file_name))
 
     def assemble_source(self, source: str, source_origin: str) -> None:
-        sanitised = source.replace('\r', '')
-        lines = sanitised.split('\n')
-
-        line_mapping = [
-            line_index + 1 for line_index in range(len(lines))
-        ]
-        parser = Parser(self, lines, line_mapping, source_origin, None, False)
+        block = SourceBlock.from_source(source, source_origin)
+        interpreter = Interpreter(self, block, None, False)
+        context = Context(None)
+
+        # a profile is of everything being run, even if it's been run before
+        prelude_length = 0
+        if self.profiler is None:
+            prelude_length = prelude_cache.prelude_length(block)
+        if prelude_length:
+            key = prelude_cache.key(block, prelude_length, self)
+            snapshot = prelude_cache.find(key)
+
+            if snapshot is not None:
+                context = snapshot.restore(self)
+            else:
+                interpreter.run(context, 0, prelude_length)
+                prelude_cache.store(key, PreludeSnapshot(self, context))
 
-        parser.parse_program(Context(None))
+        interpreter.run(context, prelude_length)
 
     def declare_label(
         self, label: str, location: typ.Optional[int] = None
@@ -345,50 +910,190 @@ class Assembler:
         self.label_values[label] = self.ip if location is None else location
 
     def run_data_command(
-        self, arguments: typ.List[Value], traceback: ProgramTraceback
+        self, arguments: typ.List[Value], traceback: int
     ) -> None:
         for arg in arguments:
             if not isinstance(arg, NumericValue):
                 raise ParseError(f'DATA expects numeric arg, not {type(arg)}')
 
-            num_words = arg.num_words
-
             start_ip = self.ip
-
-            for word_num in range(num_words):
-                if self.written_flags[self.ip]:
-                    raise ParseError('DATA rewrite')
-                else:
-                    self.written_flags[self.ip] = True
-                    self.ip += 1
-                    assert self.ip < 2**16
+            self.write_words(start_ip, arg.num_words)
+            self.ip = start_ip + arg.num_words
 
             arg.place_value(start_ip, self)
             self.data_values.append((start_ip, arg, traceback))
 
-    def link_data(self) -> 'compiled.CompiledProgram':
-        WordListType = typ.List[typ.Optional[compiled.CompiledWord]]
-        data: WordListType = [None] * (2 ** 18)
+    def write_words(self, start_ip: int, num_words: int) -> None:
+        end = start_ip + num_words
+        # checked first, as assigning past the end would grow the flags
+        if num_words != 0 and end >= 2**16:
+            raise ParseError(f'DATA past the end of memory (up to {end})')
+        if self.written_flags.find(1, start_ip, end) != -1:
+            raise ParseError('DATA rewrite')
+        self.written_flags[start_ip:end] = b'\x01' * num_words
+        self.words_written += num_words
+
+    def current_address(self) -> NumericValue:
+        return ConstantNumericValue(self.ip, 3)
+
+    def unique_identifier(self, prefix: str) -> str:
+        self.current_uid += 1
+        return f'uid_{prefix}_{self.current_uid}'
 
+    def link_data(self) -> 'compiled.CompiledProgram':
+        resolved = []
         for value_start, numeric_value, traceback in self.data_values:
             try:
                 word_array = numeric_value.as_word_array(self)
             except ValueNotReadyException as err:
-                if err.traceback:
-                    err.traceback.trigger_error(err.msg)
+                if err.traceback is not None:
+                    self.traceback_table.trigger_error(
+                        err.traceback, err.msg
+                    )
                 else:
-                    traceback.trigger_error(err.msg)
+                    self.traceback_table.trigger_error(traceback, err.msg)
 
-            for word_num, word in enumerate(word_array):
-                assert data[word_num + value_start] is None
-                data[word_num + value_start] = compiled.CompiledWord(
-                    word, traceback, True, True, True
+            if word_array:
+                assert max(word_array) < 64
+                resolved.append(
+                    (value_start, numeric_value, word_array, traceback)
                 )
 
+        unused = (
+            self.unused_functions(resolved) if self.collect_functions else []
+        )
+        placed = [
+            (value_start, word_array, traceback)
+            for value_start, _, word_array, traceback in resolved
+            if not self.is_in_ranges(value_start, unused)
+        ]
+        labels = {
+            label: address for label, address in self.label_values.items()
+            if not self.is_in_ranges(address, unused)
+        }
+
+        # sections are written away from where they're declared, so values
+        # aren't in order of address
+        placed.sort(key=lambda value: value[0])
+
+        permissions = bytes([
+            compiled.FOR_EXECUTION | compiled.FOR_READING |
+            compiled.FOR_WRITING
+        ])
+        segments = []
+        values = bytearray()
+        traceback_numbers = array.array('I')
+        start = end = 0
+        for value_start, word_array, traceback in placed:
+            assert value_start >= end
+            if value_start != end and values:
+                segments.append(compiled.Segment(
+                    start, values, permissions * len(values),
+                    traceback_numbers
+                ))
+                values = bytearray()
+                traceback_numbers = array.array('I')
+            if not values:
+                start = value_start
+
+            values.extend(word_array)
+            traceback_numbers.extend([traceback] * len(word_array))
+            end = value_start + len(word_array)
+
+        if values:
+            segments.append(compiled.Segment(
+                start, values, permissions * len(values), traceback_numbers
+            ))
+
         return compiled.CompiledProgram(
-            data, self.label_values
+            segments, labels, self.traceback_table.traceback
         )
 
+    @staticmethod
+    def is_in_ranges(
+        address: int, ranges: typ.List[typ.Tuple[int, int]]
+    ) -> bool:
+        return any(start <= address < end for start, end in ranges)
+
+    def unused_functions(
+        self, resolved: typ.List[
+            typ.Tuple[int, NumericValue, typ.List[int], int]
+        ]
+    ) -> typ.List[typ.Tuple[int, int]]:
+        # where the functions in collected sections are that nothing else
+        # in the program can get to, directly or through other functions
+        functions = []
+        for range_start, range_end in self.collected_ranges:
+            function_starts = sorted({
+                address for label, address in self.label_values.items()
+                if range_start <= address < range_end and '.' not in label
+                and not label.startswith('uid_')
+            })
+            functions.extend(zip(
+                function_starts, function_starts[1:] + [range_end]
+            ))
+        if not functions:
+            return []
+
+        functions.sort()
+        starts = [start for start, _ in functions]
+
+        def owner(address: int) -> typ.Optional[int]:
+            index = bisect.bisect_right(starts, address) - 1
+            if index >= 0 and address < functions[index][1]:
+                return index
+            return None
+
+        label_owners = {}
+        for label, address in self.label_values.items():
+            function = owner(address)
+            if function is not None:
+                label_owners[label] = function
+
+        # the functions each one uses, and those the rest of the program do
+        uses: typ.List[typ.Set[int]] = [set() for _ in functions]
+        used: typ.Set[int] = set()
+        last_values: typ.Dict[int, typ.Tuple[int, typ.List[int]]] = {}
+        for value_start, value, word_array, _ in resolved:
+            labels = value.referenced_labels()
+            if labels is None:
+                # which could be any of them
+                return []
+
+            function = owner(value_start)
+            users = used if function is None else uses[function]
+            for label in labels:
+                if label in label_owners:
+                    users.add(label_owners[label])
+
+            if function is not None:
+                last_value = last_values.get(function)
+                if last_value is None or value_start > last_value[0]:
+                    last_values[function] = (value_start, word_array)
+
+        # a function that doesn't end by jumping away runs into the next
+        for function in range(len(functions) - 1):
+            if functions[function][1] != starts[function + 1]:
+                continue
+            last_value = last_values.get(function)
+            if last_value is None or len(last_value[1]) != 4 or (
+                last_value[1][0] != self.JUMP_OPCODE
+            ):
+                uses[function].add(function + 1)
+
+        reachable = set()
+        pending = list(used)
+        while pending:
+            function = pending.pop()
+            if function not in reachable:
+                reachable.add(function)
+                pending.extend(uses[function])
+
+        return [
+            function_range for function, function_range in enumerate(functions)
+            if function not in reachable
+        ]
+
     def run_define_command(
         self, args: typ.List[Value], ctx: Context
     ) -> None:
@@ -402,6 +1107,9 @@ class Assembler:
                 raise ParseError("Need instruction name")
 
             macro_name = args[1].contents
+            if macro_name.upper() in native_commands:
+                # it would never be run, as natives are looked up first
+                raise ParseError(f"Command {macro_name} is built in")
             macro_arg_name_identifiers = args[2:-1]
             arg_names = []
 
@@ -479,15 +1187,7 @@ class Assembler:
         else:
             raise ParseError(f'Unknown set command {set_type}')
 
-    def run_include_command(
-        self, args: typ.List[Value], ctx: Context,
-        traceback: ProgramTraceback
-    ) -> None:
-        if len(args) != 1 or not isinstance(args[0], IdentifierValue):
-            raise ParseError("Need identifier as first arg to include")
-
-        filename = args[0].contents + '.xasm'
-
+    def include_lookup_dirs(self) -> typ.List[str]:
         def normalise(directory: str) -> str:
             return os.path.dirname(os.path.realpath(directory))
 
@@ -497,31 +1197,40 @@ class Assembler:
         lookup_dirs.append(normalise(__file__))
         lookup_dirs.append(os.path.join(normalise(__file__), 'lib'))
         lookup_dirs.append(normalise(os.curdir))
+        return lookup_dirs
 
-        for lookup_dir in lookup_dirs:
+    def find_include(self, name: str) -> typ.Optional[str]:
+        filename = name + '.xasm'
+        for lookup_dir in self.include_lookup_dirs():
             potential_path = os.path.join(lookup_dir, filename)
             if os.path.exists(potential_path):
-                file_path = potential_path
-                break
-        else:
-            raise ParseError(f"Can't find include {filename}")
+                return potential_path
+        return None
 
-        with open(file_path) as file:
-            source = file.read()
+    def run_include_command(
+        self, args: typ.List[Value], ctx: Context,
+        traceback: int
+    ) -> None:
+        if len(args) != 1 or not isinstance(args[0], IdentifierValue):
+            raise ParseError("Need identifier as first arg to include")
 
-        sanitised = source.replace('\r', '')
-        lines = sanitised.split('\n')
+        file_path = self.find_include(args[0].contents)
+        if file_path is None:
+            raise ParseError(f"Can't find include {args[0].contents}.xasm")
 
-        line_mapping = [
-            line_index + 1 for line_index in range(len(lines))
-        ]
-        parser = Parser(self, lines, line_mapping, file_path, traceback)
+        block = include_cache.load(file_path)
+        self.included_files.append(block.origin)
+        interpreter = Interpreter(self, block, traceback)
 
-        parser.parse_program(ctx)
+        self.include_stack.append(block.origin)
+        try:
+            interpreter.run(ctx)
+        finally:
+            self.include_stack.pop()
 
     def run_loop_command(
         self, args: typ.List[Value], parent_ctx: Context,
-        traceback: ProgramTraceback
+        traceback: int
     ) -> None:
         if len(args) != 3:
             raise ParseError('Need three args for loop')
@@ -548,11 +1257,10 @@ class Assembler:
             context.set_variable(
                 condition_var_name, IdentifierValue('NOT_SET')
             )
-            condition_parser = Parser(
-                self, condition_code.lines, condition_code.line_mapping,
-                condition_code.origin, traceback
+            condition_interpreter = Interpreter(
+                self, condition_code.block, traceback
             )
-            condition_parser.parse_program(context)
+            condition_interpreter.run(context)
 
             condition_value = context.find_variable_value(condition_var_name)
             if condition_value is None:
@@ -581,15 +1289,12 @@ class Assembler:
             if should_break:
                 break
 
-            body_parser = Parser(
-                self, body_code.lines, body_code.line_mapping,
-                body_code.origin, traceback
-            )
-            body_parser.parse_program(context)
+            body_interpreter = Interpreter(self, body_code.block, traceback)
+            body_interpreter.run(context)
 
     def run_if_command(
         self, args: typ.List[Value], parent_ctx: Context,
-        traceback: ProgramTraceback
+        traceback: int
     ) -> None:
         if len(args) != 2:
             # TODO: else
@@ -613,15 +1318,12 @@ class Assembler:
 
         context = Context(body.context)
 
-        body_parser = Parser(
-            self, body.lines, body.line_mapping,
-            body.origin, traceback
-        )
-        body_parser.parse_program(context)
+        body_interpreter = Interpreter(self, body.block, traceback)
+        body_interpreter.run(context)
 
     def run_up_command(
         self, args: typ.List[Value], command_ctx: Context,
-        traceback: ProgramTraceback
+        traceback: int
     ) -> None:
         if len(args) != 1:
             # TODO: else
@@ -635,11 +1337,8 @@ class Assembler:
         if context is None:
             raise ParseError('UP in top level context')
 
-        body_parser = Parser(
-            self, body.lines, body.line_mapping,
-            body.origin, traceback
-        )
-        body_parser.parse_program(context)
+        body_interpreter = Interpreter(self, body.block, traceback)
+        body_interpreter.run(context)
 
     def run_assert_command(self, args: typ.List[Value]) -> None:
         if len(args) != 1:
@@ -671,576 +1370,1159 @@ class Assembler:
         self.ip += as_int
         assert self.ip < 2 ** 18
 
-    def process_command(
-        self, command_name: str,
-        arguments: typ.List[Value],
-        context: Context, traceback: ProgramTraceback
+    def run_allocate_zeros_command(
+        self, args: typ.List[Value], traceback: int
     ) -> None:
-        command_name = command_name.upper()
+        # the same as DATA of that many zero words, which is recorded as a
+        # single value and marked as written all at once
+        if len(args) != 1:
+            raise ParseError('Expected 1 arg to ALLOCATE_ZEROS')
 
-        if command_name == 'DATA':
-            self.run_data_command(arguments, traceback)
-        elif command_name == 'SKIP_DATA':
-            self.run_skip_command(arguments)
-        elif command_name == 'DEFINE':
-            self.run_define_command(arguments, context)
-        elif command_name == 'SET':
-            self.run_set_command(arguments, context)
-        elif command_name == 'ASSERT':
-            self.run_assert_command(arguments)
-        elif command_name == 'INCLUDE':
-            self.run_include_command(arguments, context, traceback)
-        elif command_name == 'LOOP':
-            self.run_loop_command(arguments, context, traceback)
-        elif command_name == 'IF':
-            self.run_if_command(arguments, context, traceback)
-        elif command_name == 'UP':
-            self.run_up_command(arguments, context, traceback)
-        elif command_name == 'SET_GLOBAL_LABEL':
-            if len(arguments) != 1:
-                raise ParseError('Expected global label')
-            if not isinstance(arguments[0], IdentifierValue):
-                raise ParseError(f'Expected ident, not {type(arguments[0])}')
-
-            context.last_global_label = arguments[0].contents
-        elif command_name == 'DEBUG_OUT':
-            print('DEBUG OUT', arguments)
-        elif macro_command := context.find_instruction_macro(command_name):
-            macro_command.execute(arguments, self, context, traceback)
-        else:
-            raise ParseError(f'Unknown command {command_name}')
+        if not isinstance(args[0], NumericValue):
+            raise ParseError('Expected numeric argument to ALLOCATE_ZEROS')
 
+        try:
+            size = args[0].as_integer(self)
+        except ValueNotReadyException:
+            raise ParseError('Value to ALLOCATE_ZEROS not ready')
 
-class Parser:
-    IDENTIFIER_REGEX = r'[a-zA-Z_][a-zA-Z_0-9]*'
-    VARIABLE_USEAGE_REGEX = r'\$([a-zA-Z_][a-zA-Z_0-9]*)'
-    NUMERIC_REGEX = r'(0b[01]+)|(0x[a-fA-F0-9]+)|([1-9][0-9]*)|0'
-    MAIN_LABEL_REGEX = r'(\.|:)([a-zA-Z_][a-zA-Z_0-9.]*)'
-    DECLARE_INLINE_LABEL_REGEX = r'%(\.|:)([a-zA-Z_][a-zA-Z_0-9.]*)'
+        if size == 0:
+            raise ParseError("Can't ALLOCATE_ZEROS of nothing")
 
-    def __init__(
-        self, assembler: Assembler, virtual_lines: typ.List[str],
-        virtual_line_mapping: typ.List[int], original_file_name: str,
-        parent_traceback: typ.Optional[ProgramTraceback],
-        is_internal: typ.Optional[bool] = None
-    ) -> None:
-        self.lines = [
-            line + '\n' for line in virtual_lines
-        ]
-        self.line_num = 0
-        self.last_command_line_num = 0
-        self.column_num = 0
-        self.assembler = assembler
+        self.run_data_command([ConstantNumericValue(0, size)], traceback)
 
-        self.line_mapping = virtual_line_mapping
-        self.source_origin = original_file_name
-        self.parent_traceback = parent_traceback
+    def section_owner(self, code: CodeValue) -> typ.Optional[str]:
+        # the file whose own top level gave SECTION this code, rather than
+        # a macro from it run from somewhere else
+        if self.include_stack and self.include_stack[-1] == code.block.origin:
+            return code.block.origin
+        return None
 
-        if is_internal is not None:
-            self.is_internal = is_internal
-        else:
-            assert self.parent_traceback is not None
-            self.is_internal = self.parent_traceback.is_internal
+    def run_section_command(self, args: typ.List[Value]) -> None:
+        if len(args) != 2 or not isinstance(args[0], IdentifierValue):
+            raise ParseError('Need section name and code for SECTION')
+        code = args[1]
+        if not isinstance(code, CodeValue):
+            raise ParseError('Need code block for SECTION')
+
+        pieces = self.sections.setdefault(args[0].contents, [])
+
+        owner = self.section_owner(code)
+        if owner is not None and self.libraries is not None:
+            module = self.libraries.find(owner)
+            if module is not None:
+                chunk = module.sections.get(args[0].contents)
+                if chunk is not None:
+                    # all of the module's code for the section was built
+                    # together, and goes where its first part would have
+                    if chunk not in pieces:
+                        pieces.append(chunk)
+                    return
+
+        pieces.append(code)
+
+    def emit_section(
+        self, name: str, last_global_label: str,
+        traceback: typ.Optional[int]
+    ) -> None:
+        start_ip = self.ip
+        for piece in self.sections.get(name, []):
+            if isinstance(piece, CodeValue):
+                context = Context(piece.context)
+                context.last_global_label = last_global_label
+                Interpreter(self, piece.block, traceback, False).run(context)
+            else:
+                piece.place(self)
 
-    def advance(self, length: int, skip_whitespace: bool = True) -> None:
-        self.column_num += length
-        assert self.column_num <= len(self.lines[self.line_num])
+        if name in self.COLLECTED_SECTIONS:
+            self.collected_ranges.append((start_ip, self.ip))
 
-        if self.column_num == len(self.lines[self.line_num]):
-            self.column_num = 0
-            self.line_num += 1
+    def run_emit_section_command(
+        self, args: typ.List[Value], ctx: Context,
+        traceback: int
+    ) -> None:
+        if len(args) != 1 or not isinstance(args[0], IdentifierValue):
+            raise ParseError('Need section name for EMIT_SECTION')
 
-        if skip_whitespace and self.line_num < len(self.lines):
-            while self.column_num < len(self.lines[self.line_num]):
-                char = self.lines[self.line_num][self.column_num]
-                if char in ('\t', ' '):  # don't skip newline
-                    self.column_num += 1
-                else:
-                    break
+        self.emit_section(args[0].contents, ctx.last_global_label, traceback)
 
-    def rest_of_line(self) -> str:
-        return self.lines[self.line_num][self.column_num:]
+    def run_align_to_command(self, args: typ.List[Value]) -> None:
+        if len(args) != 1:
+            raise ParseError('Expected 1 arg to ALIGN_TO')
 
-    def accept(
-        self, regex: str, skip_whitespace: bool = True
-    ) -> typ.Optional[re.Match[str]]:
-        match = re.match(regex, self.rest_of_line())  # TODO: use pos arg
+        if not isinstance(args[0], NumericValue):
+            raise ParseError('Expected numeric argument to ALIGN_TO')
 
-        if match is not None:
-            assert match.span(0)[0] == 0
-            self.advance(match.span(0)[1], skip_whitespace)
+        try:
+            alignment = args[0].as_integer(self)
+        except ValueNotReadyException:
+            raise ParseError('Value to ALIGN_TO not ready')
 
-        return match
+        if alignment <= 1 or alignment & (alignment - 1) != 0:
+            raise ParseError(
+                f'Can only ALIGN_TO a power of two, not {alignment}'
+            )
 
-    def expect(
-        self, regex: str,
-        skip_whitespace: bool = True
-    ) -> re.Match[str]:
-        match = self.accept(regex, skip_whitespace)
-        if match is not None:
-            return match
-        else:
-            raise ParseError(f'Expected `{regex}`')
+        self.ip = -(-self.ip // alignment) * alignment
+        assert self.ip < 2 ** 18
 
-    def get_numeric_values_from_args(
-        self, num: int, args: typ.List[Value]
-    ) -> typ.Tuple[int, typ.List[int]]:
-        if len(args) != num:
-            raise ParseError(f'Expected {num} arguments, got {len(args)}')
+    def run_code_value(
+        self, code: CodeValue, last_global_label: str, traceback: int
+    ) -> None:
+        # the same way as a macro with the code as its body
+        context = Context(code.context)
+        context.last_global_label = last_global_label
+        Interpreter(self, code.block, traceback, False).run(context)
 
-        ints = []
-        largest_word_size = 0
-        for arg in args:
-            if not isinstance(arg, NumericValue):
-                if arg.backtrace:
-                    arg.backtrace.trigger_error('Expected numeric value')
-                else:
-                    raise ParseError('Expected numeric value')
+    def run_execute_command(
+        self, args: typ.List[Value], ctx: Context, traceback: int
+    ) -> None:
+        if len(args) != 1 or not isinstance(args[0], CodeValue):
+            raise ParseError('Need code block to EXECUTE')
 
-            try:
-                largest_word_size = max(
-                    largest_word_size, arg.num_words
-                )
-                integer_value = arg.as_integer(self.assembler)
-            except ValueNotReadyException:
-                if arg.backtrace:
-                    arg.backtrace.trigger_error('Value not ready')
-                else:
-                    raise ParseError('Value not ready')
+        self.run_code_value(args[0], ctx.last_global_label, traceback)
 
-            ints.append(integer_value)
+    def run_times_command(
+        self, args: typ.List[Value], ctx: Context, traceback: int
+    ) -> None:
+        if len(args) != 2:
+            raise ParseError('Need count and code block for TIMES')
 
-        return largest_word_size, ints
+        total, code = args
+        if not isinstance(total, NumericValue):
+            raise ParseError('Expected numeric count for TIMES')
+        if not isinstance(code, CodeValue):
+            raise ParseError('Need code block for TIMES')
 
-    def parse_function_call(self, name: str, context: Context) -> Value:
-        args = []
-        while True:
-            arg = self.parse_arg(context)
-            arg.backtrace = self.current_traceback(context)
-            args.append(arg)
+        try:
+            count = total.as_integer(self)
+        except ValueNotReadyException:
+            raise ParseError('Count for TIMES not ready')
 
-            if self.accept(r'\)'):
-                break
-            else:
-                self.expect(',')
+        for _ in range(count):
+            self.run_code_value(code, ctx.last_global_label, traceback)
 
-        # TODO: handle errors with function execution better
-        if name == 'make':
-            if len(args) == 0:
-                raise ParseError("Need size argument")
-
-            num_words_arg, *rest = args
-            if not isinstance(num_words_arg, ConstantNumericValue):
-                raise ParseError("Size argument must be a number constant")
-            num_words = num_words_arg.value
-
-            constitutents = []
-            for value in rest:
-                if not isinstance(value, NumericValue):
-                    raise ParseError(f"Need numeric value, not {type(value)}")
-                constitutents.append(value)
-
-            result = MakeResultValue(constitutents)
-
-            if result.num_words != num_words:
-                raise ParseError(
-                    f"Needed {num_words} words, got {result.num_words}"
-                )
+    def run_set_global_label_command(
+        self, args: typ.List[Value], ctx: Context
+    ) -> None:
+        if len(args) != 1:
+            raise ParseError('Expected global label')
+        if not isinstance(args[0], IdentifierValue):
+            raise ParseError(f'Expected ident, not {type(args[0])}')
 
-            return result
-        elif name == 'is_lt':
-            num_words, values = self.get_numeric_values_from_args(2, args)
-            a, b = values
-
-            return ConstantNumericValue(1 if a < b else 0, 1)
-        elif name == 'is_pow_of_two':
-            num_words, values = self.get_numeric_values_from_args(1, args)
-            a, = values
-            is_pow_of_2 = a > 1 and a & (a - 1) == 0
-
-            return ConstantNumericValue(1 if is_pow_of_2 else 0, 1)
-        elif name == 'is_eq':
-            if len(args) != 2:
-                raise ParseError('Expected two args')
-
-            if isinstance(args[0], NumericValue):
-                num_words, values = self.get_numeric_values_from_args(2, args)
-                a, b = values
-                # ignore num_words
-                return ConstantNumericValue(1 if a == b else 0, 1)
-            elif isinstance(args[0], IdentifierValue):
-                if not isinstance(args[1], IdentifierValue):
-                    raise ParseError('Second arg not idenfitier in is_eq')
-
-                return ConstantNumericValue(
-                    1 if args[0].contents == args[1].contents else 0, 1
-                )
+        ctx.last_global_label = args[0].contents
+
+    def process_command(
+        self, command_name: str,
+        arguments: typ.List[Value],
+        context: Context, traceback: int
+    ) -> None:
+        command_name = command_name.upper()
+        native_command = native_commands.get(command_name)
+
+        profiler = self.profiler
+        profile_key = None
+        if profiler is not None:
+            profile_key = profiler.command_key(
+                command_name, arguments, traceback,
+                native_command is not None, self
+            )
+            if profile_key is not None:
+                profiler.start(profile_key, self)
+
+        try:
+            if native_command is not None:
+                native_command(self, arguments, context, traceback)
+            elif macro_command := context.find_instruction_macro(
+                command_name
+            ):
+                macro_command.execute(arguments, self, context, traceback)
             else:
-                raise ParseError(f"Canm't check is_eq for {type(args[0])}")
-        elif name == 'not':
-            num_words, values = self.get_numeric_values_from_args(1, args)
-            a, = values
-
-            return ConstantNumericValue(1 if a == 0 else 0, 1)
-        elif name == 'plus':
-            num_words, values = self.get_numeric_values_from_args(2, args)
-            a, b = values
-            # overflow will be catched in word array conversion
-            return ConstantNumericValue(a + b, num_words)
-        elif name == 'minus':
-            num_words, values = self.get_numeric_values_from_args(2, args)
-            a, b = values
-
-            if b > a:
-                raise ParseError('Minus giving negative value')
-
-            return ConstantNumericValue(a - b, num_words)
-        elif name == 'zero_extend_numeric':
-            num_words, values = self.get_numeric_values_from_args(2, args)
-            a, b = values
-
-            return ConstantNumericValue(a, b)
-        elif name == 'concat_ident':
-            if len(args) < 2:
-                raise ParseError('Need at least two identifiers to concat')
+                raise ParseError(f'Unknown command {command_name}')
+        finally:
+            if profiler is not None and profile_key is not None:
+                profiler.stop(self)
+
+
+# Commands and functions written in Python rather than as macros, by name.
+# Plugins can add more with native_command and native_function. Macros
+# can't be given the name of a native command.
+NativeCommand = typ.Callable[[Assembler, typ.List[Value], Context, int], None]
+NativeFunction = typ.Callable[
+    ['Interpreter', typ.List[Value], Context], Value
+]
+
+# the assembler's own commands call its methods, so that subclasses can
+# change them
+native_commands: typ.Dict[str, NativeCommand] = {
+    'DATA': lambda asm, args, ctx, tb: asm.run_data_command(args, tb),
+    'SKIP_DATA': lambda asm, args, ctx, tb: asm.run_skip_command(args),
+    'ALLOCATE_ZEROS':
+        lambda asm, args, ctx, tb: asm.run_allocate_zeros_command(args, tb),
+    'ALIGN_TO': lambda asm, args, ctx, tb: asm.run_align_to_command(args),
+    'DEFINE': lambda asm, args, ctx, tb: asm.run_define_command(args, ctx),
+    'SET': lambda asm, args, ctx, tb: asm.run_set_command(args, ctx),
+    'ASSERT': lambda asm, args, ctx, tb: asm.run_assert_command(args),
+    'INCLUDE':
+        lambda asm, args, ctx, tb: asm.run_include_command(args, ctx, tb),
+    'LOOP': lambda asm, args, ctx, tb: asm.run_loop_command(args, ctx, tb),
+    'IF': lambda asm, args, ctx, tb: asm.run_if_command(args, ctx, tb),
+    'UP': lambda asm, args, ctx, tb: asm.run_up_command(args, ctx, tb),
+    'EXECUTE':
+        lambda asm, args, ctx, tb: asm.run_execute_command(args, ctx, tb),
+    'TIMES': lambda asm, args, ctx, tb: asm.run_times_command(args, ctx, tb),
+    'SECTION': lambda asm, args, ctx, tb: asm.run_section_command(args),
+    'EMIT_SECTION':
+        lambda asm, args, ctx, tb: asm.run_emit_section_command(
+            args, ctx, tb
+        ),
+    'SET_GLOBAL_LABEL':
+        lambda asm, args, ctx, tb: asm.run_set_global_label_command(
+            args, ctx
+        ),
+    'DEBUG_OUT': lambda asm, args, ctx, tb: print('DEBUG OUT', args),
+}
+native_functions: typ.Dict[str, NativeFunction] = {}
+
+
+def native_command(
+    name: str
+) -> typ.Callable[[NativeCommand], NativeCommand]:
+    # a decorator, for a function taking the Assembler, the command's
+    # arguments, the Context it's run in and its traceback
+    def register(command: NativeCommand) -> NativeCommand:
+        native_commands[name.upper()] = command
+        return command
+    return register
+
+
+def native_function(
+    name: str
+) -> typ.Callable[[NativeFunction], NativeFunction]:
+    # a decorator, for a function taking the Interpreter, the arguments and
+    # the Context it's called in, and returning the result
+    def register(function: NativeFunction) -> NativeFunction:
+        native_functions[name] = function
+        return function
+    return register
+
+
+class Expression(abc.ABC):
+    # Where the parser was when it finished parsing the expression, which is
+    # where errors evaluating it get reported
+    line_num = 0
+    column_num = 0
 
-            segments = []
-            for arg in args:
-                if not isinstance(arg, IdentifierValue):
-                    raise ParseError(
-                        f'Need identifier to concat, not {type(arg)}'
-                    )
-                segments.append(arg.contents)
+    @abc.abstractmethod
+    def evaluate(
+        self, interpreter: 'Interpreter', context: Context,
+        traceback: int
+    ) -> Value:
+        pass
 
-            return IdentifierValue(''.join(segments))
-        elif name == 'read_var':
-            if len(args) != 1 or not isinstance(args[0], IdentifierValue):
-                raise ParseError('Expected ident for read_var')
 
-            var_value = context.find_variable_value(args[0].contents)
-            if var_value is None:
-                raise ParseError(f"Can't find var {args[0].contents}")
+class IdentifierExpression(Expression):
+    def __init__(self, contents: str):
+        self.contents = contents
 
-            return var_value
-        elif name == 'hi':
-            if len(args) != 1:
-                raise ParseError('Need 1 arg for hi')
-            if not isinstance(args[0], NumericValue):
-                raise ParseError('Expected numeric value for hi command')
-
-            num_words = args[0].num_words
-            if num_words <= 1:
-                raise ParseError('need 1 or more words for hi()')
-            desired_word_num = 0
-
-            return ExtractedValue(args[0], desired_word_num)
-        elif name == 'hi_mid':
-            if len(args) != 1:
-                raise ParseError('Need 1 arg for hi_mid')
-            if not isinstance(args[0], NumericValue):
-                raise ParseError('Expected numeric value for hi_mid command')
-
-            num_words = args[0].num_words
-            if num_words < 2:
-                raise ParseError('need 2 or more words for hi_mid()')
-
-            return MakeResultValue([
-                ExtractedValue(args[0], 0),
-                ExtractedValue(args[0], 1)
-            ])
-        elif name == 'mid':
-            if len(args) != 1:
-                raise ParseError('Need 1 arg for mid')
-            if not isinstance(args[0], NumericValue):
-                raise ParseError('Expected numeric value for mid command')
-
-            num_words = args[0].num_words
-            if num_words < 2:
-                raise ParseError('need 2 or more words for mid()')
-
-            return MakeResultValue([
-                ExtractedValue(args[0], 1)
-            ])
-        elif name == 'low':
-            if len(args) != 1:
-                raise ParseError('Need 1 arg for low')
-            if not isinstance(args[0], NumericValue):
-                raise ParseError('Expected numeric value for low command')
-
-            num_words = args[0].num_words
-            if num_words < 3:
-                raise ParseError('need 3 or more words for low()')
-
-            return MakeResultValue([
-                ExtractedValue(args[0], 2)
-            ])
-        elif name == 'mod':
-            num_words, values = self.get_numeric_values_from_args(2, args)
-            a, b = values
-            if b == 0:
-                raise ParseError('mod by 0')
-
-            return ConstantNumericValue(a % b, num_words)
-        elif name == 'unique_identifier':
-            if len(args) != 1 or not isinstance(args[0], IdentifierValue):
-                raise ParseError('Expected prefix identifier')
-
-            self.assembler.current_uid += 1
-            return IdentifierValue(
-                f'uid_{args[0].contents}_{self.assembler.current_uid}'
+    def evaluate(
+        self, interpreter: 'Interpreter', context: Context,
+        traceback: int
+    ) -> Value:
+        return IdentifierValue(self.contents)
+
+
+class NumberExpression(Expression):
+    def __init__(self, value: int, num_words: int):
+        self.value = value
+        self.num_words = num_words
+
+    def evaluate(
+        self, interpreter: 'Interpreter', context: Context,
+        traceback: int
+    ) -> Value:
+        return ConstantNumericValue(self.value, self.num_words)
+
+
+class LabelExpression(Expression):
+    def __init__(self, is_local: bool, name: str):
+        self.is_local = is_local
+        self.name = name
+
+    def evaluate(
+        self, interpreter: 'Interpreter', context: Context,
+        traceback: int
+    ) -> Value:
+        if self.is_local:
+            if context.last_global_label == '':
+                raise ParseError('Local without previous global label')
+            label = f'{context.last_global_label}.{self.name}'
+        else:
+            label = self.name
+
+        return LabelValue(label)
+
+
+class InlineLabelExpression(Expression):
+    def __init__(
+        self, is_local: bool, name: str,
+        initial: typ.Optional[Expression]
+    ):
+        self.is_local = is_local
+        self.name = name
+        self.initial = initial
+
+    def evaluate(
+        self, interpreter: 'Interpreter', context: Context,
+        traceback: int
+    ) -> Value:
+        if self.is_local:
+            if context.last_global_label == '':
+                raise ParseError('Local without previous global label')
+            label = f'{context.last_global_label}.{self.name}'
+        else:
+            context.last_global_label = self.name.split('.', 2)[0]
+            label = self.name
+
+        if not self.is_local:
+            # seems weird to declare a global inline label
+            raise ParseError("No global inline labels")
+
+        initial_value: NumericValue = ConstantNumericValue(0, 1)
+
+        if self.initial is not None:
+            parsed_value = interpreter.evaluate(
+                self.initial, context, traceback
             )
-        elif name == 'global_label':
-            if len(args) < 1:
-                raise ParseError('Need at least one arg')
+            if not isinstance(parsed_value, NumericValue):
+                raise ParseError("Expected numeric value for initial val")
+            initial_value = parsed_value
 
-            segments = []
-            for arg in args:
-                if not isinstance(arg, IdentifierValue):
-                    raise ParseError('Need identifier')
-                segments.append(arg.contents)
+        return InlineLabelDeclarationValue(label, initial_value)
 
-            return LabelValue('.'.join(segments))
+
+class CodeBlockExpression(Expression):
+    def __init__(self, block: 'SourceBlock'):
+        self.block = block
+
+    def evaluate(
+        self, interpreter: 'Interpreter', context: Context,
+        traceback: int
+    ) -> Value:
+        # the block is shared, so it's only parsed the first time it's run
+        return CodeValue(self.block, context)
+
+
+class VariableExpression(Expression):
+    def __init__(self, name: str):
+        self.name = name
+
+    def evaluate(
+        self, interpreter: 'Interpreter', context: Context,
+        traceback: int
+    ) -> Value:
+        var_value = context.find_variable_value(self.name)
+
+        if var_value is not None:
+            return var_value
         else:
-            raise ParseError(f"Unknown method {name}")
+            raise ParseError(f"Can't find variable {self.name}")
 
-    def current_traceback(self, context: Context) -> ProgramTraceback:
-        offending_line_contents = self.lines[self.last_command_line_num][:-1]
 
-        line_number = self.line_mapping[self.last_command_line_num]
+class CurrentAddressExpression(Expression):
+    def evaluate(
+        self, interpreter: 'Interpreter', context: Context,
+        traceback: int
+    ) -> Value:
+        return interpreter.assembler.current_address()
 
-        full_line_origin = (
-            f'At "{self.source_origin}" on line '
-            f'{line_number}:'
-        )
-        line_origin = f'{os.path.basename(self.source_origin)}:{line_number}'
 
-        program_line = f"    {offending_line_contents}"
-        is_internal = self.is_internal
+class FunctionCallExpression(Expression):
+    def __init__(self, name: str, args: typ.List[Expression]):
+        self.name = name
+        self.args = args
 
-        traceback = [full_line_origin, program_line]
+    def evaluate(
+        self, interpreter: 'Interpreter', context: Context,
+        traceback: int
+    ) -> Value:
+        args = []
+        for arg_expression in self.args:
+            arg = interpreter.evaluate(arg_expression, context, traceback)
+            arg.backtrace = traceback
+            args.append(arg)
 
-        return ProgramTraceback(
-            self.parent_traceback, traceback, program_line, line_origin,
-            is_internal, context.last_global_label
-        )
+        return interpreter.call_function(self.name, args, context)
 
-    def parse_arg(self, context: Context) -> Value:
-        if m := self.accept(self.IDENTIFIER_REGEX):
-            if self.accept(r'\('):
-                return self.parse_function_call(m.group(0), context)
-            else:
-                return IdentifierValue(m.group(0))
 
-        elif m := self.accept(self.NUMERIC_REGEX, False):
-            value = int(m.group(0), base=0)
-            word_size = 1
-            if m_word_size := self.accept(r'_([1-9]+)'):
-                word_size = int(m_word_size.group(1))
-            self.expect("")
-            return ConstantNumericValue(value, word_size)
+class Statement(abc.ABC):
+    @abc.abstractmethod
+    def run(self, interpreter: 'Interpreter', context: Context) -> None:
+        pass
 
-        elif m := self.accept(self.MAIN_LABEL_REGEX):
-            is_local = m.group(1) == '.'
-            name = m.group(2)
 
-            if is_local:
+class LabelStatement(Statement):
+    def __init__(
+        self, is_local: bool, name: str, line_num: int, column_num: int
+    ):
+        self.is_local = is_local
+        self.name = name
+        self.line_num = line_num
+        self.column_num = column_num
+
+    def run(self, interpreter: 'Interpreter', context: Context) -> None:
+        try:
+            if self.is_local:
                 if context.last_global_label == '':
                     raise ParseError('Local without previous global label')
-                label = f'{context.last_global_label}.{name}'
+                label = f'{context.last_global_label}.{self.name}'
             else:
-                label = name
+                context.last_global_label = self.name.split('.', 2)[0]
+                label = self.name
 
-            return LabelValue(label)
+            interpreter.assembler.declare_label(label)
+        except ParseError as parse_err:
+            interpreter.handle_parse_error(
+                parse_err, self.line_num, self.column_num
+            )
+            raise
 
-        elif m := self.accept(self.DECLARE_INLINE_LABEL_REGEX):
-            is_local = m.group(1) == '.'
-            name = m.group(2)
 
-            if is_local:
-                if context.last_global_label == '':
-                    raise ParseError('Local without previous global label')
-                label = f'{context.last_global_label}.{name}'
+class CommandStatement(Statement):
+    def __init__(
+        self, name: str, args: typ.List[Expression], line_num: int,
+        block: 'SourceBlock'
+    ):
+        self.name = name
+        self.args = args
+        self.line_num = line_num
+
+        self.site = TracebackSite(
+            block.origin, block.line_mapping[line_num], block.lines[line_num]
+        )
+
+    def run(self, interpreter: 'Interpreter', context: Context) -> None:
+        # TracebackTable.entry, inlined as it's run for every command
+        entry = (
+            self.site, interpreter.parent_traceback, interpreter.is_internal,
+            context.last_global_label
+        )
+        table = interpreter.assembler.traceback_table
+        traceback = table.entry_numbers.get(entry)
+        if traceback is None:
+            traceback = table.add_entry(entry)
+
+        arguments = [
+            interpreter.evaluate(arg, context, traceback)
+            for arg in self.args
+        ]
+
+        try:
+            interpreter.assembler.process_command(
+                self.name, arguments, context, traceback
+            )
+        except ParseError as parse_err:
+            interpreter.handle_parse_error(parse_err, self.line_num, None)
+            raise
+
+
+class SyntaxErrorStatement(Statement):
+    # Parsing stops at the first syntax error, which is then raised when
+    # running gets to it, after everything before it has been run
+    def __init__(self, msg: str, line_num: int, column_num: int):
+        self.msg = msg
+        self.line_num = line_num
+        self.column_num = column_num
+
+    def run(self, interpreter: 'Interpreter', context: Context) -> None:
+        parse_err = ParseError(self.msg)
+        interpreter.handle_parse_error(
+            parse_err, self.line_num, self.column_num
+        )
+        raise parse_err
+
+
+class Parser:
+    # Everything is matched in place with pattern.match(line, column_num),
+    # so no substrings of the line get made along the way
+    IDENTIFIER_REGEX = re.compile(r'[a-zA-Z_][a-zA-Z_0-9]*')
+    VARIABLE_USEAGE_REGEX = re.compile(r'\$([a-zA-Z_][a-zA-Z_0-9]*)')
+    NUMERIC_REGEX = re.compile(r'(0b[01]+)|(0x[a-fA-F0-9]+)|([1-9][0-9]*)|0')
+    WORD_SIZE_REGEX = re.compile(r'_([1-9]+)')
+    MAIN_LABEL_REGEX = re.compile(r'(\.|:)([a-zA-Z_][a-zA-Z_0-9.]*)')
+    DECLARE_INLINE_LABEL_REGEX = re.compile(
+        r'%(\.|:)([a-zA-Z_][a-zA-Z_0-9.]*)'
+    )
+    CODE_BLOCK_SEGMENT_REGEX = re.compile(r'[^\n{}]*')
+    COMMENT_REGEX = re.compile(r'[ \t]*[rR][eE][mM][^\n]*')
+    WHITESPACE_REGEX = re.compile(r'[ \t]*')  # doesn't include newline
+    EMPTY_REGEX = re.compile('')
+
+    OPEN_PAREN_REGEX = re.compile(r'\(')
+    CLOSE_PAREN_REGEX = re.compile(r'\)')
+    OPEN_BRACE_REGEX = re.compile('{')
+    CLOSE_BRACE_REGEX = re.compile('}')
+    COMMA_REGEX = re.compile(',')
+    EQUALS_REGEX = re.compile('=')
+    NEWLINE_REGEX = re.compile('\n')
+    IP_REGEX = re.compile(r'\$\$')
+
+    def __init__(self, block: 'SourceBlock') -> None:
+        self.block = block
+        self.lines = [
+            line + '\n' for line in block.lines
+        ]
+        self.line_num = 0
+        self.column_num = 0
+
+    def advance_to(self, column_num: int, skip_whitespace: bool) -> None:
+        line = self.lines[self.line_num]
+        assert column_num <= len(line)
+
+        if column_num == len(line):
+            column_num = 0
+            self.line_num += 1
+            if self.line_num == len(self.lines):
+                self.column_num = 0
+                return
+            line = self.lines[self.line_num]
+
+        if skip_whitespace:
+            column_num = self.WHITESPACE_REGEX.match(line, column_num).end()
+        self.column_num = column_num
+
+    def at_end_of_line(self) -> bool:
+        return self.lines[self.line_num][self.column_num] == '\n'
+
+    def accept(
+        self, regex: re.Pattern[str], skip_whitespace: bool = True
+    ) -> typ.Optional[re.Match[str]]:
+        match = regex.match(self.lines[self.line_num], self.column_num)
+
+        if match is not None:
+            self.advance_to(match.end(), skip_whitespace)
+
+        return match
+
+    def expect(
+        self, regex: re.Pattern[str],
+        skip_whitespace: bool = True
+    ) -> re.Match[str]:
+        match = self.accept(regex, skip_whitespace)
+        if match is not None:
+            return match
+        else:
+            raise ParseError(f'Expected `{regex.pattern}`')
+
+    def parse_function_call(self, name: str) -> Expression:
+        args = []
+        while True:
+            args.append(self.parse_arg())
+
+            if self.accept(self.CLOSE_PAREN_REGEX):
+                break
             else:
-                context.last_global_label = name.split('.', 2)[0]
-                label = name
+                self.expect(self.COMMA_REGEX)
 
-            if not is_local:
-                # seems weird to declare a global inline label
-                raise ParseError("No global inline labels")
+        return FunctionCallExpression(name, args)
 
-            initial_value: NumericValue = ConstantNumericValue(0, 1)
+    def parse_arg(self) -> Expression:
+        expression = self.parse_arg_contents()
+        expression.line_num = self.line_num
+        expression.column_num = self.column_num
+        return expression
 
-            if self.accept(r'='):
-                parsed_value = self.parse_arg(context)
-                if not isinstance(parsed_value, NumericValue):
-                    raise ParseError("Expected numeric value for initial val")
-                initial_value = parsed_value
+    def parse_arg_contents(self) -> Expression:
+        if m := self.accept(self.IDENTIFIER_REGEX):
+            if self.accept(self.OPEN_PAREN_REGEX):
+                return self.parse_function_call(m.group(0))
+            else:
+                return IdentifierExpression(m.group(0))
 
-            return InlineLabelDeclarationValue(label, initial_value)
+        elif m := self.accept(self.NUMERIC_REGEX, False):
+            value = int(m.group(0), base=0)
+            word_size = 1
+            if m_word_size := self.accept(self.WORD_SIZE_REGEX):
+                word_size = int(m_word_size.group(1))
+            self.expect(self.EMPTY_REGEX)
+            return NumberExpression(value, word_size)
+
+        elif m := self.accept(self.MAIN_LABEL_REGEX):
+            return LabelExpression(m.group(1) == '.', m.group(2))
+
+        elif m := self.accept(self.DECLARE_INLINE_LABEL_REGEX):
+            initial = None
+            if self.accept(self.EQUALS_REGEX):
+                initial = self.parse_arg()
+
+            return InlineLabelExpression(
+                m.group(1) == '.', m.group(2), initial
+            )
 
-        elif m := self.accept('{'):
-            self.accept('\n')
+        elif m := self.accept(self.OPEN_BRACE_REGEX):
+            self.accept(self.NEWLINE_REGEX)
             lines = []
             current_line_components: typ.List[str] = []
             depth = 0  # TODO: do this more sohpisticated wrt comments, etc.
             line_mapping: typ.List[int] = []
 
             while True:
-                line_segment = self.expect('[^\n{}]*').group(0)
+                line_segment = self.expect(
+                    self.CODE_BLOCK_SEGMENT_REGEX
+                ).group(0)
 
                 if len(current_line_components) == 0:
-                    line_mapping.append(self.line_mapping[self.line_num])
+                    line_mapping.append(self.block.line_mapping[self.line_num])
 
                 current_line_components.append(line_segment)
 
-                if m := self.accept('}'):
+                if m := self.accept(self.CLOSE_BRACE_REGEX):
                     if depth == 0:
                         break
                     else:
                         current_line_components.append('}')
                         depth -= 1
-                elif m := self.accept('{'):
+                elif m := self.accept(self.OPEN_BRACE_REGEX):
                     current_line_components.append('{')
                     depth += 1
-                elif self.accept('\n'):
+                elif self.accept(self.NEWLINE_REGEX):
                     if len(current_line_components) == 0:
-                        line_mapping.append(self.line_mapping[self.line_num])
+                        line_mapping.append(
+                            self.block.line_mapping[self.line_num]
+                        )
 
                     lines.append(''.join(current_line_components))
                     current_line_components = []
 
             if len(current_line_components) == 0:
-                line_mapping.append(self.line_mapping[self.line_num])
+                line_mapping.append(self.block.line_mapping[self.line_num])
             lines.append(''.join(current_line_components))
 
             current_line_components = []
 
-            return CodeValue(
-                lines, line_mapping, self.source_origin, context
+            return CodeBlockExpression(
+                SourceBlock(lines, line_mapping, self.block.origin)
             )
 
         elif m := self.accept(self.VARIABLE_USEAGE_REGEX):
-            variable_name = m.group(1)
-            var_value = context.find_variable_value(variable_name)
+            return VariableExpression(m.group(1))
 
-            if var_value is not None:
-                return var_value
-            else:
-                raise ParseError(f"Can't find variable {variable_name}")
-
-        elif m := self.accept(r'\$\$'):
-            return ConstantNumericValue(
-                self.assembler.ip, 3
-            )
+        elif m := self.accept(self.IP_REGEX):
+            return CurrentAddressExpression()
 
         else:
             raise ParseError("Expected argument")
 
-    def parse_command(self, ctx: Context) -> None:
-        self.advance(0)
+    def parse_command(self) -> Statement:
+        self.advance_to(self.column_num, True)
         command_starting_line = self.line_num
         command_name = self.expect(self.IDENTIFIER_REGEX).group(0)
-        self.last_command_line_num = command_starting_line
 
         arguments = []
 
-        while self.rest_of_line() != '\n':
-            arguments.append(self.parse_arg(ctx))
+        while not self.at_end_of_line():
+            arguments.append(self.parse_arg())
 
-            if self.rest_of_line() != '\n':
-                self.expect(',')
+            if not self.at_end_of_line():
+                self.expect(self.COMMA_REGEX)
 
-        try:
-            self.assembler.process_command(
-                command_name, arguments,
-                ctx, self.current_traceback(ctx)
-            )
-        except ParseError as parse_err:
-            self.handle_parse_error(parse_err, True)
-            raise
+        return CommandStatement(
+            command_name, arguments, command_starting_line, self.block
+        )
 
-    def accept_label_declaration(self, ctx: Context) -> bool:
+    def accept_label_declaration(self) -> typ.Optional[Statement]:
         match = self.accept(self.MAIN_LABEL_REGEX)
 
         if not match:
-            return False
+            return None
 
-        is_local = match.group(1) == '.'
-        name = match.group(2)
+        return LabelStatement(
+            match.group(1) == '.', match.group(2),
+            self.line_num, self.column_num
+        )
 
-        if is_local:
-            if ctx.last_global_label == '':
-                raise ParseError('Local without previous global label')
-            label = f'{ctx.last_global_label}.{name}'
+    def accept_comment(self) -> None:
+        self.accept(self.COMMENT_REGEX)
+
+    def parse_program(self) -> typ.List[Statement]:
+        statements: typ.List[Statement] = []
+        try:
+            while self.line_num < len(self.lines):
+                self.accept_comment()
+                if self.accept(self.NEWLINE_REGEX):
+                    continue
+
+                statement = self.accept_label_declaration()
+                if statement is None:
+                    statement = self.parse_command()
+                statements.append(statement)
+
+                self.accept_comment()
+                self.expect(self.NEWLINE_REGEX)
+        except ParseError as parse_err:
+            statements.append(SyntaxErrorStatement(
+                parse_err.msg, self.line_num, self.column_num
+            ))
+
+        return statements
+
+
+class Interpreter:
+    # Runs the (cached) statements of a block of source in a context
+    def __init__(
+        self, assembler: Assembler, block: 'SourceBlock',
+        parent_traceback: typ.Optional[int],
+        is_internal: typ.Optional[bool] = None
+    ) -> None:
+        self.assembler = assembler
+        self.block = block
+        self.parent_traceback = parent_traceback
+
+        if is_internal is not None:
+            self.is_internal = is_internal
         else:
-            ctx.last_global_label = name.split('.', 2)[0]
-            label = name
+            assert self.parent_traceback is not None
+            self.is_internal = assembler.traceback_table.is_internal(
+                self.parent_traceback
+            )
 
-        self.assembler.declare_label(label)
+    def run(
+        self, ctx: Context, start: int = 0, stop: typ.Optional[int] = None
+    ) -> None:
+        statements = self.block.parse()
+        if start != 0 or stop is not None:
+            statements = statements[start:stop]
 
-        return True
+        for statement in statements:
+            statement.run(self, ctx)
 
-    def accept_comment(self) -> None:
-        self.accept(r'[ \t]*[rR][eE][mM][^\n]*')
+    def evaluate(
+        self, expression: Expression, context: Context,
+        traceback: int
+    ) -> Value:
+        try:
+            return expression.evaluate(self, context, traceback)
+        except ParseError as parse_err:
+            self.handle_parse_error(
+                parse_err, expression.line_num, expression.column_num
+            )
+            raise
 
-    def handle_parse_error(self, error: ParseError, full_line: bool) -> None:
-        if self in error.registered_parsers:
-            return
+    def get_numeric_values_from_args(
+        self, num: int, args: typ.List[Value]
+    ) -> typ.Tuple[int, typ.List[int]]:
+        if len(args) != num:
+            raise ParseError(f'Expected {num} arguments, got {len(args)}')
+
+        ints = []
+        largest_word_size = 0
+        for arg in args:
+            if not isinstance(arg, NumericValue):
+                if arg.backtrace is not None:
+                    self.assembler.traceback_table.trigger_error(
+                        arg.backtrace, 'Expected numeric value'
+                    )
+                else:
+                    raise ParseError('Expected numeric value')
+
+            try:
+                largest_word_size = max(
+                    largest_word_size, arg.num_words
+                )
+                integer_value = arg.as_integer(self.assembler)
+            except ValueNotReadyException:
+                if arg.backtrace is not None:
+                    self.assembler.traceback_table.trigger_error(
+                        arg.backtrace, 'Value not ready'
+                    )
+                else:
+                    raise ParseError('Value not ready')
+
+            ints.append(integer_value)
+
+        return largest_word_size, ints
 
-        line_num = self.last_command_line_num if full_line else self.line_num
+    def call_function(
+        self, name: str, args: typ.List[Value], context: Context
+    ) -> Value:
+        # TODO: handle errors with function execution better
+        function = native_functions.get(name)
+        if function is None:
+            raise ParseError(f"Unknown method {name}")
+        result = function(self, args, context)
+
+        # a number worked out from labels still depends on them
+        if type(result) is ConstantNumericValue:
+            labels: typ.Optional[typ.List[str]] = []
+            for arg in args:
+                if not isinstance(arg, NumericValue):
+                    continue
+                arg_labels = arg.referenced_labels()
+                if arg_labels is None or labels is None:
+                    labels = None
+                else:
+                    labels.extend(arg_labels)
+            if labels != []:
+                result = DerivedValue(result.value, result.num_words, labels)
+        return result
+
+    def handle_parse_error(
+        self, error: ParseError, line_num: int,
+        column_num: typ.Optional[int]
+    ) -> None:
+        # column_num is None for errors to do with the whole line
+        if self in error.registered_interpreters:
+            return
 
-        offending_line_contents = self.lines[line_num][:-1]
+        offending_line_contents = self.block.lines[line_num]
         traceback = []
         traceback.append(
-            f'At "{self.source_origin}" on line '
-            f'{self.line_mapping[line_num]}:'
+            f'At "{self.block.origin}" on line '
+            f'{self.block.line_mapping[line_num]}:'
         )
         traceback.append(f"    {offending_line_contents}")
-        if full_line:
+        if column_num is None:
             traceback.append("    " + "^" * len(offending_line_contents))
         else:
-            traceback.append("    " + " " * self.column_num + "^")
+            traceback.append("    " + " " * column_num + "^")
 
         error.add_traceback(traceback, self)
 
-    def parse_program(self, ctx: Context) -> None:
-        try:
-            while self.line_num < len(self.lines):
-                self.accept_comment()
-                if self.accept(r'\n'):
-                    continue
 
-                if not self.accept_label_declaration(ctx):
-                    self.parse_command(ctx)
+@native_function('make')
+def make_function(
+    interpreter: Interpreter, args: typ.List[Value], context: Context
+) -> Value:
+    if len(args) == 0:
+        raise ParseError("Need size argument")
 
-                self.accept_comment()
-                self.expect(r'\n')
-        except ParseError as parse_err:
-            self.handle_parse_error(parse_err, False)
-            raise
+    num_words_arg, *rest = args
+    if not isinstance(num_words_arg, ConstantNumericValue):
+        raise ParseError("Size argument must be a number constant")
+    num_words = num_words_arg.value
 
+    constitutents = []
+    for value in rest:
+        if not isinstance(value, NumericValue):
+            raise ParseError(f"Need numeric value, not {type(value)}")
+        constitutents.append(value)
+
+    result = MakeResultValue(constitutents)
+
+    if result.num_words != num_words:
+        raise ParseError(
+            f"Needed {num_words} words, got {result.num_words}"
+        )
+
+    return fold_constant(result, constitutents, interpreter.assembler)
+
+
+@native_function('is_lt')
+def is_lt_function(
+    interpreter: Interpreter, args: typ.List[Value], context: Context
+) -> Value:
+    num_words, values = interpreter.get_numeric_values_from_args(2, args)
+    a, b = values
+
+    return ConstantNumericValue(1 if a < b else 0, 1)
+
+
+@native_function('is_pow_of_two')
+def is_pow_of_two_function(
+    interpreter: Interpreter, args: typ.List[Value], context: Context
+) -> Value:
+    num_words, values = interpreter.get_numeric_values_from_args(1, args)
+    a, = values
+    is_pow_of_2 = a > 1 and a & (a - 1) == 0
+
+    return ConstantNumericValue(1 if is_pow_of_2 else 0, 1)
+
+
+@native_function('is_eq')
+def is_eq_function(
+    interpreter: Interpreter, args: typ.List[Value], context: Context
+) -> Value:
+    if len(args) != 2:
+        raise ParseError('Expected two args')
+
+    if isinstance(args[0], NumericValue):
+        num_words, values = interpreter.get_numeric_values_from_args(2, args)
+        a, b = values
+        # ignore num_words
+        return ConstantNumericValue(1 if a == b else 0, 1)
+    elif isinstance(args[0], IdentifierValue):
+        if not isinstance(args[1], IdentifierValue):
+            raise ParseError('Second arg not idenfitier in is_eq')
+
+        return ConstantNumericValue(
+            1 if args[0].contents == args[1].contents else 0, 1
+        )
+    else:
+        raise ParseError(f"Canm't check is_eq for {type(args[0])}")
+
+
+@native_function('not')
+def not_function(
+    interpreter: Interpreter, args: typ.List[Value], context: Context
+) -> Value:
+    num_words, values = interpreter.get_numeric_values_from_args(1, args)
+    a, = values
+
+    return ConstantNumericValue(1 if a == 0 else 0, 1)
+
+
+@native_function('plus')
+def plus_function(
+    interpreter: Interpreter, args: typ.List[Value], context: Context
+) -> Value:
+    num_words, values = interpreter.get_numeric_values_from_args(2, args)
+    a, b = values
+    # overflow will be catched in word array conversion
+    return ConstantNumericValue(a + b, num_words)
 
-def main() -> None:
-    if len(sys.argv) != 2:
-        print("Need filename as argument")
-        sys.exit(1)
 
-    filename = sys.argv[1]
+@native_function('minus')
+def minus_function(
+    interpreter: Interpreter, args: typ.List[Value], context: Context
+) -> Value:
+    num_words, values = interpreter.get_numeric_values_from_args(2, args)
+    a, b = values
+
+    if b > a:
+        raise ParseError('Minus giving negative value')
+
+    return ConstantNumericValue(a - b, num_words)
+
+
+@native_function('zero_extend_numeric')
+def zero_extend_numeric_function(
+    interpreter: Interpreter, args: typ.List[Value], context: Context
+) -> Value:
+    num_words, values = interpreter.get_numeric_values_from_args(2, args)
+    a, b = values
+
+    return ConstantNumericValue(a, b)
+
+
+@native_function('concat_ident')
+def concat_ident_function(
+    interpreter: Interpreter, args: typ.List[Value], context: Context
+) -> Value:
+    if len(args) < 2:
+        raise ParseError('Need at least two identifiers to concat')
+
+    segments = []
+    for arg in args:
+        if not isinstance(arg, IdentifierValue):
+            raise ParseError(
+                f'Need identifier to concat, not {type(arg)}'
+            )
+        segments.append(arg.contents)
+
+    return IdentifierValue(''.join(segments))
+
+
+@native_function('read_var')
+def read_var_function(
+    interpreter: Interpreter, args: typ.List[Value], context: Context
+) -> Value:
+    if len(args) != 1 or not isinstance(args[0], IdentifierValue):
+        raise ParseError('Expected ident for read_var')
+
+    var_value = context.find_variable_value(args[0].contents)
+    if var_value is None:
+        raise ParseError(f"Can't find var {args[0].contents}")
+
+    return var_value
+
+
+@native_function('hi')
+def hi_function(
+    interpreter: Interpreter, args: typ.List[Value], context: Context
+) -> Value:
+    if len(args) != 1:
+        raise ParseError('Need 1 arg for hi')
+    if not isinstance(args[0], NumericValue):
+        raise ParseError('Expected numeric value for hi command')
+
+    num_words = args[0].num_words
+    if num_words <= 1:
+        raise ParseError('need 1 or more words for hi()')
+    desired_word_num = 0
+
+    return fold_constant(
+        ExtractedValue(args[0], desired_word_num), args,
+        interpreter.assembler
+    )
+
+
+@native_function('hi_mid')
+def hi_mid_function(
+    interpreter: Interpreter, args: typ.List[Value], context: Context
+) -> Value:
+    if len(args) != 1:
+        raise ParseError('Need 1 arg for hi_mid')
+    if not isinstance(args[0], NumericValue):
+        raise ParseError('Expected numeric value for hi_mid command')
+
+    num_words = args[0].num_words
+    if num_words < 2:
+        raise ParseError('need 2 or more words for hi_mid()')
+
+    return fold_constant(MakeResultValue([
+        ExtractedValue(args[0], 0),
+        ExtractedValue(args[0], 1)
+    ]), args, interpreter.assembler)
+
+
+@native_function('mid')
+def mid_function(
+    interpreter: Interpreter, args: typ.List[Value], context: Context
+) -> Value:
+    if len(args) != 1:
+        raise ParseError('Need 1 arg for mid')
+    if not isinstance(args[0], NumericValue):
+        raise ParseError('Expected numeric value for mid command')
+
+    num_words = args[0].num_words
+    if num_words < 2:
+        raise ParseError('need 2 or more words for mid()')
+
+    return fold_constant(MakeResultValue([
+        ExtractedValue(args[0], 1)
+    ]), args, interpreter.assembler)
+
+
+@native_function('low')
+def low_function(
+    interpreter: Interpreter, args: typ.List[Value], context: Context
+) -> Value:
+    if len(args) != 1:
+        raise ParseError('Need 1 arg for low')
+    if not isinstance(args[0], NumericValue):
+        raise ParseError('Expected numeric value for low command')
+
+    num_words = args[0].num_words
+    if num_words < 3:
+        raise ParseError('need 3 or more words for low()')
+
+    return fold_constant(MakeResultValue([
+        ExtractedValue(args[0], 2)
+    ]), args, interpreter.assembler)
+
+
+@native_function('mod')
+def mod_function(
+    interpreter: Interpreter, args: typ.List[Value], context: Context
+) -> Value:
+    num_words, values = interpreter.get_numeric_values_from_args(2, args)
+    a, b = values
+    if b == 0:
+        raise ParseError('mod by 0')
+
+    return ConstantNumericValue(a % b, num_words)
+
+
+@native_function('unique_identifier')
+def unique_identifier_function(
+    interpreter: Interpreter, args: typ.List[Value], context: Context
+) -> Value:
+    if len(args) != 1 or not isinstance(args[0], IdentifierValue):
+        raise ParseError('Expected prefix identifier')
+
+    return IdentifierValue(
+        interpreter.assembler.unique_identifier(args[0].contents)
+    )
+
+
+@native_function('global_label')
+def global_label_function(
+    interpreter: Interpreter, args: typ.List[Value], context: Context
+) -> Value:
+    if len(args) < 1:
+        raise ParseError('Need at least one arg')
+
+    segments = []
+    for arg in args:
+        if not isinstance(arg, IdentifierValue):
+            raise ParseError('Need identifier')
+        segments.append(arg.contents)
+
+    return LabelValue('.'.join(segments))
+
+
+def load_program(
+    file_name: str, use_cache: bool = False
+) -> 'compiled.CompiledProgram':
+    # object files are mapped as they are, anything else is assembled (or
+    # found in the build cache, for the command line tools that ask)
+    if object_file.is_object_file(file_name):
+        return object_file.load_program(file_name)
+
+    # imported here since it builds on this module
+    from . import build_cache
+
+    cache = build_cache.BuildCache() if use_cache else None
+    return build_cache.assemble_file(file_name, cache)
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(prog='python -m asm')
+    arg_parser.add_argument('filename', help='path to xasm source')
+    arg_parser.add_argument(
+        '-o', '--output', default=None,
+        help='write an object file here instead of printing a listing'
+    )
+    arg_parser.add_argument(
+        '--no-cache', action='store_true',
+        help="always assemble, and don't store the result in the build cache"
+    )
+    arg_parser.add_argument(
+        '--profile', action='store_true',
+        help='assemble everything from source, and print where the time '
+        'went instead of a listing'
+    )
+    arg_parser.add_argument(
+        '--keep-unused-functions', action='store_true',
+        help="assemble everything from source, and don't drop functions "
+        'nothing uses'
+    )
+    args = arg_parser.parse_args()
 
-    assembler = Assembler()
     try:
-        assembler.assemble_file(filename)
-        program = assembler.link_data()
+        if args.profile or args.keep_unused_functions:
+            asm = Assembler()
+            asm.collect_functions = not args.keep_unused_functions
+            if args.profile:
+                profiler = asm.enable_profiling()
+            start_time = time.perf_counter()
+            asm.assemble_file(args.filename)
+            program = asm.link_data()
+            total_time = time.perf_counter() - start_time
+        else:
+            program = load_program(args.filename, not args.no_cache)
+
+        if args.output is not None:
+            object_file.save_program(program, args.output)
+        if args.profile:
+            profiler.print_table()
+            print(f'total {total_time:.4f}s, {asm.words_written} words')
+        if args.output is not None or args.profile:
+            return
+
         print(f"  addr | data | {'file':^25} | line")
-        for i, word in enumerate(program.data):
-            if word is not None:
-                tb = word.traceback.get_deepst_non_internal()
-                print(
-                    f" {i:5} | {word.value:4} | "
-                    f"{tb.line_origin:^25} | {tb.program_line.strip()}"
-                )
+        for i, word in program.words():
+            tb = word.traceback.get_deepst_non_internal()
+            print(
+                f" {i:5} | {word.value:4} | "
+                f"{tb.line_origin:^25} | {tb.program_line.strip()}"
+            )
     except AssemblyError as err:
         err.print_info()
+        sys.exit(1)
+    except object_file.ObjectFileError as err:
+        print(f'Error: {err}')
+        sys.exit(1)
 
 
 if __name__ == '__main__':
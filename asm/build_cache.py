@@ -0,0 +1,205 @@
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import typing as typ
+
+from . import assembler, compiled, linker, object_file
+
+# Bump whenever the same source should assemble to something different
+ASSEMBLER_VERSION = 3
+
+
+def hash_file(file_name: str) -> typ.Optional[str]:
+    try:
+        with open(file_name, 'rb') as file:
+            return hashlib.sha256(file.read()).hexdigest()
+    except OSError:
+        return None
+
+
+def assembler_fingerprint() -> str:
+    # the version, along with the assembler's own code, so that editing the
+    # assembler doesn't leave stale programs in the cache
+    digest = hashlib.sha256(f'version {ASSEMBLER_VERSION}\n'.encode())
+    digest.update(f'object version {object_file.VERSION}\n'.encode())
+    package_dir = os.path.dirname(os.path.realpath(__file__))
+    for file_name in sorted(os.listdir(package_dir)):
+        if file_name.endswith('.py'):
+            file_hash = hash_file(os.path.join(package_dir, file_name))
+            digest.update(f'{file_name}\n{file_hash}\n'.encode())
+
+    # and the code of any plugins' native commands and functions
+    for file_path in plugin_files(package_dir):
+        digest.update(f'{file_path}\n{hash_file(file_path)}\n'.encode())
+    return digest.hexdigest()
+
+
+def plugin_files(package_dir: str) -> typ.List[str]:
+    natives: typ.List[typ.Callable[..., typ.Any]] = [
+        *assembler.native_commands.values(),
+        *assembler.native_functions.values()
+    ]
+    file_paths = set()
+    for native in natives:
+        module = sys.modules.get(native.__module__)
+        file_path = getattr(module, '__file__', None)
+        if file_path is None:
+            continue
+        file_path = os.path.realpath(file_path)
+        if os.path.dirname(file_path) != package_dir:
+            file_paths.add(file_path)
+    return sorted(file_paths)
+
+
+def default_directory() -> str:
+    return os.environ.get('XASM_CACHE_DIR') or os.path.join(
+        os.path.expanduser('~'), '.cache', 'xasm'
+    )
+
+
+class BuildCache:
+    # Built files (object files of programs, and library modules), found by
+    # the contents of the file they were built from. Which files it included
+    # is only known after building, so each has a manifest listing them with
+    # their hashes, and the built file is named by a hash of all of them
+    # together. Kinds of built file are told apart by their extension.
+    def __init__(self, directory: typ.Optional[str] = None):
+        self.directory = directory or default_directory()
+        self.fingerprint = assembler_fingerprint()
+
+    def primary_key(self, kind: str, file_name: str) -> typ.Optional[str]:
+        source_hash = hash_file(file_name)
+        if source_hash is None:
+            return None
+
+        # tracebacks include the path of the primary file, and includes are
+        # looked up relative to it, so the same source elsewhere is different
+        digest = hashlib.sha256(self.fingerprint.encode())
+        digest.update(f'{kind}\n'.encode())
+        digest.update(os.path.abspath(file_name).encode())
+        digest.update(source_hash.encode())
+        return digest.hexdigest()
+
+    def manifest_path(self, primary_key: str) -> str:
+        return os.path.join(self.directory, 'manifests', primary_key + '.json')
+
+    def built_path(self, kind: str, build_key: str) -> str:
+        return os.path.join(self.directory, 'objects', f'{build_key}.{kind}')
+
+    @staticmethod
+    def build_key(
+        primary_key: str, included: typ.List[typ.Tuple[str, str]]
+    ) -> str:
+        digest = hashlib.sha256(primary_key.encode())
+        for file_path, file_hash in included:
+            digest.update(f'{file_path}\n{file_hash}\n'.encode())
+        return digest.hexdigest()
+
+    def find(self, kind: str, file_name: str) -> typ.Optional[str]:
+        # the path of what was built from file_name, if it's still current
+        primary_key = self.primary_key(kind, file_name)
+        if primary_key is None:
+            return None
+
+        try:
+            with open(self.manifest_path(primary_key)) as manifest_file:
+                manifest = json.load(manifest_file)
+        except (OSError, ValueError):
+            return None
+
+        # every include has to still resolve to the same file with the same
+        # contents
+        lookup = assembler.Assembler()
+        lookup.primary_filename = os.path.abspath(file_name)
+        included = []
+        for name, file_path, file_hash in manifest['included']:
+            found_path = lookup.find_include(name)
+            if found_path is None or os.path.realpath(found_path) != file_path:
+                return None
+            if hash_file(file_path) != file_hash:
+                return None
+            included.append((file_path, file_hash))
+
+        build_key = self.build_key(primary_key, included)
+        if build_key != manifest['build']:
+            return None
+        return self.built_path(kind, build_key)
+
+    def store(
+        self, kind: str, file_name: str, included_files: typ.List[str],
+        write: typ.Callable[[str], None]
+    ) -> None:
+        primary_key = self.primary_key(kind, file_name)
+        if primary_key is None:
+            return
+
+        manifest_entries = []
+        included = []
+        for file_path in dict.fromkeys(included_files):
+            file_hash = hash_file(file_path)
+            if file_hash is None:
+                return
+            name = os.path.splitext(os.path.basename(file_path))[0]
+            manifest_entries.append((name, file_path, file_hash))
+            included.append((file_path, file_hash))
+
+        build_key = self.build_key(primary_key, included)
+        manifest = {'build': build_key, 'included': manifest_entries}
+
+        try:
+            self.write_atomically(self.built_path(kind, build_key), write)
+            self.write_atomically(
+                self.manifest_path(primary_key),
+                lambda path: self.write_json(path, manifest)
+            )
+        except OSError:
+            # the cache is only an optimisation
+            pass
+
+    @staticmethod
+    def write_json(path: str, contents: typ.Any) -> None:
+        with open(path, 'w') as file:
+            json.dump(contents, file)
+
+    @staticmethod
+    def write_atomically(
+        path: str, write: typ.Callable[[str], None]
+    ) -> None:
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        handle, temporary_path = tempfile.mkstemp(dir=directory)
+        os.close(handle)
+        try:
+            write(temporary_path)
+            os.replace(temporary_path, path)
+        except BaseException:
+            os.unlink(temporary_path)
+            raise
+
+
+def assemble_file(
+    file_name: str, cache: typ.Optional[BuildCache]
+) -> compiled.CompiledProgram:
+    # with a cache, library modules are built once and linked
+    if cache is None:
+        asm = assembler.Assembler()
+    else:
+        built_path = cache.find('xobj', file_name)
+        if built_path is not None:
+            try:
+                return object_file.load_program(built_path)
+            except (OSError, object_file.ObjectFileError):
+                pass
+        asm = assembler.Assembler(linker.LibraryStore(cache))
+
+    asm.assemble_file(file_name)
+    program = asm.link_data()
+
+    if cache is not None:
+        cache.store(
+            'xobj', file_name, asm.included_files,
+            lambda path: object_file.save_program(program, path)
+        )
+    return program
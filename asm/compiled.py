@@ -1,28 +1,93 @@
+import bisect
 import typing as typ
 
 from . import assembler
 
+FOR_EXECUTION = 1
+FOR_READING = 2
+FOR_WRITING = 4
+
+# for bytes.translate, from permission flags to a 0 or 1 per word
+READABLE_TABLE = bytes(
+    1 if flags & FOR_READING else 0 for flags in range(256)
+)
+WRITABLE_TABLE = bytes(
+    1 if flags & FOR_WRITING else 0 for flags in range(256)
+)
+EXECUTABLE_TABLE = bytes(
+    1 if flags & FOR_EXECUTION and flags & FOR_READING else 0
+    for flags in range(256)
+)
+
 
 class CompiledWord:
+    # The traceback is only found from its number when it's first used, as
+    # most words never need one. There's one of these for every word of a
+    # program, so they're kept small.
+    __slots__ = (
+        'value', 'find_traceback', 'traceback_number', 'for_execution',
+        'for_reading', 'for_writing'
+    )
+
     def __init__(
-        self, value: int, traceback: 'assembler.ProgramTraceback',
-        for_execution: bool, for_reading: bool, for_writing: bool
+        self, value: int,
+        find_traceback: typ.Callable[[int], 'assembler.ProgramTraceback'],
+        traceback_number: int, for_execution: bool, for_reading: bool,
+        for_writing: bool
     ):
         assert 0 <= value < 64
         self.value = value
-        self.traceback = traceback
+        self.find_traceback = find_traceback
+        self.traceback_number = traceback_number
 
         self.for_execution = for_execution
         self.for_reading = for_reading
         self.for_writing = for_writing
 
+    @property
+    def traceback(self) -> 'assembler.ProgramTraceback':
+        return self.find_traceback(self.traceback_number)
+
+
+class Segment:
+    # A run of populated words: their values and permission flags one per
+    # byte, and the traceback number of each
+    def __init__(
+        self, start: int, values: typ.Sequence[int],
+        permissions: typ.Sequence[int], traceback_numbers: typ.Sequence[int]
+    ):
+        self.start = start
+        self.end = start + len(values)
+        self.values = values
+        self.permissions = permissions
+        self.traceback_numbers = traceback_numbers
+
+
+class ProgramWords:
+    # Random access to a program's words by address, with None for the
+    # unpopulated ones. The words are made as they're looked at.
+    def __init__(self, program: 'CompiledProgram'):
+        self.program = program
+
+    def __len__(self) -> int:
+        return 2 ** 18
+
+    def __getitem__(self, address: int) -> typ.Optional[CompiledWord]:
+        if not 0 <= address < 2 ** 18:
+            raise IndexError('address out of range')
+        return self.program.word(address)
+
 
 class CompiledProgram:
     def __init__(
-        self, data: typ.List[typ.Optional[CompiledWord]],
-        labels: typ.Dict[str, int]
+        self, segments: typ.List[Segment], labels: typ.Dict[str, int],
+        find_traceback: typ.Callable[[int], 'assembler.ProgramTraceback']
     ):
-        self.data = data
+        # in order of address
+        self.segments = segments
+        self.segment_starts = [segment.start for segment in segments]
+        self.find_traceback = find_traceback
+        self.data = ProgramWords(self)
         self.labels = labels
 
         self.address_to_labels: typ.Dict[int, typ.List[str]] = {}
@@ -30,3 +95,75 @@ class CompiledProgram:
             if address not in self.address_to_labels:
                 self.address_to_labels[address] = []
             self.address_to_labels[address].append(label)
+
+        # For symbolize: one label per address, sorted by address. Where
+        # several labels share an address the last declared wins, as that's
+        # the one in scope for what follows. Labels made by unique_identifier
+        # (like CALL return points) are skipped, since they'd otherwise split
+        # up whichever function uses them.
+        symbols: typ.Dict[int, str] = {}
+        for label, address in self.labels.items():
+            if not label.startswith('uid_'):
+                symbols[address] = label
+
+        self.symbol_addresses = sorted(symbols)
+        self.symbol_labels = [
+            symbols[address] for address in self.symbol_addresses
+        ]
+
+    def symbolize(self, address: int) -> typ.Optional[typ.Tuple[str, int]]:
+        # the nearest label at or before address, and the offset from it
+        index = bisect.bisect_right(self.symbol_addresses, address) - 1
+        if index < 0:
+            return None
+        return (
+            self.symbol_labels[index],
+            address - self.symbol_addresses[index]
+        )
+
+    def symbol_text(self, address: int) -> str:
+        symbol = self.symbolize(address)
+        if symbol is None:
+            return '?'
+        label, offset = symbol
+        return f'{label}+{offset}' if offset else label
+
+    def word(self, address: int) -> typ.Optional[CompiledWord]:
+        index = bisect.bisect_right(self.segment_starts, address) - 1
+        if index < 0:
+            return None
+
+        segment = self.segments[index]
+        if address >= segment.end:
+            return None
+
+        offset = address - segment.start
+        permissions = segment.permissions[offset]
+        return CompiledWord(
+            segment.values[offset], self.find_traceback,
+            segment.traceback_numbers[offset],
+            bool(permissions & FOR_EXECUTION),
+            bool(permissions & FOR_READING),
+            bool(permissions & FOR_WRITING)
+        )
+
+    def words(self) -> typ.Iterator[typ.Tuple[int, CompiledWord]]:
+        # every populated word with its address, in order
+        for segment in self.segments:
+            for address in range(segment.start, segment.end):
+                word = self.word(address)
+                assert word is not None
+                yield address, word
+
+    def load_into(
+        self, memory: bytearray, readable: bytearray, writable: bytearray,
+        executable: bytearray
+    ) -> None:
+        for segment in self.segments:
+            start, end = segment.start, segment.end
+            permissions = bytes(segment.permissions)
+
+            memory[start:end] = bytes(segment.values)
+            readable[start:end] = permissions.translate(READABLE_TABLE)
+            writable[start:end] = permissions.translate(WRITABLE_TABLE)
+            executable[start:end] = permissions.translate(EXECUTABLE_TABLE)
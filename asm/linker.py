@@ -0,0 +1,519 @@
+import os
+import struct
+import typing as typ
+
+from . import assembler, build_cache, object_file
+
+# Library modules (the files in asm/lib with SECTIONs) can be built once
+# into relocatable chunks, one per section, and then linked into every
+# program that includes them instead of running their section code again.
+#
+# A chunk is built at an address aligned to 4096, and only depends on where
+# it's placed modulo its section's alignment: instructions need multiples
+# of 4 and the tables are aligned within their sections. Each module is
+# built a second time with every chunk moved along by its alignment, and
+# only used if nothing changes. Words that depend on where things end up
+# are kept as relocations, the label (or for $$, the start of the chunk)
+# and which of the address's three words to use.
+
+LIB_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'lib')
+
+SECTION_ALIGNMENTS = {
+    'init': 4,
+    'functions': 4,
+    'misc_data': 1,
+    'unary_tables': 64,
+}
+DEFAULT_ALIGNMENT = 4096
+
+# word within the value, label, word of the label's address, and an offset
+# from the label
+Relocation = typ.Tuple[int, str, int, int]
+
+
+def section_alignment(name: str) -> int:
+    return SECTION_ALIGNMENTS.get(name, DEFAULT_ALIGNMENT)
+
+
+def chunk_symbol(module_path: str, section: str) -> str:
+    # a label for the start of a chunk, named like the assembler's own
+    # unique labels so it isn't shown as a symbol
+    module_name = os.path.splitext(os.path.basename(module_path))[0]
+    return f'uid_{module_name}_{section}'
+
+
+class RelocatedValue(assembler.NumericValue):
+    def __init__(
+        self, words: typ.List[int], relocations: typ.List[Relocation]
+    ):
+        self.words = words
+        self.relocations = relocations
+        self.num_words = len(words)
+
+    def as_word_array(self, asm: 'assembler.Assembler') -> typ.List[int]:
+        if not self.relocations:
+            return self.words
+
+        words = self.words.copy()
+        for word_num, label, label_word, offset in self.relocations:
+            if label not in asm.label_values:
+                raise assembler.ValueNotReadyException(
+                    f"Can't find label {label}", None
+                )
+            words[word_num] = assembler.ConstantNumericValue.int_to_words(
+                asm.label_values[label] + offset, 3
+            )[label_word]
+        return words
+
+    def referenced_labels(self) -> typ.Optional[typ.List[str]]:
+        return [label for _, label, _, _ in self.relocations]
+
+
+class ChunkAddressValue(assembler.ConstantNumericValue):
+    # $$ while building a chunk. Still usable in calculations, which is fine
+    # as long as they only depend on the address modulo the alignment.
+    def __init__(self, address: int, symbol: str, offset: int):
+        super().__init__(address, 3)
+        self.symbol = symbol
+        self.offset = offset
+
+
+def relocatable_words(
+    value: assembler.NumericValue, asm: 'assembler.Assembler'
+) -> typ.Tuple[typ.List[int], typ.List[Relocation]]:
+    if isinstance(value, ChunkAddressValue):
+        return [0, 0, 0], [
+            (word_num, value.symbol, word_num, value.offset)
+            for word_num in range(3)
+        ]
+    elif isinstance(value, assembler.LabelValue):
+        return [0, 0, 0], [
+            (word_num, value.name, word_num, 0) for word_num in range(3)
+        ]
+    elif isinstance(value, assembler.InlineLabelDeclarationValue):
+        return relocatable_words(value.initial_value, asm)
+    elif isinstance(value, assembler.MakeResultValue):
+        words: typ.List[int] = []
+        relocations: typ.List[Relocation] = []
+        for constituent in value.constituents:
+            constituent_words, constituent_relocations = relocatable_words(
+                constituent, asm
+            )
+            relocations.extend(
+                (word_num + len(words), label, label_word, offset)
+                for word_num, label, label_word, offset
+                in constituent_relocations
+            )
+            words.extend(constituent_words)
+        return words, relocations
+    elif isinstance(value, assembler.ExtractedValue):
+        inner_words, inner_relocations = relocatable_words(value.value, asm)
+        return [inner_words[value.word_num]], [
+            (0, label, label_word, offset)
+            for word_num, label, label_word, offset in inner_relocations
+            if word_num == value.word_num
+        ]
+    else:
+        # anything else has to be known already, labels aren't while
+        # building modules
+        return value.as_word_array(asm), []
+
+
+class SectionChunk:
+    def __init__(
+        self, name: str, symbol: str, alignment: int, size: int,
+        labels: typ.Dict[str, int],
+        values: typ.List[
+            typ.Tuple[int, RelocatedValue, int]
+        ],
+        find_traceback: typ.Callable[[int], 'assembler.ProgramTraceback']
+    ):
+        self.name = name
+        self.symbol = symbol
+        self.alignment = alignment
+        self.size = size
+        # relative to the start of the chunk
+        self.labels = labels
+        # with traceback numbers from the module's own table
+        self.values = values
+        self.find_traceback = find_traceback
+
+    def __deepcopy__(
+        self, memo: typ.Dict[int, typ.Any]
+    ) -> 'SectionChunk':
+        # never changes once built, so copies can share it
+        return self
+
+    def layout(self) -> typ.Tuple[typ.Any, ...]:
+        # everything that matters for linking, to compare builds
+        return self.size, sorted(self.labels.items()), [
+            (offset, value.words, value.relocations)
+            for offset, value, traceback in self.values
+        ]
+
+    def place(self, asm: 'assembler.Assembler') -> None:
+        start = -(-asm.ip // self.alignment) * self.alignment
+
+        asm.declare_label(self.symbol, start)
+        for label, offset in self.labels.items():
+            asm.declare_label(label, start + offset)
+
+        table = asm.traceback_table
+        for offset, value, traceback in self.values:
+            asm.write_words(start + offset, value.num_words)
+            asm.data_values.append((
+                start + offset, value,
+                table.intern(self.find_traceback(traceback))
+            ))
+
+        asm.ip = start + self.size
+        assert asm.ip < 2 ** 18
+
+
+class LibraryModule:
+    def __init__(
+        self, path: str, included_files: typ.List[str],
+        sections: typ.Dict[str, SectionChunk]
+    ):
+        self.path = path
+        # every file the build included, including the module itself
+        self.included_files = included_files
+        self.sections = sections
+
+
+class ModuleAssembler(assembler.Assembler):
+    # Runs a library module the way a program that NEEDs it would, but
+    # only keeps the module's own SECTIONs, and builds each into a chunk.
+    # Labels aren't given addresses until they're linked.
+    def __init__(self, module_path: str, shifted: bool):
+        super().__init__()
+        self.module_path = module_path
+        self.module_name = os.path.splitext(os.path.basename(module_path))[0]
+        self.primary_filename = module_path
+        self.shifted = shifted
+
+        self.chunk_labels: typ.Dict[str, int] = {}
+        self.chunk_symbol: typ.Optional[str] = None
+        self.chunk_start = 0
+
+    def prelude_variant(self) -> typ.Tuple[str, ...]:
+        return ('module', self.module_path)
+
+    def declare_label(
+        self, label: str, location: typ.Optional[int] = None
+    ) -> None:
+        if label in self.chunk_labels:
+            raise assembler.ParseError(f'Redeclaration of label {label}!')
+        self.chunk_labels[label] = self.ip if location is None else location
+
+    def current_address(self) -> assembler.NumericValue:
+        if self.chunk_symbol is None:
+            return super().current_address()
+        return ChunkAddressValue(
+            self.ip, self.chunk_symbol, self.ip - self.chunk_start
+        )
+
+    def unique_identifier(self, prefix: str) -> str:
+        # programs make their own, which mustn't clash with these
+        self.current_uid += 1
+        return f'uid_{self.module_name}_{prefix}_{self.current_uid}'
+
+    def run_section_command(self, args: typ.List[assembler.Value]) -> None:
+        if len(args) == 2 and isinstance(args[1], assembler.CodeValue):
+            if self.section_owner(args[1]) != self.module_path:
+                # another module's, which will have its own chunks
+                return
+        super().run_section_command(args)
+
+    def build(self) -> typ.Dict[str, SectionChunk]:
+        self.assemble_source(
+            f'INCLUDE common_pre\nNEED {self.module_name}\nINCLUDE common\n',
+            f'<module {self.module_name}>'
+        )
+
+        chunks = {}
+        for name in self.sections:
+            alignment = section_alignment(name)
+            self.chunk_start = -(-self.ip // 4096) * 4096
+            if self.shifted:
+                self.chunk_start += alignment
+            self.ip = self.chunk_start
+            self.chunk_symbol = chunk_symbol(self.module_path, name)
+            self.chunk_labels = {}
+            first_value = len(self.data_values)
+
+            self.emit_section(name, '_global_start', None)
+
+            values = []
+            for start_ip, value, traceback in self.data_values[first_value:]:
+                words, relocations = relocatable_words(value, self)
+                values.append((
+                    start_ip - self.chunk_start,
+                    RelocatedValue(words, relocations), traceback
+                ))
+            chunks[name] = SectionChunk(
+                name, self.chunk_symbol, alignment,
+                self.ip - self.chunk_start, {
+                    label: address - self.chunk_start
+                    for label, address in self.chunk_labels.items()
+                }, values, self.traceback_table.traceback
+            )
+
+        self.chunk_symbol = None
+        return chunks
+
+
+def build_module(module_path: str) -> LibraryModule:
+    module_assembler = ModuleAssembler(module_path, False)
+    chunks = module_assembler.build()
+    shifted_chunks = ModuleAssembler(module_path, True).build()
+
+    for name, chunk in chunks.items():
+        if chunk.layout() != shifted_chunks[name].layout():
+            raise assembler.LinkTimeError(
+                [f'In module "{module_path}":'],
+                f'Section {name} changes when moved by {chunk.alignment} '
+                'word(s), so it needs to be assembled with the program'
+            )
+
+    return LibraryModule(
+        module_path, list(dict.fromkeys(module_assembler.included_files)),
+        chunks
+    )
+
+
+# Layout of a module file (all integers little endian), with the same string
+# and traceback tables as object files:
+#
+#   header       magic, version, then the number of strings, tracebacks,
+#                included files and chunks
+#   strings, tracebacks
+#   included     string numbers of each file the build included
+#
+# then for each chunk its section name, symbol, alignment, size and number
+# of labels, values and relocations, followed by its labels (name and
+# offset), values (offset, number of words and traceback), relocations
+# (value, word, label, word of the label and offset) and every value's
+# words one per byte, padded to 4 bytes.
+
+MAGIC = b'XMOD'
+VERSION = 2
+
+HEADER = struct.Struct('<4sHxxIIII')
+INCLUDED = struct.Struct('<I')
+CHUNK = struct.Struct('<IIIIIII')
+LABEL = struct.Struct('<II')
+VALUE = struct.Struct('<III')
+RELOCATION = struct.Struct('<IIIIi')
+
+
+class ModuleFileError(Exception):
+    pass
+
+
+def save_module(module: LibraryModule, file_name: str) -> None:
+    tables = object_file.TableWriter()
+    included = [
+        INCLUDED.pack(tables.string_number(file_path))
+        for file_path in module.included_files
+    ]
+
+    chunk_parts: typ.List[bytes] = []
+    for chunk in module.sections.values():
+        labels = [
+            LABEL.pack(tables.string_number(label), offset)
+            for label, offset in chunk.labels.items()
+        ]
+        values = []
+        relocations = []
+        words = bytearray()
+        for value_num, (offset, value, traceback) in enumerate(chunk.values):
+            values.append(VALUE.pack(
+                offset, value.num_words, tables.traceback_number(
+                    chunk.find_traceback(traceback)
+                )
+            ))
+            relocations.extend(
+                RELOCATION.pack(
+                    value_num, word_num, tables.string_number(label),
+                    label_word, label_offset
+                )
+                for word_num, label, label_word, label_offset
+                in value.relocations
+            )
+            words.extend(value.words)
+        words.extend(bytes(object_file.padding_for(len(words))))
+
+        chunk_parts.append(CHUNK.pack(
+            tables.string_number(chunk.name),
+            tables.string_number(chunk.symbol), chunk.alignment, chunk.size,
+            len(labels), len(values), len(relocations)
+        ))
+        chunk_parts.extend(labels)
+        chunk_parts.extend(values)
+        chunk_parts.extend(relocations)
+        chunk_parts.append(bytes(words))
+
+    parts = [HEADER.pack(
+        MAGIC, VERSION, len(tables.strings), len(tables.tracebacks),
+        len(included), len(module.sections)
+    )]
+    parts.extend(tables.tables())
+    parts.extend(included)
+    parts.extend(chunk_parts)
+
+    with open(file_name, 'wb') as file:
+        file.write(b''.join(parts))
+
+
+def load_module(module_path: str, file_name: str) -> LibraryModule:
+    with open(file_name, 'rb') as file:
+        view = memoryview(file.read())
+
+    try:
+        (
+            magic, version, num_strings, num_tracebacks, num_included,
+            num_chunks
+        ) = HEADER.unpack_from(view, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ModuleFileError(f'{file_name} is not a current module file')
+
+        tables = object_file.TableReader(
+            view, HEADER.size, num_strings, num_tracebacks
+        )
+        strings = tables.strings
+        offset = tables.end
+
+        def read_table(
+            table: struct.Struct, count: int
+        ) -> typ.List[typ.Tuple[typ.Any, ...]]:
+            nonlocal offset
+            start = offset
+            offset += count * table.size
+            return list(table.iter_unpack(view[start:offset]))
+
+        included_files = [
+            strings[file_path]
+            for file_path, in read_table(INCLUDED, num_included)
+        ]
+
+        sections = {}
+        for _ in range(num_chunks):
+            (
+                name, symbol, alignment, size, num_labels, num_values,
+                num_relocations
+            ) = CHUNK.unpack_from(view, offset)
+            offset += CHUNK.size
+
+            labels = {
+                strings[label]: label_offset
+                for label, label_offset in read_table(LABEL, num_labels)
+            }
+            value_entries = read_table(VALUE, num_values)
+            value_relocations: typ.List[typ.List[Relocation]] = [
+                [] for _ in value_entries
+            ]
+            for (
+                value_num, word_num, label, label_word, label_offset
+            ) in read_table(RELOCATION, num_relocations):
+                value_relocations[value_num].append(
+                    (word_num, strings[label], label_word, label_offset)
+                )
+
+            values = []
+            words_start = offset
+            for (value_offset, num_words, traceback), relocations in zip(
+                value_entries, value_relocations
+            ):
+                # tracebacks are only read when they're placed, so check now
+                if traceback >= num_tracebacks:
+                    raise ModuleFileError(f'{file_name} is damaged')
+                values.append((
+                    value_offset,
+                    RelocatedValue(
+                        list(view[offset:offset + num_words]), relocations
+                    ),
+                    traceback
+                ))
+                offset += num_words
+            # the words are padded by their own length, not the file offset
+            offset += object_file.padding_for(offset - words_start)
+
+            sections[strings[name]] = SectionChunk(
+                strings[name], strings[symbol], alignment, size, labels,
+                values, tables.traceback
+            )
+    except (struct.error, IndexError, ValueError) as err:
+        raise ModuleFileError(f'{file_name} is damaged: {err}')
+
+    return LibraryModule(module_path, included_files, sections)
+
+
+class LibraryStore:
+    # Gives the assembler the built form of library modules, from the build
+    # cache if it has them. Modules that can't be built separately are
+    # assembled with the program as before.
+    def __init__(self, cache: typ.Optional['build_cache.BuildCache']):
+        self.cache = cache
+
+    def find(self, module_path: str) -> typ.Optional[LibraryModule]:
+        if os.path.dirname(module_path) != LIB_DIR:
+            return None
+
+        entry = loaded_modules.get(module_path)
+        if entry is not None and entry.is_current():
+            return entry.module
+
+        module = self.load(module_path)
+        if module is not None:
+            entry = LoadedModule(module.included_files, module)
+        else:
+            entry = LoadedModule([module_path], None)
+        loaded_modules[module_path] = entry
+        return module
+
+    def load(self, module_path: str) -> typ.Optional[LibraryModule]:
+        if self.cache is not None:
+            file_name = self.cache.find('xmod', module_path)
+            if file_name is not None:
+                try:
+                    return load_module(module_path, file_name)
+                except (OSError, ModuleFileError):
+                    pass
+
+        try:
+            module = build_module(module_path)
+        except (assembler.AssemblyError, assembler.ValueNotReadyException):
+            return None
+
+        if self.cache is not None:
+            self.cache.store(
+                'xmod', module_path, module.included_files,
+                lambda file_name: save_module(module, file_name)
+            )
+        return module
+
+
+class LoadedModule:
+    def __init__(
+        self, included_files: typ.List[str],
+        module: typ.Optional[LibraryModule]
+    ):
+        self.module = module
+        self.included_files = included_files
+        self.file_versions = [
+            assembler.include_cache.version(file_path)
+            for file_path in included_files
+        ]
+
+    def is_current(self) -> bool:
+        return all(
+            assembler.include_cache.version(file_path) == version
+            for file_path, version in zip(
+                self.included_files, self.file_versions
+            )
+        )
+
+
+# modules already built or loaded in this process, by path
+loaded_modules: typ.Dict[str, LoadedModule] = {}
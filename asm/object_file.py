@@ -0,0 +1,258 @@
+import array
+import mmap
+import struct
+import sys
+import typing as typ
+
+from . import assembler, compiled
+
+# Layout of an object file (all integers little endian):
+#
+#   header       magic, version, then the number of strings, tracebacks,
+#                labels and segments
+#   strings      each a u32 length followed by that much utf-8
+#   tracebacks   previous (-1 for none), origin, line number, line, last
+#                global label (origin, line and label are string numbers)
+#                and whether it's internal
+#   labels       name (string number) and address
+#   segments     start address and length of each run of populated words
+#
+# followed by, for each segment, its words one per byte, its permission
+# flags one per byte and (aligned to 4 bytes) the traceback number of each
+# word as a u32. The words and flags can be copied straight into the
+# emulator's memory from the mapped file.
+
+MAGIC = b'XOBJ'
+VERSION = 2
+
+HEADER = struct.Struct('<4sHxxIIII')
+LENGTH = struct.Struct('<I')
+TRACEBACK = struct.Struct('<iIIIII')
+LABEL = struct.Struct('<II')
+SEGMENT = struct.Struct('<II')
+
+
+class ObjectFileError(Exception):
+    pass
+
+
+def padding_for(offset: int) -> int:
+    return -offset % 4
+
+
+def u32_array(view: memoryview) -> typ.Sequence[int]:
+    # little endian u32s, read in place where the host agrees
+    if sys.byteorder == 'little':
+        return view.cast('I')
+    numbers = array.array('I', view.tobytes())
+    numbers.byteswap()
+    return numbers
+
+
+class TableWriter:
+    # Numbers strings and tracebacks as they're first seen, for the tables
+    # at the start of a file
+    def __init__(self) -> None:
+        self.strings: typ.List[str] = []
+        self.string_numbers: typ.Dict[str, int] = {}
+        self.tracebacks: typ.List[bytes] = []
+        self.traceback_numbers: typ.Dict[int, int] = {}
+
+    def string_number(self, string: str) -> int:
+        if string not in self.string_numbers:
+            self.string_numbers[string] = len(self.strings)
+            self.strings.append(string)
+        return self.string_numbers[string]
+
+    def traceback_number(
+        self, traceback: 'assembler.ProgramTraceback'
+    ) -> int:
+        if id(traceback) in self.traceback_numbers:
+            return self.traceback_numbers[id(traceback)]
+
+        previous = -1
+        if traceback.previous is not None:
+            previous = self.traceback_number(traceback.previous)
+
+        self.tracebacks.append(TRACEBACK.pack(
+            previous, self.string_number(traceback.origin),
+            traceback.line_number, self.string_number(traceback.line),
+            self.string_number(traceback.last_global_label),
+            traceback.is_internal
+        ))
+        self.traceback_numbers[id(traceback)] = len(self.tracebacks) - 1
+        return len(self.tracebacks) - 1
+
+    def tables(self) -> typ.List[bytes]:
+        parts = []
+        for string in self.strings:
+            encoded = string.encode()
+            parts.append(LENGTH.pack(len(encoded)))
+            parts.append(encoded)
+        parts.extend(self.tracebacks)
+        return parts
+
+
+class TableReader:
+    # The other side of TableWriter. Tracebacks are only built when they're
+    # asked for.
+    def __init__(
+        self, view: memoryview, offset: int, num_strings: int,
+        num_tracebacks: int
+    ):
+        self.strings: typ.List[str] = []
+        for _ in range(num_strings):
+            length, = LENGTH.unpack_from(view, offset)
+            offset += LENGTH.size
+            self.strings.append(str(view[offset:offset + length], 'utf-8'))
+            offset += length
+
+        table_end = offset + num_tracebacks * TRACEBACK.size
+        self.traceback_entries = list(
+            TRACEBACK.iter_unpack(view[offset:table_end])
+        )
+        self.tracebacks: typ.List[
+            typ.Optional[assembler.ProgramTraceback]
+        ] = [None] * num_tracebacks
+        # where the tables end
+        self.end = table_end
+
+    def traceback(self, number: int) -> 'assembler.ProgramTraceback':
+        traceback = self.tracebacks[number]
+        if traceback is None:
+            (
+                previous, origin, line_number, line, last_global_label,
+                is_internal
+            ) = self.traceback_entries[number]
+
+            traceback = assembler.ProgramTraceback(
+                self.traceback(previous) if previous >= 0 else None,
+                self.strings[origin], line_number, self.strings[line],
+                bool(is_internal), self.strings[last_global_label]
+            )
+            self.tracebacks[number] = traceback
+        return traceback
+
+
+def save_program(program: compiled.CompiledProgram, file_name: str) -> None:
+    tables = TableWriter()
+    # from the program's traceback numbers to the file's
+    traceback_numbers: typ.Dict[int, int] = {}
+
+    segment_contents = []
+    for segment in program.segments:
+        numbers = []
+        for number in segment.traceback_numbers:
+            if number not in traceback_numbers:
+                traceback_numbers[number] = tables.traceback_number(
+                    program.find_traceback(number)
+                )
+            numbers.append(traceback_numbers[number])
+
+        segment_contents.append((
+            bytes(segment.values), bytes(segment.permissions),
+            struct.pack(f'<{len(numbers)}I', *numbers)
+        ))
+
+    labels = [
+        LABEL.pack(tables.string_number(label), address)
+        for label, address in program.labels.items()
+    ]
+
+    parts: typ.List[bytes] = [HEADER.pack(
+        MAGIC, VERSION, len(tables.strings), len(tables.tracebacks),
+        len(labels), len(program.segments)
+    )]
+    parts.extend(tables.tables())
+    parts.extend(labels)
+    parts.extend(
+        SEGMENT.pack(segment.start, segment.end - segment.start)
+        for segment in program.segments
+    )
+
+    offset = sum(len(part) for part in parts)
+    for values, permissions, traceback_ids in segment_contents:
+        parts.append(values)
+        parts.append(permissions)
+        offset += 2 * len(values)
+        parts.append(bytes(padding_for(offset)))
+        offset += padding_for(offset)
+        parts.append(traceback_ids)
+        offset += len(traceback_ids)
+
+    with open(file_name, 'wb') as file:
+        file.write(b''.join(parts))
+
+
+def is_object_file(file_name: str) -> bool:
+    with open(file_name, 'rb') as file:
+        return file.read(len(MAGIC)) == MAGIC
+
+
+class ObjectFile:
+    # A mapped object file. Words and permissions are read straight from the
+    # mapping, and tracebacks are only built when they're asked for.
+    def __init__(self, file_name: str):
+        # a truncated or corrupt file fails somewhere in the unpacking
+        try:
+            self.read(file_name)
+        except (struct.error, IndexError, ValueError) as err:
+            raise ObjectFileError(f'{file_name} is corrupt ({err})')
+
+    def read(self, file_name: str) -> None:
+        with open(file_name, 'rb') as file:
+            self.mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self.mapping)
+
+        if len(view) < HEADER.size:
+            raise ObjectFileError(f'{file_name} is too short')
+        (
+            magic, version, num_strings, num_tracebacks, num_labels,
+            num_segments
+        ) = HEADER.unpack_from(view, 0)
+        if magic != MAGIC:
+            raise ObjectFileError(f'{file_name} is not an object file')
+        if version != VERSION:
+            raise ObjectFileError(
+                f'{file_name} has version {version}, expected {VERSION}'
+            )
+        self.tables = TableReader(
+            view, HEADER.size, num_strings, num_tracebacks
+        )
+        offset = self.tables.end
+
+        table_end = offset + num_labels * LABEL.size
+        self.labels = {
+            self.tables.strings[name]: address
+            for name, address in LABEL.iter_unpack(view[offset:table_end])
+        }
+        offset = table_end
+
+        table_end = offset + num_segments * SEGMENT.size
+        # slicing past the end gives a short view rather than an error, so a
+        # truncated table can still unpack
+        if table_end > len(view):
+            raise ObjectFileError(f'{file_name} is truncated')
+        segment_ranges = list(SEGMENT.iter_unpack(view[offset:table_end]))
+        offset = table_end
+
+        self.segments: typ.List[compiled.Segment] = []
+        for start, length in segment_ranges:
+            values = view[offset:offset + length]
+            offset += length
+            permissions = view[offset:offset + length]
+            offset += length + padding_for(offset + length)
+            if offset + 4 * length > len(view):
+                raise ObjectFileError(f'{file_name} is truncated')
+            traceback_ids = u32_array(view[offset:offset + 4 * length])
+            offset += 4 * length
+            self.segments.append(compiled.Segment(
+                start, values, permissions, traceback_ids
+            ))
+
+
+def load_program(file_name: str) -> compiled.CompiledProgram:
+    object_file = ObjectFile(file_name)
+    return compiled.CompiledProgram(
+        object_file.segments, object_file.labels, object_file.tables.traceback
+    )
@@ -1,7 +1,15 @@
+import contextlib
+import copy
+import io
+import os
+import sys
+import tempfile
 import typing as typ
-from . import assembler
+from . import assembler, build_cache, compiled, linker, object_file
 
 tests: typ.List[typ.Tuple[str, str, typ.List[typ.Optional[int]]]] = []
+error_tests: typ.List[typ.Tuple[str, str, typ.List[str]]] = []
+function_tests: typ.List[typ.Callable[[], bool]] = []
 
 
 def add_simple_test(
@@ -18,6 +26,93 @@ def add_simple_test(
     tests.append((name, src, expected))
 
 
+def add_error_test(name: str, src: str, expected_lines: typ.List[str]) -> None:
+    # the source should fail to assemble, with each of the expected lines
+    # in the error message
+    error_tests.append((name, src, expected_lines))
+
+
+def function_test(test: typ.Callable[[], bool]) -> typ.Callable[[], bool]:
+    # for anything that needs more than one assembly, or files on disk
+    function_tests.append(test)
+    return test
+
+
+def program_data(
+    compiled_program: compiled.CompiledProgram
+) -> typ.List[typ.Optional[int]]:
+    data: typ.List[typ.Optional[int]] = [None] * (2 ** 18)
+    for segment in compiled_program.segments:
+        data[segment.start:segment.end] = segment.values
+    return data
+
+
+def check_data(
+    data: typ.List[typ.Optional[int]],
+    test_expected: typ.List[typ.Optional[int]]
+) -> bool:
+    if data == test_expected:
+        return True
+
+    first_discrepency = [
+        actual != expected
+        for actual, expected in zip(data, test_expected)
+    ].index(True)
+
+    print(f"Discrepancy at {first_discrepency}:")
+    explanation_start = max(0, first_discrepency - 5)
+
+    for row_num, row in enumerate((test_expected, data)):
+        print(["Expected", "Actual  "][row_num], end='  ')
+        for term in row[explanation_start:explanation_start+10]:
+            if term is None:
+                printed_term = '__'
+            else:
+                printed_term = str(term)
+            print(f' {printed_term:>4}', end='')
+        print()
+    skip_terms = first_discrepency - explanation_start
+    prefix = " " * (5 * skip_terms + 10)
+    print(prefix + " ^^^^")
+    print(prefix + f"@{first_discrepency}".rjust(5))
+    return False
+
+
+def expected_data(
+    data: typ.List[typ.Optional[int]], offset: int = 0
+) -> typ.List[typ.Optional[int]]:
+    expected: typ.List[typ.Optional[int]] = [None] * (2 ** 18)
+    expected[offset:offset + len(data)] = data
+    return expected
+
+
+def write_file(file_path: str, source: str) -> None:
+    with open(file_path, 'w') as file:
+        file.write(source)
+
+
+def assemble_file(file_path: str) -> typ.List[typ.Optional[int]]:
+    asm = assembler.Assembler()
+    asm.assemble_file(file_path)
+    return program_data(asm.link_data())
+
+
+def assemble_program(source: str, name: str) -> compiled.CompiledProgram:
+    asm = assembler.Assembler()
+    asm.assemble_source(source, f'<test {name}>')
+    return asm.link_data()
+
+
+def assemble_source(source: str, name: str) -> typ.List[typ.Optional[int]]:
+    return program_data(assemble_program(source, name))
+
+
+def traceback_lines(traceback: assembler.ProgramTraceback) -> typ.List[str]:
+    lines: typ.List[str] = []
+    traceback.gather_lines(lines)
+    return lines
+
+
 add_simple_test("test1", """DATA""", [])
 add_simple_test("test2", """DATA 0""", [0])
 add_simple_test("test3", """DATA 0, 1""", [0, 1])
@@ -47,6 +142,156 @@ DEFINE COMMAND, DO_SOMETHING, a, b, {
 DO_SOMETHING 8, 9
 """.strip(), [3, 8, 9])
 
+add_simple_test("parse_whitespace", """
+\tDATA\t1 ,  2\t,3
+  REM a comment
+rem lower case comment
+
+DATA 0x3f, 0b101, 0x41_2, 0_2
+DATA $$, $$
+""", [1, 2, 3, 63, 5, 1, 1, 0, 0, 0, 0, 9, 0, 0, 9])
+
+add_simple_test("parse_labels_and_calls", """
+:start
+DATA %.here=5, .here
+DEFINE VARIABLE, v, make(2, 3, 4)
+DATA $v, make( 1 , hi( $v ) )
+""", [5, 0, 0, 0, 3, 4, 3])
+
+add_simple_test("parse_code_blocks", """
+DEFINE COMMAND, ONE_LINE, a, { DATA $a }
+ONE_LINE 7
+DEFINE COMMAND, TWO_LINES, a, {
+\tONE_LINE $a
+  ONE_LINE plus($a, 1)   }
+TWO_LINES 2
+""", [7, 2, 3])
+
+add_simple_test("code_block_reuse", """
+DEFINE COMMAND, EMIT, a, {
+    DATA $a
+    IF is_eq($a, 2), { DATA 9 }
+}
+DEFINE COMMAND, EMIT_TWICE, a, {
+    DEFINE COMMAND, AGAIN, { EMIT $a }
+    AGAIN
+    AGAIN
+}
+DEFINE VARIABLE, i, 0
+LOOP go, { SET VARIABLE, go, is_lt($i, 4) }, {
+    EMIT $i
+    SET VARIABLE, i, plus($i, 1)
+}
+EMIT_TWICE 5
+EMIT_TWICE 2
+""".strip(), [0, 1, 2, 9, 3, 5, 5, 2, 9, 2, 9])
+
+add_error_test("data_past_the_end", """
+ALLOCATE_ZEROS 65535_3
+DATA 1
+""".strip(), [
+    'At "<test data_past_the_end>" on line 2:',
+    ' >>> DATA past the end of memory (up to 65536)',
+])
+
+add_error_test("allocate_zeros_past_the_end", """
+DATA 1
+ALLOCATE_ZEROS 70000_3
+""".strip(), [
+    ' >>> DATA past the end of memory (up to 70001)',
+])
+
+add_error_test("macro_named_as_native", """
+DEFINE COMMAND, times, a, { DATA $a }
+""".strip(), [
+    '    DEFINE COMMAND, times, a, { DATA $a }',
+    ' >>> Command times is built in',
+])
+
+add_error_test("align_to_not_power_of_two", """
+ALIGN_TO 3
+""".strip(), [
+    ' >>> Can only ALIGN_TO a power of two, not 3',
+])
+
+add_error_test("code_block_reuse_traceback", """
+DEFINE COMMAND, CHECK, a, {
+    DATA $a
+    ASSERT is_lt($a, 2)
+}
+CHECK 0
+CHECK 1
+CHECK 2
+""".strip(), [
+    'At "<test code_block_reuse_traceback>" on line 7:',
+    '    CHECK 2',
+    'At "<test code_block_reuse_traceback>" on line 3:',
+    ' >>> Assertion failure',
+])
+
+add_simple_test("allocate_zeros", """
+ALLOCATE_ZEROS 3
+DATA 5
+ALLOCATE_ZEROS 2_2
+""", [0, 0, 0, 5, 0, 0])
+
+add_simple_test("allocate_zeros_to_the_end", """
+ALLOCATE_ZEROS 65534_3
+DATA 1
+""", [0] * 65534 + [1])
+
+add_simple_test("constant_folding", """
+DATA make(3, 1, 2_2), hi(0x41_2), hi_mid(0x1041_3), mid(5_3), low(70_3)
+DATA make(1, hi(:later)), mid(:later), low(:later)
+REM too big for its words, but never used
+DEFINE VARIABLE, unused, make(1, 70)
+ALIGN_TO 64_2
+ALLOCATE_ZEROS 36
+:later
+DATA 9
+""", [1, 0, 2, 1, 1, 1, 0, 6, 0, 1, 36] + [None] * 53 + [0] * 36 + [9])
+
+add_simple_test("times_execute_align_to", """
+INCLUDE asm_control
+DEFINE VARIABLE, n, 0
+TIMES 3, {
+    DATA $n
+    SET VARIABLE, n, plus($n, 1)
+}
+DEFINE VARIABLE, code, { DATA 7 }
+EXECUTE $code
+EXECUTE { DATA 8 }
+ALIGN_TO 8
+DATA 9
+ALIGN_TO 8
+DATA 10
+TIMES 0, { DATA 11 }
+""", [0, 1, 2, 7, 8, None, None, None, 9] + [None] * 7 + [10])
+
+add_simple_test("times_execute_labels", """
+:g
+TIMES 1, { DATA %.x=5 }
+EXECUTE { DATA .x }
+DATA :g.x
+""", [5, 0, 0, 0, 0, 0, 0])
+
+add_simple_test("variable_shadowed_deep_down", """
+DEFINE VARIABLE, v, 1
+DEFINE COMMAND, INNER, {
+    IF 1, { IF 1, {
+        DATA $v
+        DEFINE VARIABLE, v, 2
+        DATA $v
+        SET VARIABLE, v, 3
+        DATA $v
+    } }
+    DATA $v
+}
+INNER
+INNER
+DATA $v
+""", [1, 2, 3, 1, 1, 2, 3, 1, 1])
+
 add_simple_test("include", """
 INCLUDE common_pre
 INCLUDE common
@@ -54,6 +299,484 @@ INCLUDE common
 INC_A
 """.strip(), [16, 0, 0, 0])
 
+add_simple_test("unused_functions", """
+SECTION functions, {
+:used
+    DATA make(4, 12, 0_3)
+:unused
+    DATA make(4, 12, 0_3)
+}
+DATA :used
+EMIT_SECTION functions
+""".strip(), [0, 0, 3, 12, 0, 0, 0])
+
+add_simple_test("unused_functions_label_arithmetic", """
+SECTION functions, {
+:used
+    DATA make(4, 12, 0_3)
+:unused
+    DATA make(4, 12, 0_3)
+}
+EMIT_SECTION functions
+DATA plus(:used, 0_3)
+""".strip(), [12, 0, 0, 0, None, None, None, None, 0, 0, 0])
+
+
+@function_test
+def include_cache() -> bool:
+    with tempfile.TemporaryDirectory() as directory:
+        main_path = os.path.join(directory, 'main.xasm')
+        part_path = os.path.join(directory, 'part.xasm')
+        write_file(main_path, 'INCLUDE part\nINCLUDE part\n')
+        write_file(part_path, 'DATA 1\n')
+
+        if not check_data(assemble_file(main_path), expected_data([1, 1])):
+            return False
+        block = assembler.include_cache.load(part_path)
+
+        if not check_data(assemble_file(main_path), expected_data([1, 1])):
+            return False
+        if assembler.include_cache.load(part_path) is not block:
+            print("Unchanged include was parsed again")
+            return False
+
+        # a different size, so it's seen as changed even if the mtime isn't
+        write_file(part_path, 'DATA 2, 3\n')
+        return check_data(
+            assemble_file(main_path), expected_data([2, 3, 2, 3])
+        )
+
+
+PRELUDE = """
+INCLUDE common_pre
+NEED addition
+INCLUDE common
+""".strip() + '\n'
+
+ADD_PROGRAM = PRELUDE + """
+    JUMP :initialise
+:main
+    BINARY_ADD 50, 49
+    HALT_LOOP
+WRITE_SECTIONS
+"""
+
+
+@function_test
+def prelude_cache() -> bool:
+    first = PRELUDE + """
+DEFINE COMMAND, MINE, { BINARY_ADD 4, 7 }
+    JUMP :initialise
+:main
+    MINE
+    HALT_LOOP
+WRITE_SECTIONS
+"""
+    second = ADD_PROGRAM
+
+    assembler.prelude_cache.snapshots.clear()
+    without_cache = assemble_source(second, 'prelude_cache')
+    if not assembler.prelude_cache.snapshots:
+        print("Prelude wasn't kept")
+        return False
+
+    # both start from the same snapshot, and nothing the first one does
+    # should be seen by the second
+    assemble_source(first, 'prelude_cache')
+    if not check_data(
+        assemble_source(second, 'prelude_cache'), without_cache
+    ):
+        return False
+
+    try:
+        assemble_source(PRELUDE + 'MINE\n', 'prelude_cache')
+    except assembler.ParseError:
+        return True
+    print("Command defined after a prelude was kept with it")
+    return False
+
+
+@function_test
+def object_file_round_trip() -> bool:
+    program = assemble_program(ADD_PROGRAM, 'object_file_round_trip')
+
+    with tempfile.TemporaryDirectory() as directory:
+        file_path = os.path.join(directory, 'program.xobj')
+        object_file.save_program(program, file_path)
+        loaded = object_file.load_program(file_path)
+
+        if not check_data(program_data(loaded), program_data(program)):
+            return False
+        if loaded.labels != program.labels:
+            print("Labels differ")
+            return False
+        for address, word in program.words():
+            loaded_word = loaded.data[address]
+            assert loaded_word is not None
+            if (
+                traceback_lines(loaded_word.traceback) !=
+                traceback_lines(word.traceback)
+            ):
+                print(f"Traceback at {address} differs")
+                return False
+
+        with open(file_path, 'rb') as file:
+            contents = file.read()
+        truncated_path = os.path.join(directory, 'truncated.xobj')
+        for length in range(0, len(contents), 3):
+            with open(truncated_path, 'wb') as file:
+                file.write(contents[:length])
+            try:
+                object_file.ObjectFile(truncated_path)
+            except object_file.ObjectFileError:
+                continue
+            print(f"Loaded the first {length} bytes of an object file")
+            return False
+
+    return True
+
+
+@function_test
+def build_cache_hits_and_misses() -> bool:
+    with tempfile.TemporaryDirectory() as directory:
+        main_path = os.path.join(directory, 'main.xasm')
+        part_path = os.path.join(directory, 'part.xasm')
+        cache_dir = os.path.join(directory, 'cache')
+        write_file(main_path, ADD_PROGRAM + 'INCLUDE part\n')
+        write_file(part_path, 'DATA 7\n')
+
+        # only the command line tools use the cache unless asked
+        os.environ['XASM_CACHE_DIR'] = cache_dir
+        try:
+            assembler.load_program(main_path)
+        finally:
+            del os.environ['XASM_CACHE_DIR']
+        if os.path.exists(cache_dir):
+            print("load_program used the cache by default")
+            return False
+
+        cache = build_cache.BuildCache(cache_dir)
+        for _ in range(2):
+            if not check_data(
+                program_data(build_cache.assemble_file(main_path, cache)),
+                program_data(build_cache.assemble_file(main_path, None))
+            ):
+                return False
+            if cache.find('xobj', main_path) is None:
+                print("Program wasn't found in the cache")
+                return False
+
+        write_file(part_path, 'DATA 8, 9\n')
+        if cache.find('xobj', main_path) is not None:
+            print("Cache wasn't missed after an include changed")
+            return False
+        return check_data(
+            program_data(build_cache.assemble_file(main_path, cache)),
+            program_data(build_cache.assemble_file(main_path, None))
+        )
+
+
+LIBRARY_PROGRAM = """
+INCLUDE common_pre
+NEED addition
+NEED multiplication
+NEED unary_logic
+NEED binary_compare
+NEED unary_minus
+NEED big_int_10
+INCLUDE common
+
+    JUMP :initialise
+:main
+    BINARY_ADD 4, 7
+    BINARY_MULTIPLY 6, 7
+    UNARY_TO_BOOL 42
+    CMP 42, 43
+    CMP_IS_EQ
+    UNARY_NEGATE 22
+    LOAD_CONSTANT 12
+    STORE_A :big_int_10_args.alpha
+    CALL big_int_10_increment
+    HALT_LOOP
+
+WRITE_SECTIONS
+"""
+
+
+def compare_programs(
+    actual: compiled.CompiledProgram, expected: compiled.CompiledProgram
+) -> bool:
+    if not check_data(program_data(actual), program_data(expected)):
+        return False
+
+    # unique identifiers are numbered in the order they're made
+    def named_labels(program: compiled.CompiledProgram) -> typ.Dict[str, int]:
+        return {
+            label: address for label, address in program.labels.items()
+            if not label.startswith('uid_')
+        }
+    if named_labels(actual) != named_labels(expected):
+        print("Labels differ")
+        return False
+
+    # a linked module's tracebacks start in the module rather than where it
+    # was placed, so only the line each word came from is compared
+    for address, word in expected.words():
+        actual_word = actual.data[address]
+        assert actual_word is not None
+        if actual_word.traceback.lines != word.traceback.lines:
+            print(f"Traceback at {address} differs")
+            return False
+    return True
+
+
+@function_test
+def linker_matches_source() -> bool:
+    with tempfile.TemporaryDirectory() as directory:
+        main_path = os.path.join(directory, 'main.xasm')
+        write_file(main_path, LIBRARY_PROGRAM)
+        cache = build_cache.BuildCache(os.path.join(directory, 'cache'))
+
+        asm = assembler.Assembler()
+        asm.assemble_file(main_path)
+        from_source = asm.link_data()
+
+        # built in memory, built and saved, then loaded from the saved files
+        for store in (
+            linker.LibraryStore(None), linker.LibraryStore(cache),
+            linker.LibraryStore(cache)
+        ):
+            # the modules are placed by the prelude
+            assembler.prelude_cache.snapshots.clear()
+            linker.loaded_modules.clear()
+            asm = assembler.Assembler(store)
+            asm.assemble_file(main_path)
+            if not compare_programs(asm.link_data(), from_source):
+                return False
+
+            if not any(
+                entry.module is not None
+                for entry in linker.loaded_modules.values()
+            ):
+                print("No library modules were linked")
+                return False
+
+        # a module file that can't be read is quietly built again instead
+        for module_path, entry in linker.loaded_modules.items():
+            if entry.module is None:
+                continue
+            file_name = cache.find('xmod', module_path)
+            if file_name is None:
+                print(f"{module_path} wasn't saved")
+                return False
+            try:
+                linker.load_module(module_path, file_name)
+            except linker.ModuleFileError as err:
+                print(err)
+                return False
+
+    return True
+
+
+@function_test
+def traceback_table_per_assembly() -> bool:
+    def assemble(source: str) -> assembler.Assembler:
+        asm = assembler.Assembler()
+        asm.assemble_source(source, '<test traceback_table_per_assembly>')
+        return asm
+
+    # starting with DATA, so that the preludes are run rather than restored
+    first = assemble('DATA 0_4\n' + ADD_PROGRAM)
+    num_entries = len(first.traceback_table.entries)
+    assemble('DATA 0_4\n' + LIBRARY_PROGRAM)
+    second = assemble('DATA 0_4\n' + ADD_PROGRAM)
+
+    # nothing from the other programs should be kept
+    if len(second.traceback_table.entries) != num_entries:
+        print("Traceback table has entries from other assemblies")
+        return False
+    return compare_programs(second.link_data(), first.link_data())
+
+
+@function_test
+def segments() -> bool:
+    program = assemble_program("""
+DATA 1, 2
+ALIGN_TO 8
+DATA 3
+ALIGN_TO 4096_3
+DATA 4_2
+""", 'segments')
+
+    layout = [
+        (segment.start, list(segment.values))
+        for segment in program.segments
+    ]
+    if layout != [(0, [1, 2]), (8, [3]), (4096, [0, 4])]:
+        print(f"Segments are {layout}")
+        return False
+
+    # random access, including between and after the segments
+    values: typ.Dict[int, typ.Optional[int]] = {}
+    for address in (0, 1, 2, 7, 8, 9, 4095, 4097, 2 ** 18 - 1):
+        word = program.data[address]
+        values[address] = word.value if word is not None else None
+    if values != {
+        0: 1, 1: 2, 2: None, 7: None, 8: 3, 9: None, 4095: None, 4097: 4,
+        2 ** 18 - 1: None
+    }:
+        print(f"Words are {values}")
+        return False
+    try:
+        program.data[2 ** 18]
+    except IndexError:
+        pass
+    else:
+        print("No error for a word past the end")
+        return False
+
+    if [address for address, word in program.words()] != [
+        0, 1, 8, 4096, 4097
+    ]:
+        print("Words aren't listed in order")
+        return False
+
+    memory = bytearray(2 ** 18)
+    readable = bytearray(2 ** 18)
+    program.load_into(memory, readable, bytearray(2 ** 18), bytearray(2 ** 18))
+    if memory[:10] != bytes([1, 2, 0, 0, 0, 0, 0, 0, 3, 0]) or (
+        readable[:10] != bytes([1, 1, 0, 0, 0, 0, 0, 0, 1, 0])
+    ):
+        print("Segments weren't loaded into memory")
+        return False
+    return True
+
+
+@function_test
+def failed_write_leaves_flags() -> bool:
+    asm = assembler.Assembler()
+    try:
+        asm.assemble_source(
+            'DATA 1\nALLOCATE_ZEROS 70000_3\n', '<test failed_write>'
+        )
+    except assembler.ParseError:
+        pass
+    return len(asm.written_flags) == 2 ** 18 and asm.words_written == 1
+
+
+@function_test
+def label_value_in_two_assemblers() -> bool:
+    # a label's words are kept, but have to follow the assembler asking
+    value = assembler.LabelValue('shared')
+    first = assembler.Assembler()
+    first.label_values['shared'] = 100
+    second = assembler.Assembler()
+    second.label_values['shared'] = 4097
+
+    words = [
+        value.as_word_array(asm) for asm in (first, second, first)
+    ]
+    if words != [[0, 1, 36], [1, 0, 1], [0, 1, 36]]:
+        print(f"Label words are {words}")
+        return False
+    return True
+
+
+
+@function_test
+def definitions_per_context_tree() -> bool:
+    root = assembler.Context(None)
+    inner = assembler.Context(assembler.Context(root))
+    inner.define_variable('v', assembler.ConstantNumericValue(1, 1))
+    copied = copy.deepcopy(inner)
+
+    other = assembler.Context(None)
+    if 'v' in other.definitions:
+        print("Definitions are shared between roots")
+        return False
+    if copied.definitions is root.definitions:
+        print("Copied contexts count into the original root")
+        return False
+    return copied.parent is not None and \
+        copied.parent.definitions is copied.definitions
+
+
+
+PROFILED_PROGRAM = """
+DEFINE COMMAND, PAIR, { DATA 1, 2 }
+DEFINE COMMAND, DOWN, n, {
+    IF $n, { DOWN minus($n, 1) }
+    DATA $n
+}
+INCLUDE part
+TIMES 3, { PAIR }
+DOWN 2
+"""
+
+# (kind, name): (count, words), where a recursive macro's words are only
+# counted once
+PROFILED_STATS = {
+    ('include', 'part'): (1, 2),
+    ('macro', 'DOWN'): (3, 3),
+    ('macro', 'PAIR'): (4, 8),
+    ('times', 'main.xasm:8'): (1, 6),
+}
+
+
+def write_profiled_program(directory: str) -> str:
+    main_path = os.path.join(directory, 'main.xasm')
+    write_file(main_path, PROFILED_PROGRAM)
+    write_file(os.path.join(directory, 'part.xasm'), 'PAIR\n')
+    return main_path
+
+
+@function_test
+def profiler_stats() -> bool:
+    with tempfile.TemporaryDirectory() as directory:
+        asm = assembler.Assembler()
+        profiler = asm.enable_profiling()
+        asm.assemble_file(write_profiled_program(directory))
+
+    stats = {
+        key: (stat.count, stat.words)
+        for key, stat in profiler.stats.items()
+    }
+    if stats != PROFILED_STATS:
+        print(f"Profiled {stats}")
+        return False
+    if profiler.running:
+        print("Profiler still running something")
+        return False
+    return all(
+        0 <= stat.exclusive_time <= stat.inclusive_time
+        for stat in profiler.stats.values()
+    )
+
+
+@function_test
+def profile_flag() -> bool:
+    with tempfile.TemporaryDirectory() as directory:
+        argv = sys.argv
+        sys.argv = ['asm', '--profile', write_profiled_program(directory)]
+        output = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(output):
+                assembler.main()
+        finally:
+            sys.argv = argv
+
+    lines = output.getvalue().splitlines()
+    rows: typ.Dict[typ.Tuple[str, str], typ.Tuple[int, int]] = {}
+    for line in lines[1:-1]:
+        kind, name, count, _, _, words = (
+            column.strip() for column in line.split('|')
+        )
+        rows[kind, name] = (int(count), int(words))
+    if rows != PROFILED_STATS:
+        print(output.getvalue())
+        return False
+    return lines[0].startswith('kind ') and lines[-1].endswith(' 11 words')
+
 
 if __name__ == '__main__':
     for test in tests:
@@ -64,34 +787,41 @@ if __name__ == '__main__':
 
         try:
             asm.assemble_source(test[1], f'<test {test_name}>')
-            compiled_program = asm.link_data()
-            data = [
-                word.value if word is not None else None
-                for word in compiled_program.data
-            ]
+            data = program_data(asm.link_data())
         except assembler.AssemblyError as err:
             err.print_info()
             break
 
-        if data != test_expected:
-            first_discrepency = [
-                actual != expected
-                for actual, expected in zip(data, test_expected)
-            ].index(True)
-
-            print(f"Discrepancy at {first_discrepency}:")
-            explanation_start = max(0, first_discrepency - 5)
-
-            for row_num, row in enumerate((test_expected, data)):
-                print(["Expected", "Actual  "][row_num], end='  ')
-                for term in row[explanation_start:explanation_start+10]:
-                    if term is None:
-                        printed_term = '__'
-                    else:
-                        printed_term = str(term)
-                    print(f' {printed_term:>4}', end='')
-                print()
-            skip_terms = first_discrepency - explanation_start
-            prefix = " " * (5 * skip_terms + 10)
-            print(prefix + " ^^^^")
-            print(prefix + f"@{first_discrepency}".rjust(5))
+        check_data(data, test_expected)
+
+    for test_name, test_source, expected_lines in error_tests:
+        print(f" == {test_name} ==")
+        asm = assembler.Assembler()
+        output = io.StringIO()
+
+        try:
+            asm.assemble_source(test_source, f'<test {test_name}>')
+            asm.link_data()
+        except assembler.AssemblyError as err:
+            with contextlib.redirect_stdout(output):
+                err.print_info()
+        else:
+            print("Assembled without an error")
+            continue
+
+        printed = output.getvalue().split('\n')
+        for line in expected_lines:
+            if line not in printed:
+                print(output.getvalue())
+                print(f"Missing line: {line}")
+
+    for function in function_tests:
+        print(f" == {function.__name__} ==")
+        try:
+            passed = function()
+        except assembler.AssemblyError as err:
+            err.print_info()
+            passed = False
+
+        if not passed:
+            print("Failed")
@@ -0,0 +1,129 @@
+import argparse
+import contextlib
+import json
+import sys
+import time
+import typing as typ
+
+from asm.assembler import AssemblyError, LinkTimeError, load_program
+from asm.object_file import ObjectFileError
+
+from .emulator import Emulator, StopReason
+
+
+def read_input_file(file_name: str) -> typ.List[int]:
+    with open(file_name) as file:
+        contents = file.read()
+
+    words = []
+    for part in contents.replace(',', ' ').split():
+        try:
+            word = int(part, base=0)
+        except ValueError:
+            raise ValueError(f'Input word is not a number: {part}')
+        if not 0 <= word < 64:
+            raise ValueError(f'Input word out of range: {part}')
+        words.append(word)
+    return words
+
+
+def run_program(args: argparse.Namespace) -> int:
+    try:
+        # keep stdout clean for the program's own output
+        with contextlib.redirect_stdout(sys.stderr):
+            program = load_program(args.program, not args.no_cache)
+    except AssemblyError as err:
+        with contextlib.redirect_stdout(sys.stderr):
+            err.print_info()
+        return 1
+    except (OSError, ObjectFileError) as err:
+        print(f'Error: {err}', file=sys.stderr)
+        return 1
+
+    emulator = Emulator(program, False)
+    if args.input is not None:
+        try:
+            emulator.provide_input(read_input_file(args.input))
+        except (OSError, ValueError) as err:
+            print(f'Error: {err}', file=sys.stderr)
+            return 1
+
+    error: typ.Optional[str] = None
+    start_time = time.perf_counter()
+    try:
+        reason = emulator.run(args.max_steps).value
+    except LinkTimeError as err:
+        # errors triggered through a traceback at runtime
+        with contextlib.redirect_stdout(sys.stderr):
+            err.print_info()
+        reason, error = 'error', err.msg
+    except AssertionError:
+        pc = emulator.program_counter
+        symbol = emulator.compiled_program.symbol_text(pc)
+        reason, error = 'error', f'assertion at PC {pc} ({symbol})'
+    wall_time = time.perf_counter() - start_time
+
+    stats: typ.Dict[str, typ.Union[int, float, str, None]] = {
+        'steps': emulator.step_count,
+        'wall_time': wall_time,
+        'instructions_per_second': (
+            emulator.step_count / wall_time if wall_time > 0 else None
+        ),
+        'stop_reason': reason,
+        'error': error,
+    }
+
+    if args.json:
+        json.dump({'outputs': emulator.outputs, 'stats': stats}, sys.stdout)
+        print()
+    else:
+        print(' '.join(str(output) for output in emulator.outputs))
+        if args.stats:
+            print(f"steps:       {stats['steps']}")
+            print(f"wall time:   {wall_time:.3f}s")
+            if stats['instructions_per_second'] is not None:
+                print(f"instr/sec:   {stats['instructions_per_second']:.0f}")
+            print(f"stop reason: {reason}")
+        if error is not None:
+            print(f'Error: {error}', file=sys.stderr)
+
+    return 0 if reason != 'error' else 1
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog='python -m emu')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='run a program headlessly')
+    run_parser.add_argument(
+        'program', help='path to xasm source or an object file'
+    )
+    run_parser.add_argument(
+        '--no-cache', action='store_true',
+        help="always assemble, and don't store the result in the build cache"
+    )
+    run_parser.add_argument(
+        '--max-steps', type=int, default=None,
+        help='stop after this many instructions'
+    )
+    run_parser.add_argument(
+        '--stats', action='store_true', help='print execution statistics'
+    )
+    run_parser.add_argument(
+        '--json', action='store_true',
+        help='print outputs and statistics as a json object'
+    )
+    run_parser.add_argument(
+        '--input', default=None,
+        help='file of whitespace separated words to feed as input'
+    )
+
+    args = parser.parse_args()
+    if args.max_steps is not None and args.max_steps < 0:
+        run_parser.error('--max-steps must not be negative')
+    if args.command == 'run':
+        sys.exit(run_program(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,353 @@
+import argparse
+import asyncio
+import socket
+import struct
+import sys
+import typing as typ
+
+from asm.assembler import AssemblyError, LinkTimeError, load_program
+from asm.object_file import ObjectFileError
+
+from .debugger import Debugger, SimpleBreakpoint
+from .emulator import Emulator, StopReason
+
+# Every message in either direction is a 4 byte big endian length followed by
+# that many bytes. Requests start with a command byte, responses with a
+# status byte (0 for success, otherwise the rest is a utf-8 error message).
+# Integers are big endian; addresses and lengths are 4 bytes.
+#
+#   STEP count:u32             -> reason:u8 registers
+#   CONTINUE max_steps:u32     -> reason:u8 registers (0 for no limit)
+#   ADD_BREAKPOINT address     -> (empty)
+#   REMOVE_BREAKPOINT address  -> (empty)
+#   REGISTERS                  -> registers
+#   READ_MEMORY start length   -> raw words, one per byte
+#   WRITE_MEMORY start words   -> (empty)
+#   OUTPUTS start:u32          -> outputs from index start, newline separated
+#   INTERRUPT                  -> (empty), stops a running CONTINUE; best
+#                                 sent on a second connection
+#
+# where registers is pc:u32 a:u8 input_ready:u8 step:u64
+
+STEP = 1
+CONTINUE = 2
+ADD_BREAKPOINT = 3
+REMOVE_BREAKPOINT = 4
+REGISTERS = 5
+READ_MEMORY = 6
+WRITE_MEMORY = 7
+OUTPUTS = 8
+INTERRUPT = 9
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+STOP_REASON_CODES = {
+    StopReason.HALTED: 0,
+    StopReason.MAX_STEPS: 1,
+    StopReason.BREAKPOINT: 2,
+    StopReason.REQUESTED: 3,
+}
+
+REGISTERS_FORMAT = '>IBBQ'
+MEMORY_SIZE = 2 ** 18
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class ProgramError(Exception):
+    # the emulated program went wrong while running a request
+    pass
+
+
+class DebugServer:
+    def __init__(self, debugger: Debugger):
+        self.debugger = debugger
+        self.emu = debugger.emu
+        # the emulator is only touched by one request at a time
+        self.lock = asyncio.Lock()
+        # INTERRUPTs received so far, on any connection
+        self.interrupts = 0
+
+    def registers(self) -> bytes:
+        return struct.pack(
+            REGISTERS_FORMAT, self.emu.program_counter, self.emu.a_register,
+            self.emu.input_ready_flag, self.emu.step_count
+        )
+
+    @staticmethod
+    def check_range(start: int, length: int) -> None:
+        if start < 0 or length < 0 or start + length > MEMORY_SIZE:
+            raise ProtocolError(f'Bad memory range {start}+{length}')
+
+    async def run(self, max_steps: typ.Optional[int]) -> bytes:
+        # runs in a worker thread so that INTERRUPT can still be received
+        try:
+            reason = await asyncio.to_thread(
+                self.debugger.run_for, max_steps
+            )
+        except LinkTimeError as err:
+            # errors triggered through a traceback at runtime
+            raise ProgramError(err.msg)
+        except AssertionError:
+            # like bad permissions or an unknown opcode
+            pc = self.emu.program_counter
+            symbol = self.emu.compiled_program.symbol_text(pc)
+            raise ProgramError(f'Assertion at PC {pc} ({symbol})')
+        finally:
+            self.debugger.flush_trace_buffer()
+        return bytes([STOP_REASON_CODES[reason]]) + self.registers()
+
+    async def handle_request(self, request: bytes) -> bytes:
+        if len(request) == 0:
+            raise ProtocolError('Empty request')
+        command, body = request[0], request[1:]
+
+        if command == STEP:
+            count, = struct.unpack('>I', body)
+            return await self.run(count)
+        elif command == CONTINUE:
+            max_steps, = struct.unpack('>I', body)
+            return await self.run(max_steps if max_steps else None)
+        elif command == ADD_BREAKPOINT:
+            address, = struct.unpack('>I', body)
+            self.check_range(address, 1)
+            self.debugger.breakpoints.append(SimpleBreakpoint(address))
+            self.debugger.compile_breakpoints()
+            return b''
+        elif command == REMOVE_BREAKPOINT:
+            address, = struct.unpack('>I', body)
+            self.debugger.breakpoints = [
+                bp for bp in self.debugger.breakpoints if bp.pc != address
+            ]
+            self.debugger.compile_breakpoints()
+            return b''
+        elif command == REGISTERS:
+            return self.registers()
+        elif command == READ_MEMORY:
+            start, length = struct.unpack('>II', body)
+            self.check_range(start, length)
+            return bytes(self.emu.memory[start:start + length])
+        elif command == WRITE_MEMORY:
+            start, = struct.unpack('>I', body[:4])
+            words = body[4:]
+            self.check_range(start, len(words))
+            if any(word >= 64 for word in words):
+                raise ProtocolError('Words must be less than 64')
+            self.emu.memory[start:start + len(words)] = words
+            self.debugger.discard_history_after_edit()
+            return b''
+        elif command == OUTPUTS:
+            start, = struct.unpack('>I', body)
+            return '\n'.join(
+                str(output) for output in self.emu.outputs[start:]
+            ).encode()
+        else:
+            raise ProtocolError(f'Unknown command {command}')
+
+    async def respond(
+        self, request: bytes, writer: asyncio.StreamWriter,
+        interrupts_before: int
+    ) -> None:
+        try:
+            async with self.lock:
+                # an INTERRUPT from before the request arrived was for
+                # earlier ones, but a later one stops it
+                if self.interrupts == interrupts_before:
+                    self.emu.interrupt_requested = False
+                response = bytes([STATUS_OK]) + await self.handle_request(
+                    request
+                )
+        except (ProtocolError, ProgramError, struct.error) as err:
+            response = bytes([STATUS_ERROR]) + str(err).encode()
+
+        writer.write(struct.pack('>I', len(response)) + response)
+        await writer.drain()
+
+    async def handle_connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        pending: typ.Optional[asyncio.Task[None]] = None
+        try:
+            while True:
+                length, = struct.unpack('>I', await reader.readexactly(4))
+                request = await reader.readexactly(length)
+
+                if request == bytes([INTERRUPT]):
+                    # handled straight away, even while a run is going, so
+                    # its response can overtake those of earlier requests
+                    self.interrupts += 1
+                    self.emu.interrupt_requested = True
+                    writer.write(struct.pack('>IB', 1, STATUS_OK))
+                    await writer.drain()
+                    continue
+
+                # responses are sent in the order requests arrived
+                if pending is not None:
+                    await pending
+                pending = asyncio.create_task(
+                    self.respond(request, writer, self.interrupts)
+                )
+        except asyncio.IncompleteReadError:
+            pass
+        finally:
+            if pending is not None:
+                await pending
+            writer.close()
+
+
+class DebugClient:
+    # A minimal blocking client, for scripts
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+
+    @staticmethod
+    def connect_tcp(host: str, port: int) -> 'DebugClient':
+        return DebugClient(socket.create_connection((host, port)))
+
+    @staticmethod
+    def connect_unix(path: str) -> 'DebugClient':
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+        return DebugClient(sock)
+
+    def receive_exactly(self, length: int) -> bytes:
+        chunks = []
+        while length:
+            chunk = self.sock.recv(length)
+            if not chunk:
+                raise ConnectionError('Debug server closed the connection')
+            chunks.append(chunk)
+            length -= len(chunk)
+        return b''.join(chunks)
+
+    def send(self, command: int, body: bytes = b'') -> None:
+        message = bytes([command]) + body
+        self.sock.sendall(struct.pack('>I', len(message)) + message)
+
+    def receive(self) -> bytes:
+        length, = struct.unpack('>I', self.receive_exactly(4))
+        response = self.receive_exactly(length)
+        if response[0] != STATUS_OK:
+            raise ProtocolError(response[1:].decode())
+        return response[1:]
+
+    def request(self, command: int, body: bytes = b'') -> bytes:
+        self.send(command, body)
+        return self.receive()
+
+    @staticmethod
+    def run_result(
+        response: bytes
+    ) -> typ.Tuple[StopReason, typ.Tuple[int, int, int, int]]:
+        # from the response to STEP or CONTINUE
+        reasons = {code: reason for reason, code in STOP_REASON_CODES.items()}
+        registers = struct.unpack(REGISTERS_FORMAT, response[1:])
+        return reasons[response[0]], registers
+
+    def run_request(
+        self, command: int, count: int
+    ) -> typ.Tuple[StopReason, typ.Tuple[int, int, int, int]]:
+        return self.run_result(
+            self.request(command, struct.pack('>I', count))
+        )
+
+    def step(self, count: int = 1) -> typ.Tuple[
+        StopReason, typ.Tuple[int, int, int, int]
+    ]:
+        return self.run_request(STEP, count)
+
+    def resume(self, max_steps: int = 0) -> typ.Tuple[
+        StopReason, typ.Tuple[int, int, int, int]
+    ]:
+        return self.run_request(CONTINUE, max_steps)
+
+    def add_breakpoint(self, address: int) -> None:
+        self.request(ADD_BREAKPOINT, struct.pack('>I', address))
+
+    def remove_breakpoint(self, address: int) -> None:
+        self.request(REMOVE_BREAKPOINT, struct.pack('>I', address))
+
+    def registers(self) -> typ.Tuple[int, int, int, int]:
+        # pc, a, input_ready, step
+        return struct.unpack(REGISTERS_FORMAT, self.request(REGISTERS))
+
+    def read_memory(self, start: int, length: int) -> bytes:
+        return self.request(READ_MEMORY, struct.pack('>II', start, length))
+
+    def write_memory(self, start: int, words: bytes) -> None:
+        self.request(WRITE_MEMORY, struct.pack('>I', start) + words)
+
+    def outputs(self, start: int = 0) -> typ.List[str]:
+        text = self.request(OUTPUTS, struct.pack('>I', start)).decode()
+        return text.split('\n') if text else []
+
+    def interrupt(self) -> None:
+        self.request(INTERRUPT)
+
+    def close(self) -> None:
+        self.sock.close()
+
+
+async def serve(
+    debugger: Debugger, host: str, port: typ.Optional[int],
+    unix_path: typ.Optional[str]
+) -> None:
+    server = DebugServer(debugger)
+    if unix_path is not None:
+        listener = await asyncio.start_unix_server(
+            server.handle_connection, unix_path
+        )
+        print(f'Debug server listening on {unix_path}')
+    else:
+        listener = await asyncio.start_server(
+            server.handle_connection, host, port
+        )
+        bound_port = listener.sockets[0].getsockname()[1]
+        print(f'Debug server listening on {host}:{bound_port}')
+    sys.stdout.flush()
+
+    async with listener:
+        await listener.serve_forever()
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(prog='python -m emu.debug_server')
+    arg_parser.add_argument(
+        'program', help='path to xasm source or an object file'
+    )
+    arg_parser.add_argument(
+        '--no-cache', action='store_true',
+        help="always assemble, and don't store the result in the build cache"
+    )
+    arg_parser.add_argument('--host', default='127.0.0.1')
+    arg_parser.add_argument(
+        '--port', type=int, default=0, help='TCP port (0 picks a free one)'
+    )
+    arg_parser.add_argument(
+        '--unix', default=None, help='listen on this unix socket path instead'
+    )
+    cli_args = arg_parser.parse_args()
+
+    try:
+        compiled = load_program(cli_args.program, not cli_args.no_cache)
+    except AssemblyError as err:
+        err.print_info()
+        sys.exit(1)
+    except ObjectFileError as err:
+        print(f'Error: {err}')
+        sys.exit(1)
+
+    debugger = Debugger(Emulator(compiled, False))
+    try:
+        asyncio.run(
+            serve(debugger, cli_args.host, cli_args.port, cli_args.unix)
+        )
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,18 @@
 import abc
+import argparse
+import contextlib
 import enum
+import io
+import operator
 import sys
 import typing as typ
 
-from asm.assembler import Assembler, AssemblyError
+from asm.assembler import AssemblyError, load_program
+from asm.object_file import ObjectFileError
 
-from .emulator import Emulator
+from .emulator import Emulator, PcHooks, StopReason
+from .snapshots import SnapshotStore
+from .trace_store import TraceStore
 
 
 class RunState(enum.Enum):
@@ -15,9 +22,16 @@ class RunState(enum.Enum):
 
 
 class Breakpoint(abc.ABC):
+    # breakpoints are only checked when the PC reaches this address
+    pc: int
+
     @abc.abstractmethod
     def is_triggered(self, emu: 'Emulator') -> bool: pass
 
+    # like is_triggered, but without side effects such as counting hits
+    @abc.abstractmethod
+    def condition_holds(self, emu: 'Emulator') -> bool: pass
+
     @abc.abstractmethod
     def stringify(self, debugger: 'Debugger') -> str: pass
 
@@ -30,17 +44,138 @@ class SimpleBreakpoint(Breakpoint):
     def is_triggered(self, emu: 'Emulator') -> bool:
         return emu.program_counter == self.pc
 
-    def stringify(self, debugger: 'Debugger') -> str:
+    def condition_holds(self, emu: 'Emulator') -> bool:
+        return emu.program_counter == self.pc
+
+    def location_text(self, debugger: 'Debugger') -> str:
         if self.pc in debugger.emu.compiled_program.address_to_labels:
             labels = debugger.emu.compiled_program.address_to_labels[self.pc]
             label_text = ' (' + ', '.join(labels) + ')'
         else:
             label_text = ''
-        return f'simple, {debugger.memory_info(self.pc)}' + label_text
+        return debugger.memory_info(self.pc) + label_text
+
+    def stringify(self, debugger: 'Debugger') -> str:
+        return f'simple, {self.location_text(debugger)}'
+
+
+CONDITION_OPERATORS: typ.Dict[str, typ.Callable[[int, int], bool]] = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+
+class ConditionalBreakpoint(SimpleBreakpoint):
+    def __init__(
+        self, pc: int, address: typ.Optional[int],
+        op: typ.Optional[str], value: int, hit_target: int
+    ):
+        # address is the memory word to compare, or None for the A register
+        super().__init__(pc)
+        self.address = address
+        self.op = op
+        self.value = value
+        self.hit_target = hit_target
+        self.hits = 0
+
+    def condition_holds(self, emu: 'Emulator') -> bool:
+        if emu.program_counter != self.pc:
+            return False
+
+        if self.op is not None:
+            if self.address is None:
+                lhs = emu.a_register
+            else:
+                lhs = emu.memory[self.address]
+
+            if not CONDITION_OPERATORS[self.op](lhs, self.value):
+                return False
+
+        return True
+
+    def is_triggered(self, emu: 'Emulator') -> bool:
+        if not self.condition_holds(emu):
+            return False
+
+        self.hits += 1
+        return self.hits >= self.hit_target
+
+    def stringify(self, debugger: 'Debugger') -> str:
+        text = f'conditional, {self.location_text(debugger)}'
+        if self.op is not None:
+            if self.address is None:
+                lhs = 'A'
+            else:
+                lhs = debugger.memory_info(self.address)
+            text += f' if {lhs} {self.op} {self.value}'
+        if self.hit_target > 1:
+            text += f' (hit {self.hits}/{self.hit_target})'
+        return text
+
+
+class Tracepoint:
+    # Logs values whenever the PC reaches an address, without stopping.
+    # Items are 'a', 'pc', 'step', 'label' or a memory address.
+    def __init__(self, pc: int, items: typ.List[typ.Union[str, int]]):
+        self.pc = pc
+        self.items = items
+
+    def capture(self, emu: 'Emulator') -> typ.Tuple[int, ...]:
+        values = []
+        for item in self.items:
+            if item == 'a':
+                values.append(emu.a_register)
+            elif item == 'step':
+                values.append(emu.step_count)
+            elif isinstance(item, int):
+                values.append(emu.memory[item])
+        return tuple(values)
+
+    def format(
+        self, debugger: 'Debugger', captured: typ.Tuple[int, ...]
+    ) -> str:
+        parts = []
+        values = iter(captured)
+        for item in self.items:
+            if item == 'pc':
+                parts.append(f'PC = {self.pc}')
+            elif item == 'label':
+                symbol = debugger.emu.compiled_program.symbol_text(self.pc)
+                parts.append(':' + symbol)
+            elif isinstance(item, int):
+                parts.append(f'[{item}] = {next(values)}')
+            else:
+                parts.append(f'{item} = {next(values)}')
+        return f'Trace @{self.pc}: ' + '  '.join(parts)
+
+    def stringify(self, debugger: 'Debugger') -> str:
+        items = ', '.join(str(item) for item in self.items)
+        return f'trace {debugger.memory_info(self.pc)}: {items}'
+
+
+class Watchpoint:
+    def __init__(self, address: int, only_changes: bool):
+        self.address = address
+        self.only_changes = only_changes
+
+    def stringify(self, debugger: 'Debugger') -> str:
+        labels = debugger.emu.compiled_program.address_to_labels.get(
+            self.address, []
+        )
+        label_text = ' (' + ', '.join(labels) + ')' if labels else ''
+        kind = 'changes to' if self.only_changes else 'writes to'
+        return f'{kind} {debugger.memory_info(self.address)}' + label_text
 
 
 class Debugger:
-    def __init__(self, emu: Emulator):
+    def __init__(
+        self, emu: Emulator, snapshot_interval: int = 100_000,
+        snapshot_budget: int = 64 * 2 ** 20
+    ):
         self.emu = emu
         self.running_state = RunState.PAUSED
         self.last_command = ''
@@ -48,7 +183,34 @@ class Debugger:
         self.pause_on_output = False
         self.breakpoints: typ.List[Breakpoint] = []
 
+        # breakpoints grouped by PC, so that the emulator only has to do a
+        # single lookup per instruction
+        self.breakpoint_hooks: PcHooks = {}
+        self.triggered_breakpoints: typ.List[Breakpoint] = []
+        self.watchpoints: typ.Dict[int, Watchpoint] = {}
+        self.trace_store: typ.Optional[TraceStore] = None
+        self.tracepoints: typ.List[Tracepoint] = []
+        # values captured by tracepoints, printed when execution stops
+        self.trace_buffer: typ.List[
+            typ.Tuple[Tracepoint, typ.Tuple[int, ...]]
+        ] = []
+        self.assertion_failed = False
+        # extra places to stop at for the next continue, and whether it did
+        self.stop_pcs: typ.Set[int] = set()
+        self.stop_pc_reached = False
+
+        # for reverse execution; replaying is set while re-running history
+        # (which shouldn't print anything), and reverse_hits collects the
+        # steps at which breakpoints or watchpoints would have triggered
+        # Each snapshot keeps the breakpoint hit counts from then, which
+        # replaying brings up to date as it goes.
+        self.snapshots = SnapshotStore(snapshot_interval, snapshot_budget)
+        self.snapshots.record(emu, {})
+        self.replaying = False
+        self.reverse_hits: typ.Optional[typ.List[int]] = None
+
         emu.output_handler = self.on_output
+        emu.watch_handler = self.on_watched_write
 
     def exit(self) -> typ.NoReturn:
         sys.exit(0)
@@ -59,9 +221,74 @@ class Debugger:
         if compiled is not None:
             traceback = compiled.traceback.get_deepst_non_internal()
             return traceback.last_global_label
+
+        # no traceback for this address, so use the nearest label instead
+        symbol = self.emu.compiled_program.symbolize(self.emu.program_counter)
+        if symbol is not None:
+            label, offset = symbol
+            return label.split('.', 1)[0]
         else:
             return None
 
+    def is_function_entry(self, address: int) -> bool:
+        # functions called with CALL have a return address stored at
+        # <function>.ret_hi
+        labels = self.emu.compiled_program.labels
+        return any(
+            f'{label}.ret_hi' in labels
+            for label in self.emu.compiled_program.address_to_labels.get(
+                address, []
+            )
+        )
+
+    def function_return_address(self) -> typ.Optional[int]:
+        function_label = self.current_global_label()
+        if function_label is None:
+            return None
+
+        labels = self.emu.compiled_program.labels
+        words = []
+        for part in ('ret_hi', 'ret_mid', 'ret_low'):
+            label = f'{function_label}.{part}'
+            if label not in labels:
+                return None
+            words.append(self.emu.memory[labels[label]])
+
+        return self.emu.words_to_int(words)
+
+    def line_stop_addresses(self) -> typ.Set[int]:
+        # Where to stop to step over the current source line: the end of its
+        # expansion, or anywhere it jumps to other than into a function, so
+        # that a CALL is run as one unit but a loop or RETURN is followed.
+        program = self.emu.compiled_program
+        start = self.emu.program_counter
+        compiled = program.data[start]
+        if compiled is None:
+            return {start + 4}
+        line = compiled.traceback.get_deepst_non_internal()
+
+        end = start
+        stops: typ.Set[int] = set()
+        while True:
+            word = program.data[end] if end < 2 ** 18 else None
+            if (
+                word is None or
+                word.traceback.get_deepst_non_internal() is not line
+            ):
+                break
+
+            opcode = self.emu.memory[end]
+            if end % 4 == 0 and opcode in (0b001100, 0b001010, 0b001001):
+                target = self.emu.words_to_int(
+                    list(self.emu.memory[end + 1:end + 4])
+                )
+                if not self.is_function_entry(target):
+                    stops.add(target)
+            end += 4
+
+        stops.add(end)
+        return stops
+
     def decode_address(self, address_string: str) -> typ.Optional[int]:
         parts = address_string.replace(',', ' ').split(' ')
         parts = [part for part in parts if part]
@@ -109,10 +336,212 @@ class Debugger:
 
         return None
 
+    def make_breakpoint_hook(
+        self, breakpoints: typ.List[Breakpoint],
+        tracepoints: typ.List[Tracepoint]
+    ) -> typ.Callable[[], bool]:
+        def hook() -> bool:
+            for tracepoint in tracepoints:
+                self.trace_buffer.append(
+                    (tracepoint, tracepoint.capture(self.emu))
+                )
+
+            triggered = [bp for bp in breakpoints if bp.is_triggered(self.emu)]
+            self.triggered_breakpoints.extend(triggered)
+            return len(triggered) > 0
+
+        return hook
+
+    def compile_breakpoints(self) -> None:
+        # also covers tracepoints, which are hooks that never stop
+        by_pc: typ.Dict[
+            int, typ.Tuple[typ.List[Breakpoint], typ.List[Tracepoint]]
+        ] = {}
+        for bp in self.breakpoints:
+            by_pc.setdefault(bp.pc, ([], []))[0].append(bp)
+        for tracepoint in self.tracepoints:
+            by_pc.setdefault(tracepoint.pc, ([], []))[1].append(tracepoint)
+
+        self.breakpoint_hooks = {
+            pc: self.make_breakpoint_hook(breakpoints, tracepoints)
+            for pc, (breakpoints, tracepoints) in by_pc.items()
+        }
+
+    def add_tracepoint(self, args: typ.List[str]) -> None:
+        # trace <address> [a] [pc] [step] [label] [*<address>]...
+        keywords = ('a', 'pc', 'step', 'label')
+        address_args = []
+        while args and args[0] not in keywords and args[0][:1] != '*':
+            address_args.append(args.pop(0))
+
+        pc = self.decode_address(' '.join(address_args))
+        if pc is None:
+            return
+
+        items: typ.List[typ.Union[str, int]] = []
+        for arg in args or ['a']:
+            if arg in keywords:
+                items.append(arg)
+            elif arg.startswith('*'):
+                address = self.decode_address(arg[1:])
+                if address is None:
+                    return
+                items.append(address)
+            else:
+                print("Can't trace", arg)
+                return
+
+        tracepoint = Tracepoint(pc, items)
+        self.tracepoints.append(tracepoint)
+        self.compile_breakpoints()
+        print('New tracepoint:', tracepoint.stringify(self))
+
+    def flush_trace_buffer(self) -> None:
+        if self.trace_buffer:
+            print('\n'.join(
+                tracepoint.format(self, captured)
+                for tracepoint, captured in self.trace_buffer
+            ))
+            self.trace_buffer = []
+
+    def add_breakpoint(self, args: typ.List[str]) -> None:
+        # b <address> [if <a|*address> <op> <value>] [hits <n>]
+        hit_target = 1
+        if 'hits' in args:
+            hits_index = args.index('hits')
+            try:
+                hit_target, = [int(arg) for arg in args[hits_index + 1:]]
+            except ValueError:
+                print('Expected a single hit count')
+                return
+            if hit_target < 1:
+                print('Expected a hit count of at least 1')
+                return
+            args = args[:hits_index]
+
+        condition: typ.Optional[typ.List[str]] = None
+        if 'if' in args:
+            if_index = args.index('if')
+            condition = args[if_index + 1:]
+            args = args[:if_index]
+
+        pc = self.decode_address(' '.join(args))
+        if pc is None:
+            return
+
+        bp: Breakpoint
+        if condition is None and hit_target == 1:
+            bp = SimpleBreakpoint(pc)
+        elif condition is None:
+            bp = ConditionalBreakpoint(pc, None, None, 0, hit_target)
+        else:
+            if len(condition) != 3 or condition[1] not in CONDITION_OPERATORS:
+                print('Expected condition like `a == 5` or `*:label != 0`')
+                return
+            lhs, op, rhs = condition
+
+            address: typ.Optional[int]
+            if lhs.lower() == 'a':
+                address = None
+            elif lhs.startswith('*'):
+                address = self.decode_address(lhs[1:])
+                if address is None:
+                    return
+            else:
+                print("Can't compare", lhs)
+                return
+
+            try:
+                value = int(rhs, base=0)
+            except ValueError:
+                print("Can't decode value", rhs)
+                return
+
+            bp = ConditionalBreakpoint(pc, address, op, value, hit_target)
+
+        self.breakpoints.append(bp)
+        self.compile_breakpoints()
+        print('New breakpoint:', bp.stringify(self))
+
+    def add_watchpoint(self, args: typ.List[str]) -> None:
+        # watch <address> [changes]
+        only_changes = len(args) > 0 and args[-1] == 'changes'
+        if only_changes:
+            args = args[:-1]
+
+        address = self.decode_address(' '.join(args))
+        if address is None:
+            return
+
+        watchpoint = Watchpoint(address, only_changes)
+        self.watchpoints[address] = watchpoint
+        self.emu.write_watch[address] = 1
+        print('New watchpoint:', watchpoint.stringify(self))
+
+    def remove_watchpoint(self, args: typ.List[str]) -> None:
+        address = self.decode_address(' '.join(args))
+        if address is None:
+            return
+
+        if address not in self.watchpoints:
+            print('No watchpoint at', self.memory_info(address))
+            return
+
+        del self.watchpoints[address]
+        self.emu.write_watch[address] = 0
+
+    def set_recording(self, args: typ.List[str]) -> None:
+        if args == ['on']:
+            self.trace_store = TraceStore(self.emu.step_count)
+            self.emu.access_recorder = self.trace_store.record
+            print('Recording memory accesses from step', self.emu.step_count)
+        elif args == ['off']:
+            self.emu.access_recorder = None
+            print('Stopped recording memory accesses')
+        else:
+            print('Expected `record on` or `record off`')
+
+    def find_last_access(self, args: typ.List[str], is_write: bool) -> None:
+        # lastwrite/lastread <address> [before <step>]
+        before_step = self.emu.step_count
+        if 'before' in args:
+            before_index = args.index('before')
+            try:
+                before_step = int(' '.join(args[before_index + 1:]))
+            except ValueError:
+                print('Expected step number')
+                return
+            args = args[:before_index]
+
+        address = self.decode_address(' '.join(args))
+        if address is None:
+            return
+
+        if self.trace_store is None:
+            print('Not recording, use `record on` first')
+            return
+
+        access = self.trace_store.last_access(address, before_step, is_write)
+        kind = 'written' if is_write else 'read'
+        if access is None:
+            print(
+                f'{self.memory_info(address)} not {kind} between steps '
+                f'{self.trace_store.first_step} and {before_step}'
+            )
+            return
+
+        step, pc = access
+        print(
+            f'{self.memory_info(address)} last {kind} before step '
+            f'{before_step} at step {step} by PC = {self.memory_info(pc)}'
+        )
+        self.traceback_word(pc, False)
+
     def memory_info(self, address: int) -> str:
         as_words = self.emu.int_to_words(address, 3)
         value = self.emu.memory[address]
-        return f'<{address}; {as_words} = {value}>'
+        symbol = self.emu.compiled_program.symbol_text(address)
+        return f'<{address} {symbol}; {as_words} = {value}>'
 
     def traceback_word(self, address: int, full: bool) -> None:
         compiled_word = self.emu.compiled_program.data[address]
@@ -134,6 +563,7 @@ class Debugger:
 
         print(f'PC = {self.memory_info(program_counter)}\t', end='')
         print(f'A = {self.emu.a_register} ', end='')
+        print(f'\tstep = {self.emu.step_count}', end='')
         print()
         print(end='\t')
 
@@ -179,6 +609,24 @@ class Debugger:
             self.running_state = RunState.SINGLE_SHOT
         elif command in ('c', 'continue'):
             self.running_state = RunState.RUNNING
+        elif command in ('n', 'next'):
+            self.stop_pcs = self.line_stop_addresses()
+            self.running_state = RunState.RUNNING
+        elif command in ('u', 'until'):
+            address = self.decode_address(' '.join(args))
+
+            if address is not None:
+                self.stop_pcs = {address}
+                self.running_state = RunState.RUNNING
+        elif command in ('fin', 'finish'):
+            address = self.function_return_address()
+
+            if address is None:
+                print('Not in a function called with CALL')
+            else:
+                print('Run until return to', self.memory_info(address))
+                self.stop_pcs = {address}
+                self.running_state = RunState.RUNNING
         elif command in ('i', 'inspect'):
             address = self.decode_address(' '.join(args))
 
@@ -186,12 +634,75 @@ class Debugger:
                 self.traceback_word(address, True)
                 print(self.memory_info(address))
         elif command in ('b', 'breakpoint'):
-            address = self.decode_address(' '.join(args))
-
-            if address is not None:
-                bp = SimpleBreakpoint(address)
-                self.breakpoints.append(bp)
-                print('New breakpoint:', bp.stringify(self))
+            self.add_breakpoint(args)
+        elif command in ('bl', 'breakpoints'):
+            for bp_num, bp in enumerate(self.breakpoints):
+                print(f'{bp_num:3}: {bp.stringify(self)}')
+        elif command in ('d', 'delete'):
+            try:
+                del self.breakpoints[int(' '.join(args))]
+            except (ValueError, IndexError):
+                print('Expected breakpoint number')
+            self.compile_breakpoints()
+        elif command in ('t', 'trace'):
+            self.add_tracepoint(args)
+        elif command in ('tl', 'tracepoints'):
+            for trace_num, tracepoint in enumerate(self.tracepoints):
+                print(f'{trace_num:3}: {tracepoint.stringify(self)}')
+        elif command in ('ut', 'untrace'):
+            try:
+                del self.tracepoints[int(' '.join(args))]
+            except (ValueError, IndexError):
+                print('Expected tracepoint number')
+            self.compile_breakpoints()
+        elif command in ('w', 'watch'):
+            self.add_watchpoint(args)
+        elif command in ('uw', 'unwatch'):
+            self.remove_watchpoint(args)
+        elif command in ('wl', 'watchpoints'):
+            for watchpoint in self.watchpoints.values():
+                print(watchpoint.stringify(self))
+        elif command in ('rs', 'reverse-step'):
+            if self.emu.step_count == 0:
+                print('Already at the start of execution')
+            else:
+                self.goto_step(self.emu.step_count - 1)
+                self.print_current_instruction(full_traceback=False)
+        elif command in ('rc', 'reverse-continue'):
+            try:
+                self.reverse_continue()
+            except KeyboardInterrupt:
+                print('Reverse continue interrupted')
+            self.print_current_instruction(full_traceback=False)
+        elif command == 'goto':
+            try:
+                target_step = int(' '.join(args))
+            except ValueError:
+                print('Expected step number')
+            else:
+                try:
+                    self.goto_step(target_step)
+                except KeyboardInterrupt:
+                    print('Goto interrupted')
+                self.print_current_instruction(full_traceback=False)
+        elif command == 'record':
+            self.set_recording(args)
+        elif command in ('lw', 'lastwrite'):
+            self.find_last_access(args, True)
+        elif command in ('lr', 'lastread'):
+            self.find_last_access(args, False)
+        elif command == 'snapshots':
+            print(
+                f'{len(self.snapshots.steps)} snapshots using '
+                f'{self.snapshots.total_size} bytes, at steps',
+                ', '.join(str(step) for step in self.snapshots.steps)
+            )
+        elif command == 'x':
+            self.dump_memory(args)
+        elif command == 'assert':
+            self.check_assertion(args)
+        elif command in ('q', 'quit'):
+            self.exit()
         elif command == '.':
             self.print_current_instruction(full_traceback=True)
         else:
@@ -214,14 +725,109 @@ class Debugger:
         else:
             self.last_command = command
 
+        self.handle_command_line(command)
+
+    def handle_command_line(self, command: str) -> None:
         splitted = command.split(' ')
         self.run_command(splitted[0], splitted[1:])
 
+    def check_assertion(self, args: typ.List[str]) -> None:
+        # assert <a|pc|step|*address> <op> <value>
+        if len(args) != 3 or args[1] not in CONDITION_OPERATORS:
+            print('Expected assertion like `a == 5` or `*:label != 0`')
+            self.assertion_failed = True
+            return
+        lhs_text, op, rhs_text = args
+
+        lhs: typ.Optional[int]
+        if lhs_text.lower() == 'a':
+            lhs = self.emu.a_register
+        elif lhs_text.lower() == 'pc':
+            lhs = self.emu.program_counter
+        elif lhs_text.lower() == 'step':
+            lhs = self.emu.step_count
+        elif lhs_text.startswith('*'):
+            address = self.decode_address(lhs_text[1:])
+            lhs = None if address is None else self.emu.memory[address]
+        else:
+            print("Can't check", lhs_text)
+            lhs = None
+
+        try:
+            rhs = int(rhs_text, base=0)
+        except ValueError:
+            rhs = self.decode_address(rhs_text)
+
+        if lhs is None or rhs is None:
+            self.assertion_failed = True
+        elif CONDITION_OPERATORS[op](lhs, rhs):
+            print(f'Assertion passed: {lhs_text} {op} {rhs_text}')
+        else:
+            print(f'Assertion failed: {lhs_text} = {lhs}, not {op} {rhs}')
+            self.assertion_failed = True
+
+    def dump_memory(self, args: typ.List[str]) -> None:
+        # x <address> [count]
+        count = 1
+        if len(args) > 1 and args[-1].isdigit():
+            count = int(args[-1])
+            args = args[:-1]
+
+        address = self.decode_address(' '.join(args))
+        if address is None:
+            return
+
+        for row_start in range(address, address + count, 16):
+            row_end = min(address + count, row_start + 16, 2 ** 18)
+            words = ' '.join(
+                f'{word:2}' for word in self.emu.memory[row_start:row_end]
+            )
+            print(f'{row_start:6}: {words}')
+
     def on_output(self, data: typ.Union[str, int]) -> None:
+        if self.replaying:
+            return
+
         print('Output:', data)
         if self.pause_on_output:
             print('Break due to output')
             self.running_state = RunState.PAUSED
+            self.emu.stop_requested = True
+
+    def on_watched_write(self, address: int, old: int, new: int) -> None:
+        watchpoint = self.watchpoints[address]
+        if watchpoint.only_changes and old == new:
+            return
+
+        if self.replaying:
+            if self.reverse_hits is not None:
+                # the write is visible once this instruction is done
+                self.reverse_hits.append(self.emu.step_count + 1)
+            return
+
+        print(
+            f'Break due to write of {old} -> {new} '
+            f'[{watchpoint.stringify(self)}] '
+            f'by PC = {self.memory_info(self.emu.program_counter)}'
+        )
+        self.running_state = RunState.PAUSED
+        self.emu.stop_requested = True
+
+    def make_stop_hook(
+        self, breakpoint_hook: typ.Optional[typ.Callable[[], bool]]
+    ) -> typ.Callable[[], bool]:
+        def hook() -> bool:
+            if breakpoint_hook is not None:
+                breakpoint_hook()
+            self.stop_pc_reached = True
+            return True
+
+        return hook
+
+    def report_breakpoints(self) -> None:
+        for bp in self.triggered_breakpoints:
+            print(f'Break due to [{bp.stringify(self)}]')
+        self.triggered_breakpoints = []
 
     def run_step(self) -> None:
         self.emu.step()
@@ -230,11 +836,218 @@ class Debugger:
             print('Break due to halt loop')
             self.running_state = RunState.PAUSED
 
+        hook = self.breakpoint_hooks.get(self.emu.program_counter)
+        if hook is not None and hook():
+            self.report_breakpoints()
+            self.running_state = RunState.PAUSED
+
+        # after the hook, so the snapshot has this step's hits
+        self.snapshots.record_if_on_boundary(self.emu, self.hit_counts())
+
+    def run_for(self, max_steps: typ.Optional[int] = None) -> StopReason:
+        pc_hooks = self.breakpoint_hooks
+        if self.stop_pcs:
+            # temporary stops for finish, until and next, which still let any
+            # breakpoints at the same address report themselves
+            pc_hooks = dict(pc_hooks)
+            for pc in self.stop_pcs:
+                pc_hooks[pc] = self.make_stop_hook(pc_hooks.get(pc))
+            self.stop_pcs = set()
+        self.stop_pc_reached = False
+
+        end_step = None
+        if max_steps is not None:
+            end_step = self.emu.step_count + max_steps
+
+        while True:
+            boundary = self.snapshots.next_boundary(self.emu.step_count)
+            if end_step is not None:
+                boundary = min(boundary, end_step)
+
+            reason = self.emu.run(
+                boundary - self.emu.step_count, pc_hooks
+            )
+            if reason != StopReason.MAX_STEPS:
+                break
+            self.snapshots.record_if_on_boundary(
+                self.emu, self.hit_counts()
+            )
+
+            if self.emu.step_count == end_step:
+                break
+
+        if reason == StopReason.HALTED:
+            print('Break due to halt loop')
+        elif reason == StopReason.REQUESTED and self.emu.interrupt_requested:
+            # set from another thread, e.g. by the debug server
+            print('Break due to interrupt')
+        elif reason == StopReason.BREAKPOINT:
+            self.report_breakpoints()
+            if self.stop_pc_reached:
+                # for next, until and finish
+                pc = self.emu.program_counter
+                print(f'Stopped at {self.memory_info(pc)}')
+
+        return reason
+
+    def run_continue(self) -> None:
+        self.run_for()
+        self.running_state = RunState.PAUSED
+
+    def discard_history_after_edit(self) -> None:
+        # after the emulator state is changed by hand, later history no
+        # longer matches what would be replayed
+        self.snapshots.discard_from(self.emu.step_count)
+        self.snapshots.record(self.emu, self.hit_counts())
+        if self.trace_store is not None:
+            self.trace_store = TraceStore(self.emu.step_count)
+            if self.emu.access_recorder is not None:
+                self.emu.access_recorder = self.trace_store.record
+
+    def hit_counts(self) -> typ.Dict[Breakpoint, int]:
+        return {
+            bp: bp.hits for bp in self.breakpoints
+            if isinstance(bp, ConditionalBreakpoint)
+        }
+
+    def restore_nearest(self, step: int) -> None:
+        # the latest snapshot at or before step, and the hit counts then
+        # (breakpoints added since start from none)
+        self.emu.restore_snapshot(self.snapshots.nearest(step))
+        hit_counts = self.snapshots.nearest_extra(step)
+        for bp in self.breakpoints:
+            if isinstance(bp, ConditionalBreakpoint):
+                bp.hits = hit_counts.get(bp, 0)
+
+    def breakpoints_by_pc(self) -> typ.Dict[int, typ.List[Breakpoint]]:
+        by_pc: typ.Dict[int, typ.List[Breakpoint]] = {}
         for bp in self.breakpoints:
-            if bp.is_triggered(self.emu):
-                print(f'Break due to [{bp.stringify(self)}]')
+            by_pc.setdefault(bp.pc, []).append(bp)
+        return by_pc
+
+    def make_counting_hook(
+        self, breakpoints: typ.List[Breakpoint]
+    ) -> typ.Callable[[], bool]:
+        # counts hits the way running would, but never stops
+        def hook() -> bool:
+            for bp in breakpoints:
+                bp.is_triggered(self.emu)
+            return False
+
+        return hook
+
+    def replay_to(
+        self, target_step: int, pc_hooks: typ.Optional[PcHooks] = None
+    ) -> None:
+        # run forward silently, without stopping at breakpoints (but still
+        # counting their hits)
+        if pc_hooks is None:
+            pc_hooks = {
+                pc: self.make_counting_hook(breakpoints)
+                for pc, breakpoints in self.breakpoints_by_pc().items()
+            }
+
+        self.replaying = True
+        try:
+            while self.emu.step_count < target_step:
+                boundary = min(
+                    target_step,
+                    self.snapshots.next_boundary(self.emu.step_count)
+                )
+                reason = self.emu.run(
+                    boundary - self.emu.step_count, pc_hooks
+                )
+                if reason != StopReason.MAX_STEPS:
+                    break
+                self.snapshots.record_if_on_boundary(
+                    self.emu, self.hit_counts()
+                )
+        finally:
+            self.replaying = False
+
+    def goto_step(self, target_step: int) -> None:
+        if target_step < self.emu.step_count:
+            self.restore_nearest(target_step)
+        self.replay_to(target_step)
+
+        if self.emu.step_count != target_step:
+            print(f'Stopped at step {self.emu.step_count} due to halt loop')
+
+    def find_reverse_hits(
+        self, start_step: int, end_step: int
+    ) -> typ.List[int]:
+        # replay from start_step to end_step and return every step at which
+        # a breakpoint condition held or a watchpoint was written
+        hits: typ.List[int] = []
+
+        def check(breakpoints: typ.List[Breakpoint]) -> None:
+            if any(bp.condition_holds(self.emu) for bp in breakpoints):
+                hits.append(self.emu.step_count)
+
+        def make_scan_hook(
+            breakpoints: typ.List[Breakpoint]
+        ) -> typ.Callable[[], bool]:
+            count_hits = self.make_counting_hook(breakpoints)
+
+            def hook() -> bool:
+                check(breakpoints)
+                return count_hits()
+
+            return hook
+
+        by_pc = self.breakpoints_by_pc()
+        scan_hooks = {
+            pc: make_scan_hook(breakpoints)
+            for pc, breakpoints in by_pc.items()
+        }
+
+        self.restore_nearest(start_step)
+        assert self.emu.step_count == start_step
+        # the snapshot already has any hits at its own step counted
+        check(by_pc.get(self.emu.program_counter, []))
+
+        self.reverse_hits = hits
+        try:
+            self.replay_to(end_step, scan_hooks)
+        finally:
+            self.reverse_hits = None
+
+        return hits
+
+    def reverse_continue(self) -> None:
+        current_step = self.emu.step_count
+        end_step = current_step
+
+        while end_step > 0:
+            start_step = self.snapshots.nearest(end_step - 1).step_count
+            hits = [
+                hit for hit in self.find_reverse_hits(start_step, end_step)
+                if hit < current_step
+            ]
+
+            if hits:
+                self.goto_step(max(hits))
+                print(f'Reverse break at step {self.emu.step_count}')
+                return
+
+            end_step = start_step
+
+        self.goto_step(0)
+        print('Reached the start of execution')
+
+    def resume(self) -> None:
+        if self.running_state == RunState.SINGLE_SHOT:
+            self.run_step()
+            self.running_state = RunState.PAUSED
+        elif self.running_state == RunState.RUNNING:
+            try:
+                self.run_continue()
+            except KeyboardInterrupt:
+                print('Break due to ^C')
                 self.running_state = RunState.PAUSED
 
+        self.flush_trace_buffer()
+
     def run(self) -> None:
         while True:
             self.prompt()
@@ -243,33 +1056,78 @@ class Debugger:
             if self.running_state == RunState.PAUSED:
                 self.prompted_from_pause = True
                 continue
-            elif self.running_state == RunState.SINGLE_SHOT:
-                self.run_step()
-                self.running_state = RunState.PAUSED
-            else:
-                try:
-                    while self.running_state == RunState.RUNNING:
-                        self.run_step()
-                except KeyboardInterrupt:
-                    print('Break due to ^C')
-                    self.running_state = RunState.PAUSED
+
+            self.resume()
+
+    def run_script(self, commands: typ.Iterable[str]) -> bool:
+        # Runs each command without prompting, stopping at the first failed
+        # assertion. Output is collected and written out in one go at the
+        # end. Returns whether all assertions passed.
+        output = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(output):
+                for command in commands:
+                    command = command.strip()
+                    if command == '' or command.startswith('#'):
+                        continue
+
+                    print(' dbg >>', command)
+                    self.handle_command_line(command)
+                    self.resume()
+
+                    if self.assertion_failed:
+                        break
+        finally:
+            sys.stdout.write(output.getvalue())
+            sys.stdout.flush()
+
+        return not self.assertion_failed
 
 
 if __name__ == '__main__':
-    if len(sys.argv) != 2:
-        print('Expected 1 arg for xasm path')
-        sys.exit(1)
+    arg_parser = argparse.ArgumentParser(prog='python -m emu.debugger')
+    arg_parser.add_argument(
+        'program', help='path to xasm source or an object file'
+    )
+    arg_parser.add_argument(
+        '--no-cache', action='store_true',
+        help="always assemble, and don't store the result in the build cache"
+    )
+    arg_parser.add_argument(
+        '--snapshot-interval', type=int, default=100_000,
+        help='steps between snapshots for reverse execution'
+    )
+    arg_parser.add_argument(
+        '--snapshot-budget', type=int, default=64,
+        help='megabytes of (compressed) snapshots to keep'
+    )
+    arg_parser.add_argument(
+        '--script', default=None,
+        help='file of debugger commands to run non-interactively'
+    )
+    cli_args = arg_parser.parse_args()
 
     print("Loading... ")
-    filename = sys.argv[1]
+    filename = cli_args.program
 
     try:
-        asm = Assembler()
-        asm.assemble_file(filename)
-        compiled = asm.link_data()
+        compiled = load_program(filename, not cli_args.no_cache)
 
         emulator = Emulator(compiled, False)
-        Debugger(emulator).run()
+        debugger = Debugger(
+            emulator, cli_args.snapshot_interval,
+            cli_args.snapshot_budget * 2 ** 20
+        )
+
+        if cli_args.script is not None:
+            with open(cli_args.script) as script_file:
+                script_lines = script_file.read().split('\n')
+            sys.exit(0 if debugger.run_script(script_lines) else 1)
+
+        debugger.run()
     except AssemblyError as err:
         err.print_info()
         sys.exit(1)
+    except ObjectFileError as err:
+        print(f'Error: {err}')
+        sys.exit(1)
@@ -1,5 +1,8 @@
+import collections
+import enum
 import string
 import typing as typ
+import zlib
 
 from asm.compiled import CompiledProgram
 
@@ -7,22 +10,68 @@ STRING_CHARS = string.ascii_uppercase + string.digits + '\n'
 assert len(STRING_CHARS) < 2**6
 
 
+class StopReason(enum.Enum):
+    HALTED = 'halted'
+    MAX_STEPS = 'max_steps'
+    BREAKPOINT = 'breakpoint'
+    REQUESTED = 'requested'
+
+
+PcHooks = typ.Dict[int, typ.Callable[[], bool]]
+
+
+class Snapshot:
+    # Everything needed to put an emulator back into an earlier state. The
+    # memory is compressed since it is mostly zeros.
+    def __init__(self, emu: 'Emulator'):
+        self.step_count = emu.step_count
+        self.memory = zlib.compress(emu.memory, 1)
+        self.registers = (
+            emu.program_counter, emu.a_register,
+            emu.memory_address_register, emu.input_register,
+            emu.input_ready_flag
+        )
+        self.input_queue = tuple(emu.input_queue)
+        self.num_outputs = len(emu.outputs)
+        self.partial_output = tuple(emu.partial_output)
+
+    @property
+    def size(self) -> int:
+        return len(self.memory)
+
+
 class Emulator:
     def __init__(self, program: CompiledProgram, verbose: bool):
-        self.memory = [0] * 2 ** 18
+        self.memory = bytearray(2 ** 18)
+        self.readable = bytearray(2 ** 18)
+        self.writable = bytearray(2 ** 18)
+        self.executable = bytearray(2 ** 18)
 
         self.compiled_program = program
         assert len(program.data) == len(self.memory)
-        for address, word in enumerate(program.data):
-            if word is None:
-                continue
-            self.memory[address] = word.value
+        program.load_into(
+            self.memory, self.readable, self.writable, self.executable
+        )
+        self.writable[0] = 0  # see write_ram
+
+        # an instruction can take the fast path in run() only if all four of
+        # its words can be fetched
+        self.fetchable = bytearray(2 ** 18)
+        for address in range(0, 2 ** 18, 4):
+            if all(self.executable[address:address + 4]):
+                self.fetchable[address] = 1
 
         self.program_counter = 0
         self.a_register = 0
         self.memory_address_register = 0
         self.input_register = 0
         self.input_ready_flag = 0
+        self.input_queue: typ.Deque[int] = collections.deque()
+        self.step_count = 0
+        self.stop_requested = False
+        # can be set from another thread to stop run() soon. Unlike
+        # stop_requested, run() never clears it; that's up to whoever sets it
+        self.interrupt_requested = False
 
         self.verbose = verbose
         self.outputs: typ.List[typ.Union[int, str]] = []
@@ -31,6 +80,32 @@ class Emulator:
         OutputHandlerType = typ.Callable[[typ.Union[str, int]], None]
         self.output_handler: OutputHandlerType = lambda data: None
 
+        # non-zero for addresses where writes should call watch_handler with
+        # the address, old value and new value
+        self.write_watch = bytearray(2 ** 18)
+        WatchHandlerType = typ.Callable[[int, int, int], None]
+        self.watch_handler: WatchHandlerType = lambda address, old, new: None
+
+        # if set, called with the step, PC, address and whether it's a write
+        # for every data memory access (but not instruction fetches)
+        AccessRecorderType = typ.Callable[[int, int, int, bool], None]
+        self.access_recorder: typ.Optional[AccessRecorderType] = None
+
+    def take_snapshot(self) -> 'Snapshot':
+        return Snapshot(self)
+
+    def restore_snapshot(self, snapshot: 'Snapshot') -> None:
+        self.memory[:] = zlib.decompress(snapshot.memory)
+        (
+            self.program_counter, self.a_register,
+            self.memory_address_register, self.input_register,
+            self.input_ready_flag
+        ) = snapshot.registers
+        self.input_queue = collections.deque(snapshot.input_queue)
+        self.step_count = snapshot.step_count
+        del self.outputs[snapshot.num_outputs:]
+        self.partial_output = list(snapshot.partial_output)
+
     @staticmethod
     def words_to_int(words: typ.List[int]) -> int:
         value = 0
@@ -52,23 +127,32 @@ class Emulator:
 
         return words_reversed[::-1]
 
+    def provide_input(self, words: typ.Iterable[int]) -> None:
+        for word in words:
+            assert 0 <= word < 64
+            self.input_queue.append(word)
+        self.update_input_register()
+
+    def update_input_register(self) -> None:
+        if self.input_queue:
+            self.input_register = self.input_queue[0]
+            self.input_ready_flag = 1
+        else:
+            self.input_ready_flag = 0
+
     def read_ram(self, address: int) -> int:
         assert 0 <= address < 2 ** 18
-
-        compiled_word = self.compiled_program.data[address]
-        assert compiled_word is not None
-        assert compiled_word.for_reading
+        assert self.readable[address]
 
         return self.memory[address]
 
     def write_ram(self, address: int, value: int) -> None:
         assert 0 < address <= 2 ** 18
-
-        compiled_word = self.compiled_program.data[address]
-        assert compiled_word is not None
-        assert compiled_word.for_writing
+        assert self.writable[address]
 
         # print(f"Writing, {address}, {value}")
+        if self.write_watch[address]:
+            self.watch_handler(address, self.memory[address], value)
         self.memory[address] = value
 
     def read_ram_from_pc(self, offset: int) -> int:
@@ -76,9 +160,7 @@ class Emulator:
         assert self.program_counter % 4 == 0
         address = self.program_counter + offset
 
-        compiled_word = self.compiled_program.data[address]
-        assert compiled_word is not None
-        assert compiled_word.for_execution
+        assert self.executable[address]
 
         return self.read_ram(self.program_counter + offset)
 
@@ -118,6 +200,12 @@ class Emulator:
                 low = self.read_ram_from_pc(3)
 
             address = self.words_to_int([hi, mid, low])
+            if self.access_recorder is not None:
+                self.access_recorder(
+                    self.step_count, self.program_counter, address,
+                    bool(opcode & 0b010000)
+                )
+
             if opcode & 0b010000:
                 self.write_ram(address, self.a_register)
             else:
@@ -166,6 +254,9 @@ class Emulator:
         elif opcode & 0b000001:
             assert opcode in (0b000001,)
             self.a_register = self.input_register
+            if self.input_ready_flag:
+                self.input_queue.popleft()
+                self.update_input_register()
         else:
             self.trigger_error_at_current(f'Unknown opcode: 0b{opcode:06b}')
 
@@ -173,6 +264,142 @@ class Emulator:
             # TODO: handle wraparound
             self.program_counter = self.program_counter + 4
 
+        self.step_count += 1
+
+    def run(
+        self, max_steps: typ.Optional[int] = None,
+        pc_hooks: typ.Optional[PcHooks] = None
+    ) -> StopReason:
+        # Equivalent to calling step() until is_self_jump(), but with the
+        # common instructions decoded inline. Anything unusual (output, input,
+        # bad permissions, unknown opcodes) goes through step() so that the
+        # behaviour and errors are exactly the same.
+        # After each instruction (including the last one allowed by
+        # max_steps), if the new PC is in pc_hooks its hook is called, and
+        # the run stops if it returns True. Output handlers can
+        # set stop_requested to stop the run after the current instruction, as
+        # can the watch handler, which is called from the slow path.
+        # interrupt_requested is checked after every jump (which every loop
+        # has) and every instruction on the slow path. The run then stops
+        # the way it does at max_steps, after the new PC's hook.
+        if max_steps is not None and max_steps < 0:
+            raise ValueError(f'max_steps must not be negative: {max_steps}')
+        if pc_hooks is None:
+            pc_hooks = {}
+        self.stop_requested = False
+
+        memory = self.memory
+        readable = self.readable
+        writable = self.writable
+        write_watch = self.write_watch
+        fetchable = self.fetchable
+        recorder = self.access_recorder
+
+        pc = self.program_counter
+        a = self.a_register
+        start_count = self.step_count
+        steps = 0
+        step_limit = -1 if max_steps is None else max_steps
+        reason = StopReason.MAX_STEPS
+
+        try:
+            while True:
+                if steps and pc in pc_hooks:
+                    self.program_counter = pc
+                    self.a_register = a
+                    self.step_count = start_count + steps
+                    if pc_hooks[pc]():
+                        reason = StopReason.BREAKPOINT
+                        break
+
+                if steps == step_limit:
+                    if self.interrupt_requested:
+                        reason = StopReason.REQUESTED
+                    break
+
+                opcode = memory[pc] if fetchable[pc] else -1
+
+                if opcode == 0b100000:
+                    address = (
+                        memory[pc + 1] << 12 | memory[pc + 2] << 6 |
+                        memory[pc + 3]
+                    )
+                    if readable[address]:
+                        if recorder is not None:
+                            recorder(start_count + steps, pc, address, False)
+                        a = memory[address]
+                        pc += 4
+                        steps += 1
+                        continue
+                elif opcode == 0b110000:
+                    address = (
+                        memory[pc + 1] << 12 | memory[pc + 2] << 6 |
+                        memory[pc + 3]
+                    )
+                    if writable[address] and not write_watch[address]:
+                        if recorder is not None:
+                            recorder(start_count + steps, pc, address, True)
+                        memory[address] = a
+                        pc += 4
+                        steps += 1
+                        continue
+                elif opcode == 0b101000:
+                    address = memory[pc + 1] << 12 | memory[pc + 2] << 6 | a
+                    if readable[address]:
+                        if recorder is not None:
+                            recorder(start_count + steps, pc, address, False)
+                        a = memory[address]
+                        pc += 4
+                        steps += 1
+                        continue
+                elif opcode == 0b010000:
+                    a = (a + 1) % 64
+                    pc += 4
+                    steps += 1
+                    continue
+                elif opcode == 0b001100 or (opcode == 0b001010 and a):
+                    address = (
+                        memory[pc + 1] << 12 | memory[pc + 2] << 6 |
+                        memory[pc + 3]
+                    )
+                    if address == pc and opcode == 0b001100:
+                        reason = StopReason.HALTED
+                        break
+                    if address % 4 == 0:
+                        pc = address
+                        steps += 1
+                        if self.interrupt_requested:
+                            step_limit = steps
+                        continue
+                elif opcode == 0b001010:
+                    pc += 4
+                    steps += 1
+                    continue
+
+                # slow path
+                self.program_counter = pc
+                self.a_register = a
+                self.step_count = start_count + steps
+                if self.is_self_jump():
+                    reason = StopReason.HALTED
+                    break
+                self.step()
+                pc = self.program_counter
+                a = self.a_register
+                steps += 1
+
+                if self.stop_requested:
+                    reason = StopReason.REQUESTED
+                    break
+                if self.interrupt_requested:
+                    step_limit = steps
+        finally:
+            self.program_counter = pc
+            self.a_register = a
+            self.step_count = start_count + steps
+
+        return reason
+
     def is_self_jump(self) -> bool:
         # check if the next instruction is a jump to itself, indicating a halt
         opcode = self.read_ram_from_pc(0)
@@ -0,0 +1,88 @@
+import bisect
+import typing as typ
+
+from .emulator import Emulator, Snapshot
+
+
+class SnapshotStore:
+    # Snapshots are taken every `interval` steps. Once they take up more than
+    # `budget` bytes, the snapshot that leaves the smallest hole relative to
+    # its distance from the current step is evicted, so that the ones left
+    # are roughly logarithmically spaced going back from the current step.
+    # The first snapshot (step 0) is never evicted.
+    def __init__(self, interval: int, budget: int):
+        assert interval > 0
+        self.interval = interval
+        self.budget = budget
+        self.steps: typ.List[int] = []
+        self.snapshots: typ.List[Snapshot] = []
+        # whatever else the debugger needs back along with each snapshot
+        self.extras: typ.List[typ.Any] = []
+        self.total_size = 0
+
+    def next_boundary(self, step: int) -> int:
+        return (step // self.interval + 1) * self.interval
+
+    def record(self, emu: Emulator, extra: typ.Any = None) -> None:
+        step = emu.step_count
+        index = bisect.bisect_left(self.steps, step)
+        if index < len(self.steps) and self.steps[index] == step:
+            return
+
+        snapshot = emu.take_snapshot()
+        self.steps.insert(index, step)
+        self.snapshots.insert(index, snapshot)
+        self.extras.insert(index, extra)
+        self.total_size += snapshot.size
+
+        self.evict(step)
+
+    def record_if_on_boundary(
+        self, emu: Emulator, extra: typ.Any = None
+    ) -> None:
+        if emu.step_count % self.interval == 0:
+            self.record(emu, extra)
+
+    def evict(self, current_step: int) -> None:
+        while self.total_size > self.budget and len(self.steps) > 2:
+            best_index = 1
+            best_cost = float('inf')
+
+            for index in range(1, len(self.steps)):
+                if index + 1 < len(self.steps):
+                    right = self.steps[index + 1]
+                else:
+                    right = max(current_step, self.steps[index])
+                hole = right - self.steps[index - 1]
+                distance = abs(current_step - self.steps[index]) + 1
+                cost = hole / distance
+
+                if cost < best_cost:
+                    best_index = index
+                    best_cost = cost
+
+            self.total_size -= self.snapshots[best_index].size
+            del self.steps[best_index]
+            del self.snapshots[best_index]
+            del self.extras[best_index]
+
+    def discard_from(self, step: int) -> None:
+        # for when the emulator state is changed other than by running
+        index = bisect.bisect_left(self.steps, step)
+        for snapshot in self.snapshots[index:]:
+            self.total_size -= snapshot.size
+        del self.steps[index:]
+        del self.snapshots[index:]
+        del self.extras[index:]
+
+    def nearest_index(self, step: int) -> int:
+        # of the latest snapshot at or before step
+        index = bisect.bisect_right(self.steps, step) - 1
+        assert index >= 0, 'no snapshot before step'
+        return index
+
+    def nearest(self, step: int) -> Snapshot:
+        return self.snapshots[self.nearest_index(step)]
+
+    def nearest_extra(self, step: int) -> typ.Any:
+        return self.extras[self.nearest_index(step)]
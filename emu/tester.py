@@ -1,12 +1,18 @@
 import abc
+import asyncio
+import contextlib
+import io
 import itertools
 import os
+import queue
+import struct
+import threading
 import time
 import typing as typ
 
 from asm import assembler
 
-from emu import emulator
+from emu import debug_server, debugger, emulator
 
 ExpectedOutput = typ.List[typ.Union[str, int]]
 
@@ -24,20 +30,14 @@ class SimpleTest(abc.ABC):
 
     def setup(self, verbose: bool) -> bool:
         self.timer = time.time()
-        self.assembler = assembler.Assembler()
         try:
-            self.assembler.assemble_file(os.path.join(
+            program = assembler.load_program(os.path.join(
                 os.path.dirname(__file__),
                 'tests',
                 self.xasm_file
-            ) + '.xasm')
+            ) + '.xasm', use_cache=True)
             if verbose:
-                print(f'Assembled in {time.time() - self.timer:.3f}')
-            self.timer = time.time()
-
-            program = self.assembler.link_data()
-            if verbose:
-                print(f'Linked in {time.time() - self.timer:.3f}')
+                print(f'Loaded in {time.time() - self.timer:.3f}')
                 self.timer = time.time()
 
         except assembler.AssemblyError as err:
@@ -48,16 +48,12 @@ class SimpleTest(abc.ABC):
         self.emulator = emulator.Emulator(program, verbose)
         return True
 
-    def halt_condition(self) -> bool:
-        return self.emulator.is_self_jump()
-
     def run(self, verbose: bool) -> bool:
         print(f" == {self.test_name} == ")
         if not self.setup(verbose):
             return False
 
-        while not self.halt_condition():
-            self.emulator.step()
+        self.emulator.run()
 
         if verbose:
             print(f'\nRan in {time.time() - self.timer:.3f}')
@@ -82,6 +78,38 @@ class SimpleTest(abc.ABC):
         return True
 
 
+class ScriptTest(SimpleTest):
+    # Runs debugger commands on the program. Passes if the script's
+    # assertions do (or fail, for should_pass = False), and it printed
+    # each of the expected lines.
+    expected_output: ExpectedOutput = []
+    expected_lines: typ.List[str] = []
+    snapshot_interval = 100_000
+    should_pass = True
+
+    @abc.abstractproperty
+    def script(self) -> typ.List[str]: pass
+
+    def run(self, verbose: bool) -> bool:
+        print(f" == {self.test_name} == ")
+        if not self.setup(verbose):
+            return False
+
+        debug = debugger.Debugger(self.emulator, self.snapshot_interval)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            passed = debug.run_script(self.script)
+
+        printed = output.getvalue().split('\n')
+        missing = [line for line in self.expected_lines if line not in printed]
+        if verbose or passed != self.should_pass or missing:
+            print(output.getvalue())
+        for line in missing:
+            print(f" Missing line: {line}")
+
+        return passed == self.should_pass and not missing
+
+
 class Count1Test(SimpleTest):
     xasm_file = 'count_1'
     test_name = 'count 1'
@@ -144,6 +172,359 @@ class BinaryCompareTest(SimpleTest):
     ]
 
 
+class ConditionalBreakpointTest(ScriptTest):
+    xasm_file = 'count_1'
+    test_name = 'conditional breakpoints'
+
+    script = [
+        'b :loop if a == 10',
+        'c',
+        'assert a == 10',
+        'assert step == 31',
+        'd 0',
+        'b :loop if *:constants.zero != 0',
+        'b :loop hits 5',
+        'c',
+        'assert a == 15',
+        'b :loop hits 0',
+        'bl',
+    ]
+    expected_lines = [
+        'Break due to [conditional, <4 loop; [0, 0, 4] = 2> (loop) '
+        '(hit 5/5)]',
+        'Expected a hit count of at least 1',
+        '  0: conditional, <4 loop; [0, 0, 4] = 2> (loop) if '
+        '<20 constants.zero; [0, 0, 20] = 0> != 0',
+    ]
+
+
+class HitCountTest(ScriptTest):
+    xasm_file = 'count_1'
+    test_name = 'breakpoint hit counts'
+
+    # every third time round the loop, counting from where each was added
+    script = [
+        'b :loop hits 3',
+        'c',
+        'assert a == 2',
+        'd 0',
+        'b :loop hits 3',
+        'c',
+        'assert a == 5',
+        'c',
+        'assert a == 6',
+    ]
+
+
+class WatchpointTest(ScriptTest):
+    xasm_file = 'addition_1'
+    test_name = 'watchpoints'
+
+    # filling in the table writes 0 to its first word, which isn't a change
+    script = [
+        'w :addition_table changes',
+        'w :initialise_addition_table.val_sum',
+        'c',
+        'assert *:initialise_addition_table.val_sum == 1',
+        'assert step == 5',
+        'c',
+        'assert *:initialise_addition_table.val_sum == 2',
+        'uw :initialise_addition_table.val_sum',
+        'w :initialise_addition_table.val_x changes',
+        'c',
+        'assert *:initialise_addition_table.val_x == 1',
+        'assert *:initialise_addition_table.val_y == 0',
+        'wl',
+    ]
+    expected_lines = [
+        'Break due to write of 1 -> 2 [writes to <100 '
+        'initialise_addition_table.val_sum; [0, 1, 36] = 1> '
+        '(initialise_addition_table.data, '
+        'initialise_addition_table.val_sum)] by PC = <16 '
+        'initialise_addition_table.val_y+5; [0, 0, 16] = 48>',
+        'changes to <4096 addition_table; [1, 0, 0] = 0> (addition_table)',
+    ]
+
+
+class ReverseExecutionTest(ScriptTest):
+    xasm_file = 'count_1'
+    test_name = 'reverse execution'
+    # so that going back restores a snapshot and replays from it
+    snapshot_interval = 10
+
+    script = [
+        'c',
+        'assert step == 193',
+        'goto 31',
+        'assert a == 10',
+        'assert step == 31',
+        'rs',
+        'assert step == 30',
+        'b :loop if a == 5',
+        'rc',
+        'assert a == 5',
+        'assert step == 16',
+        'rc',
+        'assert step == 0',
+        'd 0',
+        'b :loop hits 3',
+        'c',
+        'assert a == 2',
+        'goto 0',
+        'c',
+        'assert a == 2',
+        'c',
+        'assert a == 3',
+        'rc',
+        'assert a == 2',
+        'bl',
+    ]
+    expected_lines = [
+        'Reverse break at step 16',
+        'Reached the start of execution',
+        '  0: conditional, <4 loop; [0, 0, 4] = 2> (loop) (hit 3/3)',
+    ]
+
+
+class StepOverTest(ScriptTest):
+    xasm_file = 'big_int_10_1'
+    test_name = 'next, until and finish'
+
+    script = [
+        'u :main',
+        'assert pc == :main',
+        'fin',
+        'n',
+        'n',
+        'n',
+        'n',
+        'assert pc == 20',
+        'n',
+        'assert pc == 48',
+        'u :big_int_10_increment',
+        'assert pc == :big_int_10_increment',
+        'fin',
+        'assert pc == 76',
+        'assert *:big_int_10_args.alpha == 12',
+    ]
+    expected_lines = [
+        'Not in a function called with CALL',
+        'Stopped at <48 main+44; [0, 0, 48] = 32>',
+        'Run until return to <76 main+72; [0, 1, 12] = 32>',
+    ]
+
+
+class LocalLabelTest(ScriptTest):
+    xasm_file = 'big_int_10_1'
+    test_name = 'local labels'
+
+    script = [
+        'b .loop',
+        'u :big_int_10_increment',
+        'u .loop',
+        'assert pc == :big_int_10_increment.loop',
+        'b .done',
+        'c',
+        'assert pc == :big_int_10_increment.done',
+        'i .idx_1',
+    ]
+    expected_lines = [
+        "Can't find local label _global_start.loop",
+        '<1175 big_int_10_increment.idx_1; [0, 18, 23] = 1>',
+    ]
+
+
+class AccessHistoryTest(ScriptTest):
+    xasm_file = 'addition_1'
+    test_name = 'memory access history'
+
+    script = [
+        'lw :initialise_addition_table.val_sum',
+        'record on',
+        'b :initialise_addition_table.start hits 3',
+        'c',
+        'lw :initialise_addition_table.val_sum',
+        'lr :initialise_addition_table.val_sum',
+        'lw :initialise_addition_table.val_sum before 5',
+        'lw :initialise_addition_table.val_x',
+        'record off',
+    ]
+    expected_lines = [
+        'Not recording, use `record on` first',
+        '<100 initialise_addition_table.val_sum; [0, 1, 36] = 2> last '
+        'written before step 17 at step 12 by PC = <16 '
+        'initialise_addition_table.val_y+5; [0, 0, 16] = 48>',
+        '<100 initialise_addition_table.val_sum; [0, 1, 36] = 2> last '
+        'read before step 17 at step 9 by PC = <4 '
+        'initialise_addition_table.main_loop; [0, 0, 4] = 32>',
+        '<100 initialise_addition_table.val_sum; [0, 1, 36] = 2> last '
+        'written before step 5 at step 4 by PC = <16 '
+        'initialise_addition_table.val_y+5; [0, 0, 16] = 48>',
+        '<10 initialise_addition_table.val_x; [0, 0, 10] = 0> not '
+        'written between steps 0 and 17',
+    ]
+
+
+class TracepointTest(ScriptTest):
+    xasm_file = 'count_1'
+    test_name = 'tracepoints'
+
+    # the values are printed once the run stops
+    script = [
+        't :loop a step',
+        't :loop label pc *:constants.zero',
+        'b :loop hits 2',
+        'c',
+        'ut 0',
+        'tl',
+        'c',
+        'assert a == 2',
+    ]
+    expected_lines = [
+        'Trace @4: a = 0  step = 1',
+        'Trace @4: :loop  PC = 4  [20] = 0',
+        'Trace @4: a = 1  step = 4',
+        '  0: trace <4 loop; [0, 0, 4] = 2>: label, pc, 20',
+    ]
+
+
+class FailedAssertionTest(ScriptTest):
+    xasm_file = 'count_1'
+    test_name = 'script stops at a failed assertion'
+    should_pass = False
+
+    # the last two lines are never run
+    script = [
+        '# comments and blank lines are skipped',
+        '',
+        'b :loop if a == 10',
+        'c',
+        'assert a == 11',
+        'd 0',
+        'c',
+    ]
+    expected_lines = [
+        ' dbg >> b :loop if a == 10',
+        'Assertion failed: a = 10, not == 11',
+    ]
+
+    def run(self, verbose: bool) -> bool:
+        if not super().run(verbose):
+            return False
+        if self.emulator.step_count != 31:
+            print(f" Ran on to step {self.emulator.step_count}")
+            return False
+        return True
+
+
+class DebugServerTest(SimpleTest):
+    xasm_file = 'count_1'
+    test_name = 'debug server'
+    expected_output: ExpectedOutput = []
+
+    def run(self, verbose: bool) -> bool:
+        print(f" == {self.test_name} == ")
+        if not self.setup(verbose):
+            return False
+
+        # no snapshots while running, which is when interrupts used to be
+        # looked at
+        server = debug_server.DebugServer(
+            debugger.Debugger(self.emulator, 2 ** 40)
+        )
+        started: 'queue.Queue[typ.Tuple[int, asyncio.Future[None]]]' = (
+            queue.Queue()
+        )
+        thread = threading.Thread(
+            target=asyncio.run, args=[self.serve(server, started)]
+        )
+        thread.start()
+        port, stop = started.get()
+
+        client = debug_server.DebugClient.connect_tcp('127.0.0.1', port)
+        client.sock.settimeout(10)
+        output = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(output):
+                results = self.make_requests(client)
+        except (OSError, debug_server.ProtocolError) as err:
+            print(output.getvalue())
+            print(f" Request failed: {type(err).__name__}: {err}")
+            return False
+        finally:
+            # in case a run is still going
+            self.emulator.interrupt_requested = True
+            client.close()
+            stop.get_loop().call_soon_threadsafe(stop.set_result, None)
+            thread.join()
+
+        if verbose:
+            print(output.getvalue())
+        for name, actual, expected in results:
+            if actual != expected:
+                print(f" Discrepancy in {name}")
+                print(f"     Expected: {expected}")
+                print(f"       Actual: {actual}")
+                return False
+        return True
+
+    @staticmethod
+    async def serve(
+        server: debug_server.DebugServer,
+        started: 'queue.Queue[typ.Tuple[int, asyncio.Future[None]]]'
+    ) -> None:
+        # on a free port, until the future it gives is done
+        listener = await asyncio.start_server(
+            server.handle_connection, '127.0.0.1', 0
+        )
+        stop = asyncio.get_running_loop().create_future()
+        started.put((listener.sockets[0].getsockname()[1], stop))
+        async with listener:
+            await stop
+
+    def make_requests(
+        self, client: debug_server.DebugClient
+    ) -> typ.List[typ.Tuple[str, typ.Any, typ.Any]]:
+        # what each request gave, and what it should have
+        StopReason = emulator.StopReason
+        results: typ.List[typ.Tuple[str, typ.Any, typ.Any]] = [
+            ('step', client.step(), (StopReason.MAX_STEPS, (4, 0, 0, 1))),
+            ('registers', client.registers(), (4, 0, 0, 1)),
+            ('read', client.read_memory(0, 4), bytes([32, 0, 0, 20])),
+        ]
+
+        client.add_breakpoint(8)
+        results.append((
+            'continue', client.resume(),
+            (StopReason.BREAKPOINT, (8, 0, 0, 2))
+        ))
+        client.remove_breakpoint(8)
+        results.append(('outputs', client.outputs(), ['0']))
+
+        # now INC_A, INC_A, JUMP :loop, which never stops or outputs. The
+        # INTERRUPT is answered first, and stops the CONTINUE sent before it.
+        client.write_memory(4, bytes([16, 0, 0, 0]))
+        client.write_memory(12, bytes([12, 0, 0, 4]))
+        client.send(debug_server.CONTINUE, struct.pack('>I', 0))
+        client.send(debug_server.INTERRUPT)
+        results.append(('interrupt', client.receive(), b''))
+        reason, registers = client.run_result(client.receive())
+        results.append(('interrupted', reason, StopReason.REQUESTED))
+
+        # errors in the program are reported, and the session carries on
+        pc = registers[0]
+        client.write_memory(pc, bytes([63]))
+        try:
+            client.step()
+            error = ''
+        except debug_server.ProtocolError as err:
+            error = str(err)
+        symbol = self.emulator.compiled_program.symbol_text(pc)
+        results.append(('error', error, f'Assertion at PC {pc} ({symbol})'))
+        results.append(('after error', client.registers()[0], pc))
+        return results
+
+
 all_tests = [
     Count1Test(),
     NoOpTest(),
@@ -153,6 +534,16 @@ all_tests = [
     LibUnaryMinusTest(),
     UnaryLogicTest(),
     BinaryCompareTest(),
+    ConditionalBreakpointTest(),
+    HitCountTest(),
+    WatchpointTest(),
+    ReverseExecutionTest(),
+    StepOverTest(),
+    LocalLabelTest(),
+    AccessHistoryTest(),
+    TracepointTest(),
+    FailedAssertionTest(),
+    DebugServerTest(),
 ]
 
 VERBOSE = True
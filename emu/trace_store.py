@@ -0,0 +1,73 @@
+import array
+import bisect
+import typing as typ
+
+
+class AccessIndex:
+    # steps and PCs of the accesses to a single address, in step order
+    def __init__(self) -> None:
+        self.steps = array.array('q')
+        self.pcs = array.array('l')
+
+
+class TraceStore:
+    # Records every data memory access into flat append-only logs, which are
+    # indexed by address on demand so that finding the last access to an
+    # address before some step is a binary search.
+    def __init__(self, first_step: int) -> None:
+        self.first_step = first_step
+        self.last_step = first_step - 1
+
+        self.log_steps = array.array('q')
+        self.log_pcs = array.array('l')
+        self.log_addresses = array.array('l')
+        self.log_is_write = bytearray()
+
+        self.indexed_count = 0
+        self.read_index: typ.Dict[int, AccessIndex] = {}
+        self.write_index: typ.Dict[int, AccessIndex] = {}
+
+    def record(self, step: int, pc: int, address: int, is_write: bool) -> None:
+        if step <= self.last_step:
+            # already recorded, so this must be a replay of earlier history
+            return
+        self.last_step = step
+
+        self.log_steps.append(step)
+        self.log_pcs.append(pc)
+        self.log_addresses.append(address)
+        self.log_is_write.append(is_write)
+
+    def update_index(self) -> None:
+        for event_num in range(self.indexed_count, len(self.log_steps)):
+            if self.log_is_write[event_num]:
+                index = self.write_index
+            else:
+                index = self.read_index
+
+            address = self.log_addresses[event_num]
+            if address not in index:
+                index[address] = AccessIndex()
+            index[address].steps.append(self.log_steps[event_num])
+            index[address].pcs.append(self.log_pcs[event_num])
+
+        self.indexed_count = len(self.log_steps)
+
+    def last_access(
+        self, address: int, before_step: int, is_write: bool
+    ) -> typ.Optional[typ.Tuple[int, int]]:
+        # the (step, PC) of the last access strictly before before_step
+        self.update_index()
+
+        indices = self.write_index if is_write else self.read_index
+        index = indices.get(address)
+        if index is None:
+            return None
+
+        position = bisect.bisect_left(index.steps, before_step) - 1
+        if position < 0:
+            return None
+        return index.steps[position], index.pcs[position]
+
+    def __len__(self) -> int:
+        return len(self.log_steps)